@@ -0,0 +1,137 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+# keeps track of which ingredient is loaded in which slot (bottle on a pump/valve) and of
+# the cocktails that can be poured with them
+#
+# every ingredient gets a bit, every recipe a bitmask of the ingredients it needs, so a recipe
+# is pourable if (recipe_mask & ~available_mask) == 0. when a bottle runs dry or is swapped,
+# only the recipes containing the changed ingredient (from the inverted index of the
+# RecipeStore) are checked again, the pourable set is always ready to be read.
+# watchers get the names of the recipes that were checked again
+class Availability():
+
+    def __init__(self, recipes, slots = ()):
+        self.recipes = recipes
+        self.bits = {}
+        self.recipe_masks = {}
+        self.available_mask = 0
+        self.ingredient_slots = {}
+        self.slots = {}
+        self.empty = set()
+        self.pourable = set()
+        # changes whenever the pourable set changes, lets the menus skip unchanged lists
+        self.version = 0
+        self.watchers = []
+        for recipe in recipes:
+            self.addRecipe(recipe)
+        for slot in slots:
+            self.setSlot(slot["slot"], slot["ingredient"], slot.get("pump", 0))
+
+    @classmethod
+    def load(cls, recipes, filename):
+        with open(filename) as machine_json_file:
+            return cls(recipes, json.load(machine_json_file)["slots"])
+
+    def bit(self, ingredient):
+        if ingredient not in self.bits:
+            self.bits[ingredient] = 1 << len(self.bits)
+        return self.bits[ingredient]
+
+    def mask(self, ingredients):
+        mask = 0
+        for ingredient in ingredients:
+            mask |= self.bit(ingredient)
+        return mask
+
+    # callback(names) after recipes were checked again
+    def watch(self, callback):
+        self.watchers.append(callback)
+
+    def notify(self, names):
+        for callback in self.watchers:
+            callback(names)
+
+    def isAvailable(self, ingredient):
+        return bool(self.available_mask & self.bits.get(ingredient, 0))
+
+    # recipes have to be in the RecipeStore before they are added here
+    def addRecipe(self, recipe):
+        mask = self.mask(recipe.ingredients)
+        self.recipe_masks[recipe.name] = mask
+        self.version += 1
+        if mask & ~self.available_mask == 0:
+            self.pourable.add(recipe.name)
+        else:
+            self.pourable.discard(recipe.name)
+        self.notify([recipe.name])
+
+    def removeRecipe(self, name):
+        self.recipe_masks.pop(name, None)
+        self.pourable.discard(name)
+        self.version += 1
+        self.notify([name])
+
+    def names(self, alcoholic = True):
+        if alcoholic:
+            return set(self.pourable)
+        return self.pourable & self.recipes.categories["non-alcoholic"]
+
+    # load an ingredient into a slot, None means the slot is unused
+    def setSlot(self, slot, ingredient, pump = 0):
+        old = self.slots.get(slot)
+        self.empty.discard(slot)
+        self.slots[slot] = (ingredient, pump)
+        if old is not None and old[0] is not None:
+            self.ingredient_slots[old[0]].discard(slot)
+            self.updateIngredient(old[0])
+        if ingredient is not None:
+            self.ingredient_slots.setdefault(ingredient, set()).add(slot)
+            self.updateIngredient(ingredient)
+
+    def setEmpty(self, slot, empty = True):
+        if slot not in self.slots:
+            return
+        if empty:
+            self.empty.add(slot)
+        else:
+            self.empty.discard(slot)
+        ingredient = self.slots[slot][0]
+        if ingredient is not None:
+            self.updateIngredient(ingredient)
+
+    def slotsFor(self, ingredient):
+        return [slot for slot in self.ingredient_slots.get(ingredient, ()) if slot not in self.empty]
+
+    def updateIngredient(self, ingredient):
+        bit = self.bit(ingredient)
+        was_available = bool(self.available_mask & bit)
+        available = len(self.slotsFor(ingredient)) > 0
+        if available == was_available:
+            return
+        self.version += 1
+        if available:
+            self.available_mask |= bit
+            for name in self.recipes.by_ingredient.get(ingredient, ()):
+                if self.recipe_masks[name] & ~self.available_mask == 0:
+                    self.pourable.add(name)
+        else:
+            self.available_mask &= ~bit
+            self.pourable -= self.recipes.by_ingredient.get(ingredient, set())
+        self.notify(self.recipes.by_ingredient.get(ingredient, ()))
@@ -0,0 +1,239 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+
+# benchmark suite, runs on the offscreen Qt platform (no display needed)
+#
+#   python3 benchmarks/bench.py -o results.json              run and write the results
+#   python3 benchmarks/bench.py --save-baseline base.json    run and save as baseline
+#   python3 benchmarks/bench.py --compare base.json          run and compare, exit code 1 on regressions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+# a result is a regression if it is this much worse than the baseline
+TOLERANCE = 0.10
+
+RECIPE_COUNTS = (10, 100, 1000, 10000, 100000)
+
+def timeit(func, min_time = 0.2):
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / runs
+
+def syntheticIngredients(count = 60):
+    return {"ingredient " + str(i): {"price": round(random.uniform(0.5, 5), 2), "density": round(random.uniform(0.8, 2), 2)} for i in range(count)}
+
+def syntheticCocktails(recipe_count, ingredients):
+    names = list(ingredients)
+    data = {"alcoholic": {}, "non-alcoholic": {}}
+    for i in range(recipe_count):
+        category = "alcoholic" if i % 2 else "non-alcoholic"
+        data[category]["cocktail " + str(i)] = [[name, random.randint(5, 100)] for name in random.sample(names, random.randint(2, 6))]
+    return data
+
+class Results():
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name, value, unit, higher_is_better = True):
+        self.results[name] = {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+        print("%-44s %14.3f %s" % (name, value, unit))
+        sys.stdout.flush()
+
+def benchFrames(results, app):
+    import protocol
+    from cocktailmixer import HardwareInterface
+    hardware_interface = HardwareInterface("/dev/null-cocktailmixer-bench", binary = False)
+    for mode, binary in (("json", False), ("binary", True)):
+        frames = [protocol.encode_frame("update", "scale", random.randint(0, 300), binary) for i in range(1000)]
+        def parse():
+            for frame in frames:
+                hardware_interface.serialProcess(frame)
+        results.add("serialProcess." + mode, len(frames) / timeit(parse), "frames/s")
+        splitter = protocol.FrameSplitter()
+        stream = b"".join(frames)
+        def split():
+            splitter.feed(stream)
+            for raw in splitter.frames():
+                protocol.decode_frame(raw)
+        results.add("split_decode." + mode, len(frames) / timeit(split), "frames/s")
+    hardware_interface.close()
+
+    from scalefilter import ScaleFilter
+    scale_filter = ScaleFilter()
+    samples = [(180 + random.gauss(0, 0.5), i / 500) for i in range(1000)]
+    def filter_samples():
+        for value, now in samples:
+            scale_filter.update(value, now)
+    results.add("scale_filter", len(samples) / timeit(filter_samples), "samples/s")
+
+def benchRecipes(results):
+    from cocktailmixer import Controller
+    from mixerdata import MixerData
+    from recipes import RecipeStore
+    from pricing import PriceTable
+    from search import SearchIndex
+    from availability import Availability
+    from sampling import Suggestions
+    ingredients = syntheticIngredients()
+    # only the recipe math of the controller, without any hardware or GUI
+    controller = Controller.__new__(Controller)
+    controller.shared = MixerData()
+    controller.shared.ingredients_data = ingredients
+    for count in RECIPE_COUNTS:
+        store = RecipeStore(syntheticCocktails(count, ingredients))
+        recipes = list(store)[:1000]
+        def calculate():
+            for recipe in recipes:
+                controller.get_masses(controller.get_normalized_volumes(100, recipe.volumes))
+        results.add("recipe_math." + str(count), len(recipes) / timeit(calculate), "recipes/s")
+        start = time.perf_counter()
+        PriceTable(store, ingredients)
+        results.add("price_table_build." + str(count), (time.perf_counter() - start) * 1000, "ms", False)
+        index = SearchIndex(store)
+        # typing "cocktail 12" letter by letter, plus a misspelled name for the fuzzy match
+        queries = ["cocktail 12"[:i] for i in range(1, 12)] + ["coktail 21"]
+        def search():
+            for query in queries:
+                index.search(query)
+        results.add("search_keystroke." + str(count), timeit(search) / len(queries) * 1000, "ms", False)
+        # the same on a machine with 24 of the 60 ingredients, only its pourable cocktails are found
+        machine = Availability(store, [{"slot": i, "ingredient": name} for i, name in enumerate(list(ingredients)[:24])])
+        allowed = machine.names()
+        def searchPourable():
+            for query in queries:
+                index.search(query, allowed)
+        results.add("search_keystroke_pourable." + str(count), timeit(searchPourable) / len(queries) * 1000, "ms", False)
+        # every ingredient loaded: all cocktails are suggested
+        availability = Availability(store, [{"slot": i, "ingredient": name} for i, name in enumerate(ingredients)])
+        start = time.perf_counter()
+        suggestions = Suggestions(store, availability, PriceTable(store, ingredients), max_price = float("inf"))
+        results.add("suggestions_build." + str(count), (time.perf_counter() - start) * 1000, "ms", False)
+        def suggest():
+            for i in range(1000):
+                suggestions.cocktail(True)
+                suggestions.ingredients(False)
+        results.add("suggestions_draw." + str(count), 2000 / timeit(suggest), "draws/s")
+
+def benchRendering(results, app):
+    from cocktailmixer import CocktailProgressBar, SelectCocktailMenu
+    progress = CocktailProgressBar()
+    progress.resize(222, 260)
+    progress.show()
+    app.processEvents()
+    values = [random.randint(0, 100) for i in range(200)]
+    def paint():
+        for value in values:
+            progress.setValue(value)
+            progress.repaint()
+    timeit(paint)
+    results.add("paintEvent.CocktailProgressBar", progress.paintStats()["average_ms"], "ms", False)
+
+    menu = SelectCocktailMenu()
+    menu.resize(240, 320)
+    menu.show()
+    for count in (100, 1000, 10000):
+        names = ["cocktail " + str(i) for i in range(count)]
+        menu.model.setOrder(names)
+        def update():
+            menu.updateList(names)
+            app.processEvents()
+        results.add("updateList." + str(count), timeit(update) * 1000, "ms", False)
+
+def benchStartup(results):
+    child = ("import time, json; start = time.perf_counter(); "
+        "from PyQt5.QtWidgets import QApplication; import cocktailmixer; imported = time.perf_counter() - start; "
+        "app = QApplication([]); controller = cocktailmixer.Controller('/dev/null-cocktailmixer-bench'); "
+        "intro = time.perf_counter() - start\n"
+        "while not controller.startup_complete: app.processEvents()\n"
+        "controller.close(); "
+        "print(json.dumps({'imports': imported, 'intro': intro, 'phases': controller.startup_times}))")
+    startup = json.loads(subprocess.check_output([sys.executable, "-c", child], cwd = ROOT, stderr = subprocess.DEVNULL))
+    results.add("startup.imports", startup["imports"] * 1000, "ms", False)
+    results.add("startup.until_intro", startup["intro"] * 1000, "ms", False)
+    for name, seconds in startup["phases"].items():
+        results.add("startup.Controller." + name, seconds * 1000, "ms", False)
+
+def compare(results, baseline):
+    regressions = []
+    print("\n%-44s %14s %14s %8s" % ("benchmark", "baseline", "current", "change"))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]["value"]
+        new = result["value"]
+        change = (new - old) / old if old else 0
+        worse = -change if result["higher_is_better"] else change
+        flag = "  REGRESSION" if worse > TOLERANCE else ""
+        if flag:
+            regressions.append(name)
+        print("%-44s %14.3f %14.3f %+7.1f%%%s" % (name, old, new, change * 100, flag))
+    return regressions
+
+def main(args):
+    parser = argparse.ArgumentParser(description = "CocktailMixer benchmarks")
+    parser.add_argument("-o", "--output", help = "write the results as JSON")
+    parser.add_argument("--save-baseline", help = "write the results as new baseline")
+    parser.add_argument("--compare", help = "compare against a saved baseline")
+    parser.add_argument("--only", choices = ("frames", "recipes", "rendering", "startup"), action = "append")
+    options = parser.parse_args(args[1:])
+    random.seed(42)
+
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication(args)
+    results = Results()
+    only = options.only or ("frames", "recipes", "rendering", "startup")
+    if "frames" in only:
+        benchFrames(results, app)
+    if "recipes" in only:
+        benchRecipes(results)
+    if "rendering" in only:
+        benchRendering(results, app)
+    if "startup" in only:
+        benchStartup(results)
+
+    output = {"time": time.time(), "platform": sys.platform, "python": sys.version.split()[0], "results": results.results}
+    for filename in (options.output, options.save_baseline):
+        if filename:
+            with open(filename, "w") as output_file:
+                json.dump(output, output_file, indent = 1)
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            regressions = compare(results.results, json.load(baseline_file)["results"])
+        if regressions:
+            print("\n" + str(len(regressions)) + " regressions")
+            return 1
+    return 0
+
+if __name__== "__main__":
+    sys.exit(main( sys.argv ))
@@ -0,0 +1,141 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+
+# load test for the order API (orderserver.py)
+#
+#   python3 orderserver.py 8080 &
+#   python3 benchmarks/order_load.py --port 8080 --connections 50 --requests 5000 --listeners 20
+#
+# every connection sends orders back to back over keep-alive, the listeners follow /events.
+# reports the latency percentiles per status, refused orders (503) are the admission control
+# at work, not errors
+
+async def request(reader, writer, method, path, body = None):
+    data = json.dumps(body).encode("utf-8") if body is not None else b""
+    writer.write((method + " " + path + " HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        "Content-Length: " + str(len(data)) + "\r\n\r\n").encode("latin-1") + data)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, separator, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    return status, json.loads((await reader.readexactly(length)).decode("utf-8"))
+
+async def worker(options, cocktails, latencies, remaining):
+    reader, writer = await asyncio.open_connection(options.host, options.port)
+    try:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            order = {"cocktail": random.choice(cocktails), "size": random.choice((20, 100, 200))}
+            start = time.perf_counter()
+            status, body = await request(reader, writer, "POST", "/orders", order)
+            latencies.setdefault(status, []).append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+async def listener(options, counts, stop):
+    reader, writer = await asyncio.open_connection(options.host, options.port)
+    key = base64.b64encode(os.urandom(16)).decode("latin-1")
+    writer.write(("GET /events HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        "Sec-WebSocket-Key: " + key + "\r\nSec-WebSocket-Version: 13\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    try:
+        while not stop.is_set():
+            first, second = await reader.readexactly(2)
+            length = second & 0x7F
+            if length == 126:
+                length = int.from_bytes(await reader.readexactly(2), "big")
+            elif length == 127:
+                length = int.from_bytes(await reader.readexactly(8), "big")
+            payload = await reader.readexactly(length)
+            if first & 0x0F == 8:
+                break
+            event = json.loads(payload.decode("utf-8"))
+            counts[event["type"]] = counts.get(event["type"], 0) + 1
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+async def run(options):
+    reader, writer = await asyncio.open_connection(options.host, options.port)
+    status, body = await request(reader, writer, "GET", "/cocktails")
+    writer.close()
+    cocktails = [cocktail["name"] for cocktail in body["cocktails"]]
+    if not cocktails:
+        print("no pourable cocktails")
+        return
+    print("%d cocktails, %d connections, %d requests, %d event listeners" % (len(cocktails), options.connections,
+        options.requests, options.listeners))
+
+    stop = asyncio.Event()
+    counts = {}
+    listeners = [asyncio.ensure_future(listener(options, counts, stop)) for i in range(options.listeners)]
+    latencies = {}
+    remaining = [options.requests]
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(options, cocktails, latencies, remaining) for i in range(options.connections)])
+    elapsed = time.perf_counter() - start
+    # the events of the last orders are still on their way
+    await asyncio.sleep(0.5)
+    stop.set()
+    for task in listeners:
+        task.cancel()
+    await asyncio.gather(*listeners, return_exceptions = True)
+
+    total = sum(len(values) for values in latencies.values())
+    print("%d requests in %.2fs, %.0f requests/s" % (total, elapsed, total / elapsed))
+    print("%-8s %7s %9s %9s %9s %9s %9s" % ("status", "count", "p50 ms", "p90 ms", "p99 ms", "p99.9 ms", "max ms"))
+    for status, values in sorted(latencies.items()):
+        values.sort()
+        print("%-8d %7d %9.2f %9.2f %9.2f %9.2f %9.2f" % (status, len(values), percentile(values, 50) * 1000,
+            percentile(values, 90) * 1000, percentile(values, 99) * 1000, percentile(values, 99.9) * 1000, values[-1] * 1000))
+    if options.listeners:
+        print("events per listener: " + ", ".join("%s %.1f" % (kind, count / options.listeners) for kind, count in sorted(counts.items())))
+
+def main(args):
+    parser = argparse.ArgumentParser(description = "load test for the CocktailMixer order API")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8080)
+    parser.add_argument("--connections", type = int, default = 20, help = "concurrent keep-alive connections")
+    parser.add_argument("--requests", type = int, default = 2000, help = "orders to send in total")
+    parser.add_argument("--listeners", type = int, default = 5, help = "clients following /events")
+    options = parser.parse_args(args[1:])
+    random.seed(42)
+    asyncio.get_event_loop().run_until_complete(run(options))
+
+if __name__== "__main__":
+    main( sys.argv )
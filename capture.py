@@ -0,0 +1,135 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import mmap
+import time
+import struct
+
+import protocol
+
+# capture of the serial traffic of a session, for replay.py
+#
+# file layout, little endian, no padding, so it can be read straight from a memory map:
+#   header  magic (8 bytes), wall clock time (double), monotonic time (double) of the start
+#   record  ns since the start (uint64), direction (uint8), frame length (uint16), raw frame
+# records are only ever appended. the serial worker flushes the writer every FLUSH_INTERVAL
+# from a timer, also when no frames come, so a crash loses at most that much and leaves a
+# torn last record, which the reader ignores.
+# "python3 capture.py <file>" prints what a capture contains
+
+MAGIC = b"CMXCAP1\n"
+HEADER = struct.Struct("<8sdd")
+RECORD = struct.Struct("<QBH")
+
+# direction of a frame
+RX = 0
+TX = 1
+
+CAPTURE_DIR = "data/captures"
+
+# s
+FLUSH_INTERVAL = 1.0
+
+def captureName(name = "mixer", directory = CAPTURE_DIR):
+    return os.path.join(directory, name + "-" + time.strftime("%Y%m%d-%H%M%S") + ".cap")
+
+# used from the serial I/O thread only
+class CaptureWriter():
+
+    def __init__(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        # never continues an older capture, its times start somewhere else
+        self.file = open(filename, "xb")
+        self.filename = filename
+        self.start = time.perf_counter()
+        self.file.write(HEADER.pack(MAGIC, time.time(), self.start))
+        self.frames = 0
+        self.bytes = HEADER.size
+
+    # now: perf_counter time the frame was read or written
+    def write(self, direction, frame, now = None):
+        now = time.perf_counter() if now is None else now
+        self.file.write(RECORD.pack(max(int((now - self.start) * 1e9), 0), direction, len(frame)))
+        self.file.write(frame)
+        self.frames += 1
+        self.bytes += RECORD.size + len(frame)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class CaptureReader():
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as capture_file:
+            self.map = mmap.mmap(capture_file.fileno(), 0, access = mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            raise ValueError(filename + " is no capture")
+        magic, self.wall_time, self.start = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(filename + " is no capture")
+
+    # (s since the start, direction, frame) of every complete record, read from the map
+    # without loading the file
+    def __iter__(self):
+        data = self.map
+        offset = HEADER.size
+        end = len(data)
+        while offset + RECORD.size <= end:
+            ns, direction, length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + length > end:
+                return
+            yield ns / 1e9, direction, data[offset:offset + length]
+            offset += length
+
+    def close(self):
+        self.map.close()
+
+def main(args):
+    reader = CaptureReader(args[1])
+    counts = {}
+    frames = [0, 0]
+    sizes = [0, 0]
+    invalid = 0
+    last = 0
+    for t, direction, frame in reader:
+        frames[direction] += 1
+        sizes[direction] += len(frame)
+        last = t
+        try:
+            cmd, cmd_id, value = protocol.decode_frame(frame)
+        except protocol.FrameError:
+            invalid += 1
+            continue
+        key = ("rx " if direction == RX else "tx ") + cmd + " " + cmd_id
+        counts[key] = counts.get(key, 0) + 1
+    print("captured %s, %.1fs" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(reader.wall_time)), last))
+    print("received %d frames (%d bytes), sent %d frames (%d bytes), %d invalid" % (frames[RX], sizes[RX], frames[TX], sizes[TX], invalid))
+    for key, count in sorted(counts.items()):
+        print("%-40s %8d" % (key, count))
+    reader.close()
+
+if __name__== "__main__":
+    main( sys.argv )
@@ -15,17 +15,60 @@
 # You should have received a copy of the GNU General Public License
 # along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
 import json
+import math
 import time
+import bisect
 
-from PyQt5.QtCore import Qt, pyqtSignal, QIODevice, QObject, QPoint, QRect
-from PyQt5.QtWidgets import QApplication, QProgressBar, QPushButton, QWidget, QStackedWidget, QStyleFactory, QGridLayout, QHBoxLayout, QVBoxLayout, QSizePolicy, QLabel, QSpacerItem, QListWidget, QListWidgetItem, QCheckBox, QButtonGroup
-from PyQt5.QtGui import QPainter, QPen, QColor, QMovie, QFont, QPainter, QPolygon
-from PyQt5.QtSerialPort import QSerialPort
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QAbstractListModel, QModelIndex, QPoint, QRect, QTimer
+from PyQt5.QtWidgets import QApplication, QProgressBar, QPushButton, QWidget, QStackedWidget, QStyleFactory, QGridLayout, QHBoxLayout, QVBoxLayout, QSizePolicy, QLabel, QSpacerItem, QListWidget, QListWidgetItem, QListView, QCheckBox, QButtonGroup
+from PyQt5.QtGui import QPainter, QPen, QColor, QMovie, QFont, QPainter, QPolygon, QPixmap
+
+import protocol
+from availability import Availability
+from pouring import PourPlanner
+from orders import OrderQueue
+import eventlog
+import latency
+import flowmodel
+from flowmodel import FlowModel
+from scalefilter import ScaleFilter
+import reliable
+from mixerdata import MixerData
+from history import HISTORY_FILE
+from hotreload import DataWatcher
+from pricing import SIZES
+from sampling import Suggestions
+from capture import CaptureWriter, captureName
+
+log_serial = eventlog.getLogger("serial")
+log_hardware = eventlog.getLogger("hardware")
+log_gui = eventlog.getLogger("gui")
+log_controller = eventlog.getLogger("controller")
 
 # TODO: use cool font like in airplanes with corners and crossed zeroes?
 
+LIST_STYLE = """
+    QListView {
+        background-color: #000000;
+        color: #FFB900
+    }
+    QListView::item:selected {
+        background-color: #FFB900;
+        color: #000000;
+        border-radius: 3px;
+    }
+    QScrollBar {
+        width: 0px;
+        height: 0px;
+    }
+"""
+
+# letters picked with the encoder in the cocktail search, DEL removes the last one, OK ends the search
+SEARCH_CHARS = tuple("ABCDEFGHIJKLMNOPQRSTUVWXYZ ") + ("DEL", "OK")
+
 class HeaderLayout(QHBoxLayout):
 
     def __init__(self, title, parent = None):
@@ -76,6 +119,9 @@ class StyledPushButton(QPushButton):
             StyledPushButton:checked, StyledPushButton:pressed {
                 background-color: #DB9E00;
             }
+            StyledPushButton:disabled {
+                background-color: #5A4100;
+            }
         """)
 
 class CocktailProgressBar(QWidget):
@@ -96,16 +142,25 @@ class CocktailProgressBar(QWidget):
                # border-radius: 5px;
           # }
         # """)
-    def paintEvent(self, e):
+        self.value = 0
+        self.geometry_key = None
+        # paint timing in seconds, to check that the pour screen keeps up on the Pi
+        self.paint_time = 0
+        self.paint_time_max = 0
+        self.paint_time_total = 0
+        self.paint_count = 0
+        
+    # the glass outline and the completely filled glass only depend on the widget
+    # geometry, so they are built once and every paint just blits the visible part
+    def updateGeometryCache(self):
         # TODO: add ASCII drawing for the points
         # TODO: fill faster in thinner areas? (more realistic)
         # TODO: change from self.x()/.y() to self.size() size.width/.height
         # TODO: correctly map values for different widget heights (now 2x)
-        # TODO: default value for setValue not called before first paint?
-        # TODO: turn green at 100%?
-        # TODO: filter values outside 0 - 100%
-        # TODO: fix bug where value is wrong after too fast update, maybe in HardwareInterface?
-        # TODO: maybe add some visual styles like borders or gradients?
+        key = (self.x(), self.y(), self.width(), self.height())
+        if key == self.geometry_key:
+            return
+        self.geometry_key = key
         x_offset = self.x()                 # offset from widget to window
         y_offset = self.y()                 # offset from widget to window
         bowl_width = 140 / 2                # measured from model
@@ -129,23 +184,24 @@ class CocktailProgressBar(QWidget):
         b4 = self.getSymPoint(a4, x_symaxis)
         b5 = self.getSymPoint(a5, x_symaxis)
         
-        qp = QPainter()
-        qp.begin(self)
-        qp.setPen(QColor("#FFB900"))
-        font = QFont()
-        font.setBold(True)
-        qp.setFont(font)
-        
-        qp.drawPolyline(QPolygon([a1, a2, a3, a4, a5, b5, b4, b3, b2, b1, a1]))
-        qp.drawText(QRect(a5.x(), a5.y(), 2 * base_width, 320 - a5.y() - y_offset), Qt.AlignCenter, str(self.value) + "%")
+        self.outline = QPolygon([a1, a2, a3, a4, a5, b5, b4, b3, b2, b1, a1])
+        self.text_rect = QRect(a5.x(), a5.y(), 2 * base_width, 320 - a5.y() - y_offset)
+        self.fill_bottom = a5.y()
+        self.fill_left = a1.x()
+        self.fill_right = b1.x()
         
         # fill the Polyline
+        self.fill = QPixmap(max(self.width(), 1), max(self.height(), 1))
+        self.fill.fill(Qt.transparent)
+        qp = QPainter()
+        qp.begin(self.fill)
+        qp.setPen(QColor("#FFB900"))
         fill_width = 0
         delta_x = a1.x() - a2.x()
         delta_y = a2.y() - a1.y()
         width_factor = delta_x / delta_y
         
-        for i in range(2 * self.value):
+        for i in range(2 * 100):
             fill_height = a5.y() - i
             if fill_height >= a3.y():
                 fill_width = base_width
@@ -157,9 +213,52 @@ class CocktailProgressBar(QWidget):
         
         qp.end()
         
+    def fillTop(self, value):
+        return self.fill_bottom - 2 * max(0, min(value, 100))
+        
+    def paintEvent(self, e):
+        # TODO: turn green at 100%?
+        # TODO: maybe add some visual styles like borders or gradients?
+        start = time.perf_counter()
+        self.updateGeometryCache()
+        
+        qp = QPainter()
+        qp.begin(self)
+        top = self.fillTop(self.value)
+        strip = QRect(0, top + 1, self.width(), self.fill_bottom - top)
+        qp.drawPixmap(strip, self.fill, strip)
+        qp.setPen(QColor("#FFB900"))
+        font = QFont()
+        font.setBold(True)
+        qp.setFont(font)
+        qp.drawPolyline(self.outline)
+        qp.drawText(self.text_rect, Qt.AlignCenter, str(self.value) + "%")
+        qp.end()
+        
+        self.paint_time = time.perf_counter() - start
+        latency.tracker.painted("scale")
+        self.paint_time_max = max(self.paint_time_max, self.paint_time)
+        self.paint_time_total += self.paint_time
+        self.paint_count += 1
+        
+    def paintStats(self):
+        average = self.paint_time_total / self.paint_count if self.paint_count else 0
+        return {"count": self.paint_count, "last_ms": self.paint_time * 1000,
+            "average_ms": average * 1000, "max_ms": self.paint_time_max * 1000}
+        
     def setValue(self, value):
+        old_value = self.value
         self.value = value
-        self.repaint()
+        if self.geometry_key is None:
+            self.update()
+            return
+        self.updateGeometryCache()
+        # only repaint the strip between the old and the new fill level and the percentage text
+        top = min(self.fillTop(old_value), self.fillTop(value))
+        bottom = max(self.fillTop(old_value), self.fillTop(value))
+        if top != bottom:
+            self.update(QRect(self.fill_left, top, self.fill_right - self.fill_left + 1, bottom - top + 1))
+        self.update(self.text_rect)
         
     def getSymPoint(self, point, symaxis):
         return QPoint((2 * symaxis - point.x()), point.y())
@@ -180,6 +279,125 @@ class StyledCheckBox(QCheckBox):
     def __init__(self, parent = None):
         super().__init__(parent)
 
+class StyledListWidget(QListWidget):
+
+    # paint_event: latency event type finished by a repaint of this list
+    def __init__(self, paint_event = None, parent = None):
+        super().__init__(parent)
+        self.paint_event = paint_event
+        self.setStyleSheet(LIST_STYLE)
+        
+    def paintEvent(self, e):
+        super().paintEvent(e)
+        if self.paint_event is not None:
+            latency.tracker.painted(self.paint_event)
+
+class StyledListView(QListView):
+
+    # paint_event: latency event type finished by a repaint of this list
+    def __init__(self, paint_event = None, parent = None):
+        super().__init__(parent)
+        self.paint_event = paint_event
+        self.setStyleSheet(LIST_STYLE)
+        # all rows have the same height, so the view only asks the model for the visible ones
+        self.setUniformItemSizes(True)
+        
+    def paintEvent(self, e):
+        super().paintEvent(e)
+        if self.paint_event is not None:
+            latency.tracker.painted(self.paint_event)
+
+# list of cocktail names for the StyledListView, without any per-row objects
+#
+# all recipe names are kept sorted once (order), the visible rows are the subset given to
+# setNames in the same order. a new subset is merged into the current rows, so only the rows
+# that really changed are removed or inserted and the view keeps its position
+class CocktailListModel(QAbstractListModel):
+
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.order = []
+        self.rows = []
+        # rows in search ranking instead of name order, see setRanked
+        self.ranked = False
+        
+    def setOrder(self, names):
+        self.order = sorted(names)
+        
+    def addName(self, name):
+        i = bisect.bisect_left(self.order, name)
+        if i == len(self.order) or self.order[i] != name:
+            self.order.insert(i, name)
+            
+    def removeName(self, name):
+        i = bisect.bisect_left(self.order, name)
+        if i < len(self.order) and self.order[i] == name:
+            del self.order[i]
+        
+    def rowCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+        
+    def data(self, index, role = Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid() and index.row() < len(self.rows):
+            return self.rows[index.row()]
+        return None
+        
+    def name(self, row):
+        return self.rows[row] if 0 <= row < len(self.rows) else None
+        
+    def row(self, name):
+        if self.ranked:
+            return self.rows.index(name) if name in self.rows else -1
+        i = bisect.bisect_left(self.rows, name)
+        return i if i < len(self.rows) and self.rows[i] == name else -1
+        
+    def sortedNames(self, names):
+        if not isinstance(names, (set, frozenset)):
+            names = set(names)
+        # sorting a small subset is cheaper than walking through all names
+        if not self.order or len(names) * math.log2(len(names) + 2) < len(self.order):
+            return sorted(names)
+        return [name for name in self.order if name in names]
+        
+    def setNames(self, names):
+        new = self.sortedNames(names)
+        rows = self.rows
+        if not rows or not new or self.ranked:
+            self.beginResetModel()
+            self.rows = new
+            self.ranked = False
+            self.endResetModel()
+            return
+        i = 0
+        j = 0
+        while i < len(rows) or j < len(new):
+            if j >= len(new) or (i < len(rows) and rows[i] < new[j]):
+                k = i
+                while k < len(rows) and (j >= len(new) or rows[k] < new[j]):
+                    k += 1
+                self.beginRemoveRows(QModelIndex(), i, k - 1)
+                del rows[i:k]
+                self.endRemoveRows()
+            elif i >= len(rows) or new[j] < rows[i]:
+                k = j
+                while k < len(new) and (i >= len(rows) or new[k] < rows[i]):
+                    k += 1
+                self.beginInsertRows(QModelIndex(), i, i + k - j - 1)
+                rows[i:i] = new[j:k]
+                self.endInsertRows()
+                i += k - j
+                j = k
+            else:
+                i += 1
+                j += 1
+                
+    # a short list of search results, shown as ranked
+    def setRanked(self, names):
+        self.beginResetModel()
+        self.rows = list(names)
+        self.ranked = True
+        self.endResetModel()
+
 class StyledStackedWidget(QStackedWidget):
 
     def __init__(self, parent = None):
@@ -290,6 +508,10 @@ class ModeMenu(QWidget):
 
     stop_clicked = pyqtSignal()
     select_cocktail_clicked = pyqtSignal()
+    select_ingredients_clicked = pyqtSignal()
+    recent_cocktails_clicked = pyqtSignal()
+    random_cocktail_clicked = pyqtSignal()
+    random_ingredients_clicked = pyqtSignal()
 
     def __init__(self, parent = None):
         super().__init__(parent)
@@ -334,10 +556,15 @@ class ModeMenu(QWidget):
         
         self.header.emg.pressed.connect(self.stop_clicked)
         self.choice1.pressed.connect(self.select_cocktail_clicked)
+        self.choice2.pressed.connect(self.select_ingredients_clicked)
+        self.choice3.pressed.connect(self.recent_cocktails_clicked)
+        self.choice5.pressed.connect(self.random_cocktail_clicked)
+        self.choice6.pressed.connect(self.random_ingredients_clicked)
         
 class SelectCocktailMenu(QWidget):
 
     stop_clicked = pyqtSignal()
+    search_changed = pyqtSignal(str)
 
     def __init__(self, parent = None):
         super().__init__(parent)
@@ -345,23 +572,18 @@ class SelectCocktailMenu(QWidget):
         self.layout.setSpacing(8)
         self.layout.setContentsMargins(9, 9, 9, 9)
         self.header = HeaderLayout("SELECT COCKTAIL")
-        self.list = QListWidget(self)
-        self.list.setStyleSheet("""
-            QListWidget {
-                background-color: #000000;
-                color: #FFB900
-            }
-            QListWidget::item:selected {
-                background-color: #FFB900;
-                color: #000000;
-                border-radius: 3px;
-            }
-            QScrollBar {
-                width: 0px;
-                height: 0px;
-            }
-        """)
-        self.list.setSortingEnabled(True)
+        self.model = CocktailListModel(self)
+        self.list = StyledListView("encoder", self)
+        self.list.setModel(self.model)
+        # identifies the names currently in the model, see updateList
+        self.key = None
+        # type-ahead search: the encoder picks letters while searching is set
+        self.searching = False
+        self.query = ""
+        self.search_char = 0
+        self.search = StyledPushButton()
+        self.search.setMaximumHeight(40)
+        self.showQuery()
         
         #self.list.addItem("Apricot Sling")
 
@@ -378,24 +600,144 @@ class SelectCocktailMenu(QWidget):
         
         self.layout.addLayout(self.header, 0, 0, 1, 0)
         self.layout.addWidget(self.list, 1, 0)
+        self.layout.addWidget(self.search, 2, 0)
         
         self.header.emg.pressed.connect(self.stop_clicked)
+        self.search.pressed.connect(self.toggleSearch)
         
-    def updateList(self, cocktails, alcoholic):
-        # TODO: display only cocktails with all ingredients available
-        print("> updating available cocktails")
-        self.list.clear()
-        for p in cocktails["non-alcoholic"]:
-            self.list.addItem(p)
-        if alcoholic:
-            for p in cocktails["alcoholic"]:
-                self.list.addItem(p)
-        self.list.setCurrentRow(0)
+    # key: anything identifying the content of names, the model is left alone if it didn't change
+    # names: the names or a function returning them, only called if key says the list changed
+    def updateList(self, names, current = None, key = None):
+        if key is None or key != self.key:
+            log_gui.info("updating available cocktails")
+            self.model.setNames(names() if callable(names) else names)
+            self.key = key
+        # keep the selection when the list is refreshed
+        row = self.model.row(current) if current is not None else -1
+        self.list.setCurrentIndex(self.model.index(max(row, 0)))
+        
+    def currentCocktail(self):
+        return self.model.name(self.list.currentIndex().row())
                 
     def scrollList(self, counts):
-        print("DEBUG: scrolling list: " + str(counts))
-        self.list.setCurrentRow((self.list.currentRow() - counts) % self.list.count())
+        log_gui.debug("scrolling list: %d", counts)
+        count = self.model.rowCount()
+        if count:
+            self.list.setCurrentIndex(self.model.index((self.list.currentIndex().row() - counts) % count))
+            
+    def showResults(self, names):
+        self.model.setRanked(names)
+        self.key = None
+        self.list.setCurrentIndex(self.model.index(0))
+            
+    def showQuery(self):
+        if self.searching:
+            self.search.setText(self.query + "[" + SEARCH_CHARS[self.search_char] + "]")
+        else:
+            self.search.setText("SEARCH: " + self.query if self.query else "SEARCH")
+            
+    def toggleSearch(self):
+        if self.searching:
+            self.stopSearch()
+        else:
+            self.startSearch()
+            
+    def startSearch(self):
+        self.searching = True
+        self.search.setCheckable(True)
+        self.search.setChecked(True)
+        self.showQuery()
+        
+    def stopSearch(self):
+        self.searching = False
+        self.search.setChecked(False)
+        self.search.setCheckable(False)
+        self.showQuery()
+        
+    def resetSearch(self):
+        self.query = ""
+        self.search_char = 0
+        self.stopSearch()
+        
+    def scrollSearch(self, counts):
+        self.search_char = (self.search_char - counts) % len(SEARCH_CHARS)
+        self.showQuery()
+        
+    def pickSearchChar(self):
+        char = SEARCH_CHARS[self.search_char]
+        if char == "OK":
+            self.stopSearch()
+            return
+        self.query = self.query[:-1] if char == "DEL" else self.query + char
+        self.showQuery()
+        self.search_changed.emit(self.query)
                 
+class SelectIngredientsMenu(QWidget):
+
+    stop_clicked = pyqtSignal()
+    show_clicked = pyqtSignal()
+    filter_changed = pyqtSignal(list, list)
+
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.layout = QGridLayout(self)
+        self.layout.setSpacing(8)
+        self.layout.setContentsMargins(9, 9, 9, 9)
+        self.header = HeaderLayout("SELECT INGREDIENTS")
+        self.list = StyledListWidget("encoder", self)
+        self.list.setSortingEnabled(True)
+        self.result = StyledLabel()
+        self.result.setAlignment(Qt.AlignCenter)
+        self.show_button = StyledPushButton()
+        self.show_button.setText("SHOW COCKTAILS")
+        
+        self.layout.addLayout(self.header, 0, 0, 1, 0)
+        self.layout.addWidget(self.list, 1, 0)
+        self.layout.addWidget(self.result, 2, 0)
+        self.layout.addWidget(self.show_button, 3, 0)
+        
+        # tapping an ingredient cycles through: don't care -> must contain -> must not contain
+        self.list.itemClicked.connect(self.toggleItem)
+        self.show_button.pressed.connect(self.show_clicked)
+        self.header.emg.pressed.connect(self.stop_clicked)
+        
+    def updateList(self, ingredients):
+        self.list.clear()
+        for p in ingredients:
+            item = QListWidgetItem(p)
+            item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+            item.setCheckState(Qt.Unchecked)
+            self.list.addItem(item)
+        self.list.setCurrentRow(0)
+        self.filter_changed.emit([], [])
+        
+    def scrollList(self, counts):
+        if self.list.count():
+            self.list.setCurrentRow((self.list.currentRow() - counts) % self.list.count())
+            
+    def toggleCurrent(self):
+        if self.list.currentItem() is not None:
+            self.toggleItem(self.list.currentItem())
+            
+    def toggleItem(self, item):
+        next_state = {Qt.Unchecked: Qt.Checked, Qt.Checked: Qt.PartiallyChecked, Qt.PartiallyChecked: Qt.Unchecked}
+        item.setCheckState(next_state[item.checkState()])
+        self.filter_changed.emit(*self.selection())
+        
+    def selection(self):
+        include = []
+        exclude = []
+        for row in range(self.list.count()):
+            item = self.list.item(row)
+            if item.checkState() == Qt.Checked:
+                include.append(item.text())
+            elif item.checkState() == Qt.PartiallyChecked:
+                exclude.append(item.text())
+        return include, exclude
+        
+    def setResultCount(self, count):
+        self.result.setText(str(count) + " COCKTAILS")
+        
 class SizePriceMenu(QWidget):
     
     stop_clicked = pyqtSignal()
@@ -427,7 +769,7 @@ class SizePriceMenu(QWidget):
         self.group.addButton(self.large)
         self.spacer = QSpacerItem(1, 1, QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.price = StyledLabel()
-        self.price.setText("CHF 6.42")
+        self.setPrice(0)
         self.price.setStyleSheet("""
             StyledLabel {
                 font: bold 40px;
@@ -436,12 +778,15 @@ class SizePriceMenu(QWidget):
         """)
         self.price.setAlignment(Qt.AlignCenter)
         self.glass_label = StyledLabel()
-        self.glass_label.setText("Glass Status:")
         self.glass_label.setAlignment(Qt.AlignCenter)
         # TODO: style the checkbox in StyledCheckBox
+        # only shows what the scale detected
         self.glass = StyledCheckBox()
+        self.glass.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.glass.setFocusPolicy(Qt.NoFocus)
         self.start = StyledPushButton()
         self.start.setText("START")
+        self.setGlass(False)
         
         self.layout.addLayout(self.header, 0, 0, 1, 3)
         self.layout.addWidget(self.shot, 1, 0)
@@ -455,16 +800,25 @@ class SizePriceMenu(QWidget):
         #self.layout.addItem(self.spacer, 6, 0, 1, 3)
         self.layout.addWidget(self.start, 4, 0, 1, 3)
         
-        # TODO: only activate start button after a glass is detected
         self.start.pressed.connect(self.start_clicked)
         self.shot.pressed.connect(lambda: self.size_clicked.emit(20))
         self.medium.pressed.connect(lambda: self.size_clicked.emit(100))
         self.large.pressed.connect(lambda: self.size_clicked.emit(200))
         self.header.emg.pressed.connect(self.stop_clicked)
         
+    def setPrice(self, price):
+        self.price.setText("CHF " + format(price, ".2f"))
+        
+    # START is only enabled with a glass on the scale
+    def setGlass(self, present):
+        self.glass_label.setText("Glass Status:" if present else "Place Glass:")
+        self.glass.setChecked(present)
+        self.start.setEnabled(present)
+        
 class PouringMenu(QWidget):
 
     stop_clicked = pyqtSignal()
+    next_clicked = pyqtSignal()
 
     def __init__(self, parent = None):
         super().__init__(parent)
@@ -476,76 +830,343 @@ class PouringMenu(QWidget):
         
         self.progress = CocktailProgressBar()
         self.progress.setValue(0)
+        self.queue = StyledLabel()
+        self.queue.setAlignment(Qt.AlignCenter)
+        self.next = StyledPushButton()
+        self.next.setText("NEXT ORDER")
         
         self.layout.addLayout(self.header, 0, 0, 1, 3)
         self.layout.addWidget(self.progress, 1, 0, 1, 3)
+        self.layout.addWidget(self.queue, 2, 0, 1, 3)
+        self.layout.addWidget(self.next, 3, 0, 1, 3)
         
         self.header.emg.pressed.connect(self.stop_clicked)
+        self.next.pressed.connect(self.next_clicked)
+        
+    def setQueueStatus(self, depth, throughput):
+        self.queue.setText("QUEUE: " + str(depth) + "   " + str(int(throughput)) + " DRINKS/H")
         
+# a command sent with HardwareInterface.sendCommand, finished(ok, detail) fires once:
+#   (True, "ack")          the device acknowledged it, rtt holds the time until then in s
+#   (False, reason)        never acknowledged or the link was lost
+#   (True, "unconfirmed")  written on a link without ACKs (device didn't negotiate them)
+class PendingCommand(QObject):
+
+    finished = pyqtSignal(bool, str)
+
+    def __init__(self, command, cmd_id, value, parent = None):
+        super().__init__(parent)
+        self.command = command
+        self.cmd_id = cmd_id
+        self.value = value
+        self.ok = None
+        self.detail = None
+        self.rtt = None
+
+    def complete(self, ok, detail, rtt = None):
+        self.ok = ok
+        self.detail = detail
+        self.rtt = rtt
+        self.finished.emit(ok, detail)
+        self.deleteLater()
+
 class HardwareInterface(QObject):
 
     encoder_changed = pyqtSignal(int)
     encoder_clicked = pyqtSignal()
     emergency_stop = pyqtSignal()
     scale_changed = pyqtSignal(int)
+    glass_changed = pyqtSignal(bool)
+    bottle_empty = pyqtSignal(int)
+    bottle_refilled = pyqtSignal(int)
+    pour_finished = pyqtSignal()
+    open_requested = pyqtSignal()
+    close_requested = pyqtSignal()
+    write_requested = pyqtSignal(bytes)
 
-    def __init__(self, parent = None):
+    # capture_file: record the traffic for replay.py, see capture.py
+    def __init__(self, port_name = "COM8", binary = True, display_rate = 30, scale_rate = None, capture_file = None, parent = None):
         super().__init__(parent)
         # TODO: define port at a better location
-        # TODO: check for port opening / writing exceptions
-        self.serial = QSerialPort()
-        self.serial.readyRead.connect(self.serialRead)
-        self.serial.setPortName("COM8")
-        self.serial.open(QIODevice.ReadWrite)
-        self.serial.setBaudRate(115200)
-        self.serial.setDataBits(8)
-        self.serial.setParity(QSerialPort.NoParity)
-        self.serial.setStopBits(1)
-        self.serial.setFlowControl(QSerialPort.NoFlowControl)
-        assert self.serial.error() == QSerialPort.NoError
-
-        self.serial.clear(QSerialPort.Input)
-        
-        #self.serial.write(b"DEBUG: serial write test")
-        #self.serial.flush()
-        
-    def serialRead(self):
-        #print("DEBUG: serial received data: ", (bytes(self.serial.readAll()).decode('utf-8')))
-        while self.serial.canReadLine():
-            print("DEBUG: processing received serial data")
-            self.serialProcess(self.serial.readLine())
-
-    # TODO: implement checksum
-    # TODO: implement ACK/NAK
-    # TODO: implement exceptions to catch invalid command frames
-    def serialProcess(self, serial_data):
-        frame = json.loads(bytes(serial_data).decode('utf-8'))
-        cmd = frame["command"]
-        func = getattr(self, "command_" + cmd)
-        func(frame["id"], frame["value"])
+        # QtSerialPort is only imported once the intro is on screen
+        import serialio
+        capture_writer = None
+        if capture_file is not None:
+            try:
+                capture_writer = CaptureWriter(capture_file)
+                log_serial.info("capturing the traffic of %s to %s", port_name, capture_file)
+            except OSError as e:
+                log_serial.error("can't capture to %s: %s", capture_file, e)
+        # the port is read and decoded in the serial I/O thread, only decoded frames end up here
+        self.worker = serialio.SerialWorker(port_name, capture_writer = capture_writer)
+        self.worker.moveToThread(serialio.ioThread())
+        self.worker.events_ready.connect(self.processEvents)
+        self.worker.opened.connect(self.portOpened)
+        self.open_requested.connect(self.worker.open)
+        self.close_requested.connect(self.worker.close, Qt.BlockingQueuedConnection)
+        self.write_requested.connect(self.worker.write)
+        self.open_requested.emit()
+        
+        self.invalid_frames = 0
+        self.rx_time = None
+        self.scale_rx_time = None
+        
+        # we always start in JSON mode, binary frames are only sent after the device confirmed them
+        self.binary = False
+        if binary:
+            self.negotiateProtocol()
+            
+        # acknowledged commands, only once the device confirmed "set link" (see reliable.py)
+        self.link = None
+        self.link_timer = QTimer(self)
+        self.link_timer.setSingleShot(True)
+        self.link_timer.timeout.connect(self.pollLink)
+        self.negotiateLink()
+        # unconfirmed emergency stop, see emergencyStop
+        self.stop_timer = QTimer(self)
+        self.stop_timer.setInterval(int(reliable.STOP_INTERVAL * 1000))
+        self.stop_timer.timeout.connect(self.resendStop)
+        self.stop_resends = 0
+            
+        # the scale can sample much faster than the screen refreshes, so scale values are
+        # coalesced: the first one goes out immediately, after that only the newest value per
+        # display frame is emitted and the ones in between are counted as dropped
+        self.scale_filter = ScaleFilter()
+        self.scale_value = 0
+        self.scale_pending = False
+        self.scale_window = {"count": 0, "min": None, "max": None}
+        self.scale_stats = {"count": 0, "dropped": 0, "min": None, "max": None}
+        self.scale_samples_total = 0
+        self.scale_dropped_total = 0
+        self.display_timer = QTimer(self)
+        self.display_timer.setSingleShot(True)
+        self.display_timer.timeout.connect(self.flushScale)
+        self.setDisplayRate(display_rate)
+        if scale_rate is not None:
+            self.setScaleRate(scale_rate)
+        
+        #self.write_requested.emit(b"DEBUG: serial write test")
+        
+    def setDisplayRate(self, rate):
+        self.display_timer.setInterval(int(1000 / rate))
+        
+    # sampling rate of the scale on the Arduino, independent from the display rate
+    def setScaleRate(self, rate):
+        return self.sendCommand("set", "scale_rate", int(rate))
+        
+    def updateScale(self, value):
+        self.scale_samples_total += 1
+        window = self.scale_window
+        window["count"] += 1
+        window["min"] = value if window["min"] is None else min(window["min"], value)
+        window["max"] = value if window["max"] is None else max(window["max"], value)
+        # every sample goes through the filter, only the coalesced filtered weight is shown
+        events = self.scale_filter.update(value, self.rx_time)
+        self.scale_value = int(round(self.scale_filter.weight))
+        self.scale_rx_time = self.rx_time
+        if self.display_timer.isActive():
+            self.scale_pending = True
+        else:
+            self.flushScale(True)
+        for event in events:
+            log_hardware.debug("scale %s at %.1fg", event, self.scale_filter.weight)
+            if event in ("glass_placed", "glass_removed"):
+                self.glass_changed.emit(event == "glass_placed")
+            
+    def flushScale(self, force = False):
+        if not (force or self.scale_pending):
+            return
+        self.scale_pending = False
+        window = self.scale_window
+        self.scale_stats = {"count": window["count"], "dropped": window["count"] - 1, "min": window["min"], "max": window["max"]}
+        self.scale_dropped_total += window["count"] - 1
+        self.scale_window = {"count": 0, "min": None, "max": None}
+        self.display_timer.start()
+        self.scale_changed.emit(self.scale_value)
+        latency.tracker.stage("scale", "emit", self.scale_rx_time)
+        latency.tracker.arm("scale", self.scale_rx_time)
+        
+    def negotiateProtocol(self, timeout = 500):
+        log_serial.info("requesting binary serial protocol")
+        self.send("set", "protocol", "binary")
+        QTimer.singleShot(timeout, self.negotiationTimeout)
+        
+    def negotiationTimeout(self):
+        if not self.binary:
+            log_serial.warning("no binary protocol support, falling back to JSON")
+            
+    def send(self, command, cmd_id, value = None):
+        self.write_requested.emit(protocol.encode_frame(command, cmd_id, value, self.binary))
+        
+    def negotiateLink(self, window = reliable.WINDOW):
+        log_serial.info("requesting acknowledged commands, window %d", window)
+        self.send("set", "link", window)
+        
+    # send a command that the device has to acknowledge, returns a PendingCommand
+    def sendCommand(self, command, cmd_id, value = None):
+        pending = PendingCommand(command, cmd_id, value, self)
+        if self.link is None:
+            self.send(command, cmd_id, value)
+            # after returning, so the caller can connect to finished first
+            QTimer.singleShot(0, lambda: pending.complete(True, "unconfirmed"))
+            return pending
+        self.link.submit(command, cmd_id, value, pending.complete)
+        self.pollLink()
+        return pending
+        
+    # close the valves: out of band, without a sequence number, so neither a gap in the
+    # command window nor a broken link holds it up, and resent until the device confirms it.
+    # the commands still in the window are dropped, a pour_start behind the stop must not
+    # start anything, and the device gets a fresh link
+    def emergencyStop(self):
+        log_serial.warning("sending emergency stop")
+        self.send("set", "emergency_stop", 1)
+        self.stop_resends = 0
+        self.stop_timer.start()
+        link = self.link
+        if link is not None:
+            # gone before the failed commands call back, they may stop again
+            self.link = None
+            link.reset("emergency stop")
+            self.negotiateLink()
+            
+    def resendStop(self):
+        if self.stop_resends >= reliable.MAX_STOP_RESENDS:
+            log_serial.error("emergency stop not confirmed after %d resends", self.stop_resends)
+            self.stop_timer.stop()
+            return
+        self.stop_resends += 1
+        self.send("set", "emergency_stop", 1)
+        
+    # failed commands call back from within poll(), ack() and nak(), a callback that stops
+    # the pour replaces self.link, so everything after them checks it is still the same link
+    def pollLink(self):
+        link = self.link
+        if link is None:
+            return
+        now = time.perf_counter()
+        for frame in link.poll(now, self.binary):
+            self.write_requested.emit(frame)
+        if self.link is not link:
+            return
+        if link.broken:
+            log_serial.error("command link lost, negotiating again")
+            self.link = None
+            self.negotiateLink()
+            return
+        deadline = link.nextDeadline()
+        if deadline is not None:
+            self.link_timer.start(max(int((deadline - now) * 1000) + 1, 0))
+        
+    def portOpened(self, ok, error):
+        if ok:
+            log_serial.info("serial port %s opened", self.worker.port_name)
+        else:
+            log_serial.error("could not open serial port %s: %s", self.worker.port_name, error)
+            
+    def close(self):
+        self.stop_timer.stop()
+        if self.link is not None:
+            self.link.reset("port closed")
+        self.close_requested.emit()
         
+    def linkStats(self):
+        stats = self.worker.stats()
+        stats["invalid_frames"] += self.invalid_frames
+        stats["commands"] = self.link.stats() if self.link is not None else None
+        return stats
+        
+    # frames decoded by the I/O thread
+    def processEvents(self):
+        for cmd, cmd_id, value, rx_time, parse_time in self.worker.takeEvents():
+            latency.tracker.record(cmd_id + ".parse", parse_time - rx_time)
+            latency.tracker.stage(cmd_id, "handoff", rx_time)
+            self.dispatch(cmd, cmd_id, value, rx_time)
+
+    # decode and handle a raw frame on the calling thread, for captured or synthetic traffic
+    def serialProcess(self, serial_data, rx_time = None):
+        # time the bytes were read, all latency measurements start here
+        rx_time = time.perf_counter() if rx_time is None else rx_time
+        try:
+            cmd, cmd_id, value = protocol.decode_frame(serial_data)
+        except protocol.FrameError as e:
+            self.invalid_frames += 1
+            log_serial.warning("dropping invalid frame: %s", e)
+            return
+        latency.tracker.stage(cmd_id, "parse", rx_time)
+        self.dispatch(cmd, cmd_id, value, rx_time)
+        
+    def dispatch(self, cmd, cmd_id, value, rx_time):
+        func = getattr(self, "command_" + cmd, None)
+        if func is None:
+            self.invalid_frames += 1
+            log_serial.warning("dropping frame with unknown command: %s", cmd)
+            return
+        self.rx_time = rx_time
+        func(cmd_id, value)
+        
+    # the values were converted while decoding, see protocol.VALUE_TYPES
     def command_update(self, cmd_id, value):
-        print("DEBUG: received: update " + cmd_id + " " + value)
+        log_serial.debug("received: update %s %s", cmd_id, value)
         if cmd_id == "encoder":
-            # TODO: check if really a number
-            self.encoder_changed.emit(int(value))
+            self.encoder_changed.emit(value)
+            latency.tracker.stage("encoder", "emit", self.rx_time)
+            latency.tracker.arm("encoder", self.rx_time)
         elif cmd_id == "encoder_button":
             # TODO: implement latching encoder button (check value)
             self.encoder_clicked.emit()
         elif cmd_id == "scale":
-            # TODO: check if really a number
-            self.scale_changed.emit(int(value))
+            self.updateScale(value)
         elif cmd_id == "emergency_stop":
             # TODO: implement latching emergency stop (check value)
             self.emergency_stop.emit()
+        elif cmd_id == "bottle_empty":
+            # value is the slot number of the empty bottle
+            self.bottle_empty.emit(value)
+        elif cmd_id == "bottle_refilled":
+            # value is the slot number, e.g. from a level switch
+            self.bottle_refilled.emit(value)
         elif cmd_id == "coin_counter":
             pass
         elif cmd_id == "key_switch":
             pass
         
     def command_finished(self, cmd_id, value):
-        print("DEBUG: received: finished " + cmd_id + " " + value)
+        log_serial.debug("received: finished %s %s", cmd_id, value)
+        if cmd_id == "protocol":
+            self.binary = value == "binary"
+            log_serial.info("serial protocol: %s", value)
+        elif cmd_id == "link":
+            # the device starts expecting sequence number 0 again
+            old = self.link
+            self.link = reliable.ReliableSender(min(value, reliable.WINDOW))
+            log_serial.info("acknowledged commands, window %d", self.link.window)
+            if old is not None:
+                old.reset("link negotiated again")
+        elif cmd_id == "emergency_stop":
+            if self.stop_timer.isActive():
+                log_serial.info("emergency stop confirmed after %d resends", self.stop_resends)
+                self.stop_timer.stop()
+        elif cmd_id == "pour_start":
+            self.pour_finished.emit()
         
+    def command_ack(self, cmd_id, value):
+        link = self.link
+        if link is not None:
+            link.ack(value, self.rx_time)
+            if self.link is link:
+                self.pollLink()
+            
+    def command_nak(self, cmd_id, value):
+        link = self.link
+        if link is not None:
+            frame = link.nak(value, time.perf_counter(), self.binary)
+            if self.link is not link:
+                return
+            if frame is not None:
+                self.write_requested.emit(frame)
+            self.pollLink()
+            
     def command_get(self, cmd_id, value):
         pass
         
@@ -555,116 +1176,497 @@ class HardwareInterface(QObject):
     def command_pour(self, cmd_id, value):
         pass
         
+    # send all steps of a PourSchedule, the Arduino starts pouring after "pour_start"
+    # the steps are pipelined in the window, returns the PendingCommand of pour_start
+    def sendSchedule(self, schedule):
+        for step in schedule.steps:
+            self.sendCommand("pour", "pour_step", step.frameValue())
+        return self.sendCommand("pour", "pour_start", len(schedule.steps))
+        
+# one mixer: its screen, hardware, slots and orders
+# several Controllers can run in one process, they share a MixerData and the serial I/O thread
 class Controller():
     
-    def __init__(self):
-        print("> starting controller...")
+    # all menus besides the intro, built on demand or in idle time after the intro is shown
+    MENUS = ("alcohol_menu", "mode_menu", "select_cocktail_menu", "select_ingredients_menu", "size_price_menu", "pouring_menu")
+    
+    # shared: MixerData of all mixers, a Controller on its own loads its own
+    # name: identifies the mixer next to others, also in the file name of its flow model
+    # capture_file: record the serial traffic, see capture.py
+    # state_dir: directory for the pour history, flow model, latency snapshot and emergency
+    # dumps instead of data/ and logs/, e.g. so replay.py leaves the real ones alone
+    def __init__(self, port_name = "COM8", shared = None, machine_file = "data/machine.json", name = None, capture_file = None, state_dir = None):
+        log_controller.info("starting controller %s...", name or "")
+        self.port_name = port_name
+        self.name = name or "mixer"
+        self.machine_file = machine_file
+        self.capture_file = capture_file
+        self.flow_file = flowmodel.MODEL_FILE if name is None else "data/flow_model-" + name + ".json"
+        self.latency_file = latency.SNAPSHOT_FILE
+        self.dump_dir = "logs"
+        history_file = HISTORY_FILE
+        if state_dir is not None:
+            self.flow_file = os.path.join(state_dir, os.path.basename(self.flow_file))
+            self.latency_file = os.path.join(state_dir, os.path.basename(self.latency_file))
+            self.dump_dir = state_dir
+            history_file = os.path.join(state_dir, os.path.basename(history_file))
+        self.owns_shared = shared is None
+        self.shared = MixerData(history_file = history_file) if shared is None else shared
+        # orderserver.OrderServer, set by main when the order API is enabled
+        self.order_server = None
+        self.startup_start = time.perf_counter()
+        self.startup_times = {}
+        self.startup_complete = False
+        self.loaded = False
+        self.menus = {}
+        # glass changeover between two orders: None (glass ready), "remove" or "place"
+        self.glass_state = None
+        self.glass_present = False
+        # filtered scale weight in g, the one at the start of a pour is the tare for the progress
+        self.scale = 0
+        self.tare = 0
+        self.pour_order = None
+        self.pour_samples = []
+        # (key, names) the search picks from, see search_allowed
+        self.search_cache = (None, None)
         
-        print(">  - loading cocktail databases")
-        # TODO: implement error handling and maybe close the file in the end?
-        with open("data/cocktails.json") as cocktail_json_file:
-            self.cocktail_data = json.load(cocktail_json_file)
-            
-        with open("data/ingredients.json") as ingredients_json_file:
-            self.ingredients_data = json.load(ingredients_json_file)
-            
-        print(">  - connecting to hardware")
-        self.hardware_interface = HardwareInterface()
-            
-        print(">  - loading GUI elements")
-        # define the menus and window
+        # show the intro as early as possible, everything else follows from the event loop
+        log_controller.info(" - loading intro")
         self.intro_menu = IntroMenu()
-        self.alcohol_menu = AlcoholMenu()
-        self.mode_menu = ModeMenu()
-        self.select_cocktail_menu = SelectCocktailMenu()
-        self.size_price_menu = SizePriceMenu()
-        self.pouring_menu = PouringMenu()
         self.main_window = StyledStackedWidget()
-        
-        # add the menus to the window
         self.main_window.addWidget(self.intro_menu)
-        self.main_window.addWidget(self.alcohol_menu)
-        self.main_window.addWidget(self.mode_menu)
-        self.main_window.addWidget(self.select_cocktail_menu)
-        self.main_window.addWidget(self.size_price_menu)
-        self.main_window.addWidget(self.pouring_menu)
-        
-        # connect the UI slots
-        self.alcohol_menu.stop_clicked.connect(self.goto_intro)
-        self.mode_menu.stop_clicked.connect(self.goto_intro)
-        self.select_cocktail_menu.stop_clicked.connect(self.goto_intro)
-        self.size_price_menu.stop_clicked.connect(self.goto_intro)
-        self.pouring_menu.stop_clicked.connect(self.goto_intro)
         self.intro_menu.start_clicked.connect(self.goto_alcohol)
-        self.alcohol_menu.drink_clicked.connect(self.goto_mode)
-        self.mode_menu.select_cocktail_clicked.connect(self.goto_select_cocktail)
-        self.size_price_menu.start_clicked.connect(self.goto_pouring_menu)
-        self.size_price_menu.size_clicked.connect(self.handle_size_buttons)
+        log_gui.info("enter intro menu")
+        self.main_window.setCurrentWidget(self.intro_menu)
+        self.main_window.show()
+        self.startup_phase("intro")
+        QTimer.singleShot(0, self.load)
+        
+    def close(self):
+        if self.loaded:
+            self.hardware_interface.close()
+            self.shared.unregister(self.name)
+            if self.owns_shared:
+                self.latency_timer.stop()
+                self.write_latency_snapshot()
+                import serialio
+                serialio.stopIoThread()
+                self.shared.close()
+                
+    def write_latency_snapshot(self):
+        try:
+            latency.tracker.writeSnapshot(self.latency_file)
+        except OSError as e:
+            log_controller.error("can't write the latency snapshot: %s", e)
+            
+    @property
+    def recipes(self):
+        return self.shared.recipes
+        
+    @property
+    def ingredients_data(self):
+        return self.shared.ingredients_data
+        
+    @property
+    def price_table(self):
+        return self.shared.price_table
+        
+    @property
+    def search_index(self):
+        return self.shared.search_index
+        
+    @property
+    def history(self):
+        return self.shared.history
+            
+    def startup_phase(self, name):
+        now = time.perf_counter()
+        self.startup_times[name] = now - self.startup_start - sum(self.startup_times.values())
+        
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        log_controller.info(" - loading cocktail databases")
+        # only the first mixer really loads them
+        self.shared.load()
+        self.shared.recipes_changed.connect(self.apply_recipe_changes)
+        self.shared.ingredients_changed.connect(self.apply_ingredient_changes)
+        self.startup_phase("databases")
+            
+        with open(self.machine_file) as machine_json_file:
+            self.machine_data = json.load(machine_json_file)
+        self.availability = Availability(self.recipes, self.machine_data["slots"])
+        self.shared.register(self.name, self.availability)
+        self.flow_model = FlowModel.load(self.ingredients_data, self.flow_file)
+        self.pour_planner = PourPlanner(self.machine_data, self.availability, self.ingredients_data, self.flow_model)
+        self.orders = OrderQueue(self.price_table, self.pour_planner)
+        # swapped or refilled bottles: saving the machine file applies its slots again
+        self.machine_watcher = DataWatcher([self.machine_file])
+        self.machine_watcher.file_changed.connect(self.reload_machine)
+        self.startup_phase("machine")
+        # follows the availability by itself, prices and pours are passed on
+        self.suggestions = Suggestions(self.recipes, self.availability, self.price_table, self.history)
+        self.startup_phase("suggestions")
+            
+        # the port itself is opened in the serial I/O thread
+        log_controller.info(" - connecting to hardware")
+        self.hardware_interface = HardwareInterface(self.port_name, capture_file = self.capture_file)
         
         # connect the hardware interface command slots
         self.hardware_interface.encoder_changed.connect(self.handle_encoder_changed)
         self.hardware_interface.encoder_clicked.connect(self.handle_encoder_clicked)
-        self.hardware_interface.emergency_stop.connect(self.goto_intro)
-        self.hardware_interface.scale_changed.connect(self.pouring_menu.progress.setValue)
+        self.hardware_interface.emergency_stop.connect(self.stop_pouring)
+        self.hardware_interface.pour_finished.connect(self.handle_pour_finished)
+        self.hardware_interface.scale_changed.connect(self.handle_scale_changed)
+        self.hardware_interface.glass_changed.connect(self.handle_glass_changed)
+        self.hardware_interface.bottle_empty.connect(self.availability.setEmpty)
+        self.hardware_interface.bottle_refilled.connect(lambda slot: self.availability.setEmpty(slot, False))
+        self.startup_phase("hardware")
         
-        print("> controller started")
-        print("> enter intro menu")
-        self.main_window.setCurrentWidget(self.intro_menu)
-        self.main_window.show()
+        # latency histograms for tuning under load, see latency.py, one tracker for all mixers
+        self.latency_timer = QTimer()
+        self.latency_timer.timeout.connect(self.write_latency_snapshot)
+        if self.owns_shared:
+            self.latency_timer.start(latency.SNAPSHOT_INTERVAL * 1000)
+        
+        log_controller.info(" - loading GUI elements")
+        QTimer.singleShot(0, self.build_next_menu)
+        
+    # one menu per event loop iteration, so the intro stays responsive
+    def build_next_menu(self):
+        for name in self.MENUS:
+            if name not in self.menus:
+                self.get_menu(name)
+                QTimer.singleShot(0, self.build_next_menu)
+                return
+        self.startup_phase("menus")
+        self.startup_complete = True
+        log_controller.info("controller started in %.0f ms (%s)", 1000 * sum(self.startup_times.values()),
+            ", ".join(name + " " + str(int(1000 * t)) + " ms" for name, t in self.startup_times.items()))
+        
+    def get_menu(self, name):
+        if name not in self.menus:
+            self.load()
+            menu = getattr(self, "build_" + name)()
+            self.main_window.addWidget(menu)
+            self.menus[name] = menu
+        return self.menus[name]
+        
+    def __getattr__(self, name):
+        # only called for missing attributes: the menus are created on first use
+        if name in Controller.MENUS:
+            return self.get_menu(name)
+        raise AttributeError(name)
+        
+    # the shared data already applied a changed data file, update what belongs to this mixer
+    def apply_ingredient_changes(self, data, affected):
+        self.pour_planner.ingredients_data = data
+        self.flow_model.ingredients_data = data
+        self.suggestions.update(affected)
+        if affected:
+            self.refresh_menus()
+            
+    def apply_recipe_changes(self, changed, removed):
+        for name in removed:
+            self.availability.removeRecipe(name)
+            self.select_cocktail_menu.model.removeName(name)
+        for recipe in changed:
+            self.availability.addRecipe(recipe)
+            self.select_cocktail_menu.model.addName(recipe.name)
+        if changed or removed:
+            self.refresh_menus()
+            
+    # every slot of the file is set again, which also counts its bottle as full
+    def reload_machine(self, filename):
+        try:
+            with open(filename) as machine_json_file:
+                machine_data = json.load(machine_json_file)
+            slots = {slot["slot"]: (slot["ingredient"], slot.get("pump", 0)) for slot in machine_data["slots"]}
+            for ingredient, pump in slots.values():
+                if ingredient is not None and ingredient not in self.ingredients_data:
+                    raise ValueError("unknown ingredient " + repr(ingredient))
+            PourPlanner(machine_data, self.availability, self.ingredients_data)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log_controller.error("rejected changes in %s: %s", filename, e)
+            return
+        for slot in set(self.availability.slots) - set(slots):
+            self.availability.setSlot(slot, None)
+        for slot, (ingredient, pump) in slots.items():
+            self.availability.setSlot(slot, ingredient, pump)
+        self.machine_data = machine_data
+        self.pour_planner = PourPlanner(machine_data, self.availability, self.ingredients_data, self.flow_model)
+        self.orders.pour_planner = self.pour_planner
+        log_controller.info("reloaded %s, %d slots, %d cocktails pourable", filename, len(slots), len(self.availability.pourable))
+        self.refresh_menus()
+        
+    def refresh_menus(self):
+        if self.is_current("select_cocktail_menu"):
+            if self.select_cocktail_menu.query:
+                self.handle_search(self.select_cocktail_menu.query)
+            else:
+                self.show_cocktail_list(self.select_cocktail_menu.currentCocktail())
+        elif self.is_current("select_ingredients_menu"):
+            self.handle_ingredient_filter(*self.ingredient_filter)
+        elif self.is_current("size_price_menu"):
+            if self.cocktail in self.recipes:
+                self.size_price_menu.setPrice(self.price_table.getPrice(self.cocktail, self.size))
+            else:
+                self.goto_select_cocktail()
+                
+    def is_current(self, name):
+        return self.main_window.currentWidget() is self.menus.get(name)
+        
+    def build_alcohol_menu(self):
+        menu = AlcoholMenu()
+        menu.stop_clicked.connect(self.goto_intro)
+        menu.drink_clicked.connect(self.goto_mode)
+        return menu
+        
+    def build_mode_menu(self):
+        menu = ModeMenu()
+        menu.stop_clicked.connect(self.goto_intro)
+        menu.select_cocktail_clicked.connect(self.goto_select_cocktail)
+        menu.select_ingredients_clicked.connect(self.goto_select_ingredients)
+        menu.recent_cocktails_clicked.connect(self.goto_recent_cocktails)
+        menu.random_cocktail_clicked.connect(self.goto_random_cocktail)
+        menu.random_ingredients_clicked.connect(self.goto_random_ingredients)
+        return menu
+        
+    def build_select_cocktail_menu(self):
+        menu = SelectCocktailMenu()
+        menu.model.setOrder(self.recipes.names())
+        menu.stop_clicked.connect(self.goto_intro)
+        menu.search_changed.connect(self.handle_search)
+        return menu
+        
+    def build_select_ingredients_menu(self):
+        menu = SelectIngredientsMenu()
+        menu.stop_clicked.connect(self.goto_intro)
+        menu.filter_changed.connect(self.handle_ingredient_filter)
+        menu.show_clicked.connect(self.goto_select_cocktail_by_ingredients)
+        return menu
+        
+    def build_size_price_menu(self):
+        menu = SizePriceMenu()
+        menu.stop_clicked.connect(self.goto_intro)
+        menu.start_clicked.connect(self.goto_pouring_menu)
+        menu.size_clicked.connect(self.handle_size_buttons)
+        return menu
+        
+    def build_pouring_menu(self):
+        menu = PouringMenu()
+        menu.stop_clicked.connect(self.stop_pouring)
+        menu.next_clicked.connect(self.goto_alcohol)
+        return menu
         
     def handle_encoder_changed(self, counts):
-        if self.main_window.currentWidget() is self.select_cocktail_menu:
-            self.select_cocktail_menu.scrollList(counts)
+        if self.is_current("select_cocktail_menu"):
+            if self.select_cocktail_menu.searching:
+                self.select_cocktail_menu.scrollSearch(counts)
+            else:
+                self.select_cocktail_menu.scrollList(counts)
+        elif self.is_current("select_ingredients_menu"):
+            self.select_ingredients_menu.scrollList(counts)
         
     def handle_encoder_clicked(self):
-        if self.main_window.currentWidget() is self.select_cocktail_menu:
-            self.goto_size_price()
+        if self.is_current("select_cocktail_menu"):
+            if self.select_cocktail_menu.searching:
+                self.select_cocktail_menu.pickSearchChar()
+            else:
+                self.goto_size_price()
+        elif self.is_current("select_ingredients_menu"):
+            self.select_ingredients_menu.toggleCurrent()
+            
+    def handle_ingredient_filter(self, include, exclude):
+        self.ingredient_filter = (include, exclude)
+        self.select_ingredients_menu.setResultCount(len(self.recipes.query(include, exclude, self.alcohol) & self.availability.pourable))
+            
+    def handle_search(self, query):
+        if query:
+            start = time.perf_counter()
+            results = self.search_index.search(query, self.search_allowed())
+            log_gui.debug("search %r: %d results in %.2fms", query, len(results), (time.perf_counter() - start) * 1000)
+            self.select_cocktail_menu.showResults(results)
+        else:
+            self.show_cocktail_list()
+            
+    # the names of the current list as a set, only built again when the list, the alcohol
+    # choice, the availability or the history changed, not on every letter
+    def search_allowed(self):
+        key = (self.cocktail_list, self.alcohol, self.availability.version, self.history.size)
+        if self.search_cache[0] != key:
+            self.search_cache = (key, set(self.cocktail_list()))
+        return self.search_cache[1]
+        
+    # sets of names are shown sorted, lists (recent cocktails) in their order
+    def show_cocktail_list(self, current = None, key = None):
+        names = self.cocktail_list()
+        if isinstance(names, list):
+            self.select_cocktail_menu.showResults(names)
+        else:
+            self.select_cocktail_menu.updateList(names, current, key)
             
     def handle_size_buttons(self, size):
         # TODO: collect this data for the pouring command
         if size == 20:
-            print("DEBUG: shot button pressed")
+            log_gui.debug("shot button pressed")
         elif size == 100:
-            print("DEBUG: medium button pressed")
+            log_gui.debug("medium button pressed")
         elif size == 200:
-            print("DEBUG: large button pressed")
+            log_gui.debug("large button pressed")
         self.size = size
+        self.size_price_menu.setPrice(self.price_table.getPrice(self.cocktail, size))
         
     def start_pouring(self):
-        # TODO: rather use and argument for this function instead of reading directly from the list?
-        cocktail = self.select_cocktail_menu.list.currentItem().text()
-        print("DEBUG: pouring " + cocktail + "...")
+        order = self.orders.start()
+        if order is None:
+            return
+        cocktail = order.cocktail
+        log_controller.info("pouring %s...", cocktail)
         
         # TODO: what if not found at all? should not happen in reality
-        if cocktail in self.cocktail_data["non-alcoholic"]:
-            recipe_volumes = self.cocktail_data["non-alcoholic"][cocktail]
-        else:
-            recipe_volumes = self.cocktail_data["alcoholic"][cocktail]
+        log_controller.debug("recipe in original volumes: %s", self.recipes.get(cocktail).volumes)
+        log_controller.debug("recipe in normalized volumes: %s", self.price_table.getVolumes(cocktail, order.size))
+        log_controller.debug("recipe in normalized masses: %s", order.masses)
+        schedule = order.schedule
+        log_controller.debug("pour schedule: %s", schedule.steps)
+        log_controller.info("expected pouring time %.1fs (sequential %.1fs)", schedule.duration, schedule.sequential_duration)
+        # the previous pour, if its timer didn't run yet
+        self.learn_flow(self.pour_order)
+        # the glass just settled, take the newest filtered weight instead of the last coalesced one
+        self.tare = self.hardware_interface.scale_filter.weight
+        # scale samples of this pour for the flow model, see learn_flow
+        self.pour_order = order
+        self.pour_started = time.perf_counter()
+        self.pour_samples = []
+        self.hardware_interface.sendSchedule(schedule).finished.connect(self.handle_pour_sent)
+        self.pouring_menu.progress.setValue(0)
+        self.publish("started", order)
+        self.update_queue_status()
         
-        # DEBUG
-        #print(self.cocktail_data)
+    def handle_pour_sent(self, ok, detail):
+        if not ok and self.orders.current is not None:
+            log_controller.error("pour schedule not acknowledged: %s", detail)
+            self.stop_pouring()
+            
+    # drop_queue: cancel the waiting orders too and go back to the intro
+    def stop_pouring(self, drop_queue = True):
+        order = self.orders.cancel()
+        if order is not None:
+            # whatever stopped the pour, the valves have to close
+            self.hardware_interface.emergencyStop()
+            log_controller.warning("EMERGENCY STOP, cancelled %s, %d orders %s", order, len(self.orders.pending), "dropped" if drop_queue else "waiting")
+            self.record_pour(order, "cancelled")
+            self.publish("cancelled", order)
+            # what led up to it, only when a pour was really stopped
+            try:
+                log_controller.warning("recent events written to %s", eventlog.dumpRingBuffer(self.dump_dir, "emergency-stop"))
+            except OSError as e:
+                log_controller.error("can't write the recent events: %s", e)
+        if drop_queue:
+            for pending in self.orders.pending:
+                self.publish("cancelled", pending)
+            self.orders.pending.clear()
+        self.update_queue_status()
+        # a stopped pour says nothing about the valves
+        self.pour_order = None
+        if order is not None:
+            # the half poured glass has to go before the next order
+            self.glass_state = "remove" if self.glass_present else "place"
+        elif self.glass_state == "place" and not self.orders.pending:
+            # nothing left to pour into it
+            self.glass_state = None
+        if drop_queue:
+            self.goto_intro()
         
-        print("DEBUG: recipe in original volumes: " + str(recipe_volumes))
-        # FIXME: read correct norm. value from size pressed
-        recipe_normalized_volumes = self.get_normalized_volumes(self.size, recipe_volumes)
-        print("DEBUG: recipe in normalized volumes: " + str(recipe_normalized_volumes))
-        recipe_masses = self.get_masses(recipe_normalized_volumes)
-        print("DEBUG: recipe in normalized masses: " + str(recipe_masses))
-
-        #mylist = [self.cocktail_data[k][cocktail] for k in self.cocktail_data]
-        #print(mylist)
+    def handle_pour_finished(self):
+        order = self.orders.finish()
+        if order is None:
+            return
+        log_controller.info("finished %s, %.1f drinks/h", order, self.orders.throughput())
+        self.record_pour(order, "finished")
+        self.publish("finished", order)
+        # suggested more often now
+        self.suggestions.update([order.cocktail])
+        # the last valve is still running out for a moment
+        QTimer.singleShot(int(flowmodel.MAX_LAG * 1000), lambda order = order: self.learn_flow(order))
+        # the next order starts as soon as the glass is swapped
+        self.glass_state = "remove"
+        self.update_queue_status()
+        
+    def handle_scale_changed(self, value):
+        self.scale = value
+        if self.pour_order is not None:
+            self.pour_samples.append((time.perf_counter() - self.pour_started, value - self.tare))
+        order = self.orders.current
+        if order is not None:
+            total = sum(mass for name, mass in order.masses)
+            percent = int(round(100 * (value - self.tare) / total))
+            self.pouring_menu.progress.setValue(percent)
+            self.publish("progress", order, percent = percent)
+            
+    def handle_glass_changed(self, present):
+        log_controller.info("glass %s", "placed" if present else "removed")
+        self.glass_present = present
+        if "size_price_menu" in self.menus:
+            self.size_price_menu.setGlass(present)
+        if not present and self.orders.current is not None:
+            log_controller.warning("glass removed while pouring")
+            # only this drink is lost, the next order pours into the next glass
+            self.stop_pouring(drop_queue = False)
+        elif self.glass_state == "remove" and not present:
+            self.glass_state = "place"
+        elif self.glass_state == "place" and present:
+            # pour as soon as the new glass settled
+            self.glass_state = None
+            self.start_pouring()
+            
+    def record_pour(self, order, outcome):
+        duration = (order.finished or time.monotonic()) - order.started
+        try:
+            self.history.append(order.cocktail, order.size, order.masses, duration, outcome, None if self.owns_shared else self.name)
+        except OSError as e:
+            log_controller.error("can't write the pour history: %s", e)
+            
+    # order: the finished order the samples belong to, a later pour or a stop already
+    # took its place if it isn't the pour_order anymore
+    def learn_flow(self, order):
+        if order is None or self.pour_order is not order:
+            return
+        self.pour_order = None
+        errors = self.flow_model.learn(order.schedule.steps, self.pour_samples)
+        for ingredient, error in errors.items():
+            stats = self.flow_model.estimates[ingredient].stats()
+            log_controller.info("%s: %+.1fg off target, learned %.1fml/s, lag %.2fs, mean error %.1fg over %d pours", ingredient,
+                error, stats["flow_ml_s"], stats["lag_s"], stats["mean_abs_error_g"], stats["pours"])
+        if errors:
+            try:
+                self.flow_model.save(self.flow_file)
+            except OSError as e:
+                log_controller.error("can't save the flow model: %s", e)
+        
+    def update_queue_status(self):
+        self.pouring_menu.setQueueStatus(self.orders.depth(), self.orders.throughput())
+        if self.order_server is not None:
+            self.order_server.setQueue(self.name, self.orders.depth(), self.orders.throughput())
+            
+    # an event about an order for the clients of the order API
+    def publish(self, event, order, **values):
+        if self.order_server is not None:
+            self.order_server.publish(dict(values, type = event, order = order.id, cocktail = order.cocktail, mixer = self.name))
         
     def get_total_volume(self, volumes):
         volume = 0
         for ingredients in volumes:
             volume += ingredients[1]
-        print("DEBUG: total volume: " + str(volume))
+        log_controller.debug("total volume: %s", volume)
         return volume
         
     def get_normalized_volumes(self, normal_volume, volumes):
         normalized_volumes = []
         normalization_factor = normal_volume / self.get_total_volume(volumes)
-        print("DEBUG: normalization_factor: " + str(round(normalization_factor, 3)))
+        log_controller.debug("normalization_factor: %.3f", normalization_factor)
         for ingredient in volumes:
             name = ingredient[0]
             mass = ingredient[1] * normalization_factor
@@ -684,47 +1686,193 @@ class Controller():
         return masses
         
     def goto_alcohol(self):
-        print("> enter alcohol menu")
+        log_gui.info("enter alcohol menu")
         self.main_window.setCurrentWidget(self.alcohol_menu)
         
     def goto_mode(self, alcohol):   # TODO: add default value = False?
-        print("DEBUG: alcohol: " + str(alcohol))
-        print("> enter mode menu")
+        log_gui.debug("alcohol: %s", alcohol)
+        log_gui.info("enter mode menu")
         self.alcohol = alcohol
         self.main_window.setCurrentWidget(self.mode_menu)
         
     def goto_intro(self):
-        print("> EMERGENCY STOP")
-        print("> enter intro menu")
+        log_controller.info("STOP")
+        log_gui.info("enter intro menu")
         self.main_window.setCurrentWidget(self.intro_menu)
         
     def goto_select_cocktail(self):
         # TODO: do the update directly after the non-alcoholic/all-cocktails selection in AlcoholMenu?
-        # TODO: better way than to copy the whole list over?
-        self.select_cocktail_menu.updateList(self.cocktail_data, self.alcohol)
-        print("> enter select cocktail menu")
+        self.cocktail_list = lambda: self.availability.names(self.alcohol)
+        self.select_cocktail_menu.resetSearch()
+        self.select_cocktail_menu.updateList(self.cocktail_list, key = ("available", self.alcohol, self.availability.version))
+        log_gui.info("enter select cocktail menu")
+        self.main_window.setCurrentWidget(self.select_cocktail_menu)
+        
+    def goto_recent_cocktails(self):
+        self.cocktail_list = lambda: [name for name in self.history.recentCocktails() if name in self.availability.pourable
+            and (self.alcohol or not self.recipes.get(name).alcoholic)]
+        self.select_cocktail_menu.resetSearch()
+        self.show_cocktail_list()
+        log_gui.info("enter recent cocktails menu")
+        self.main_window.setCurrentWidget(self.select_cocktail_menu)
+        
+    def goto_select_ingredients(self):
+        self.select_ingredients_menu.updateList(self.recipes.ingredients())
+        log_gui.info("enter select ingredients menu")
+        self.main_window.setCurrentWidget(self.select_ingredients_menu)
+        
+    def goto_select_cocktail_by_ingredients(self):
+        include, exclude = self.ingredient_filter
+        self.cocktail_list = lambda: self.recipes.query(include, exclude, self.alcohol) & self.availability.pourable
+        self.select_cocktail_menu.resetSearch()
+        self.select_cocktail_menu.updateList(self.cocktail_list,
+            key = ("query", tuple(include), tuple(exclude), self.alcohol, self.availability.version))
+        log_gui.info("enter select cocktail menu")
         self.main_window.setCurrentWidget(self.select_cocktail_menu)
         
+    def goto_random_cocktail(self):
+        cocktail = self.suggestions.cocktail(self.alcohol)
+        log_controller.info("random cocktail: %s", cocktail)
+        if cocktail is not None:
+            self.show_size_price(cocktail)
+            
+    # a random pair of ingredients that at least one cocktail has, shown like a filter of the select ingredients menu
+    def goto_random_ingredients(self):
+        ingredients = self.suggestions.ingredients(self.alcohol)
+        log_controller.info("random ingredients: %s", ingredients)
+        if ingredients is not None:
+            self.ingredient_filter = (ingredients, [])
+            self.goto_select_cocktail_by_ingredients()
+            
     def goto_size_price(self):
-        print("> enter size price menu")
+        cocktail = self.select_cocktail_menu.currentCocktail()
+        if cocktail is not None:
+            self.show_size_price(cocktail)
+            
+    def show_size_price(self, cocktail):
+        log_gui.info("enter size price menu")
+        self.cocktail = cocktail
         # default value 20ml if no size button pressed
         self.size = 20
+        self.size_price_menu.shot.setChecked(True)
+        self.size_price_menu.setPrice(self.price_table.getPrice(self.cocktail, self.size))
+        self.size_price_menu.setGlass(self.glass_present)
         self.main_window.setCurrentWidget(self.size_price_menu)
         
     def goto_pouring_menu(self):
-        print("> enter pouring menu")
+        log_gui.info("enter pouring menu")
         self.main_window.setCurrentWidget(self.pouring_menu)
-        self.start_pouring()
+        self.queue_order(self.cocktail, self.size)
+        
+    # orders can be entered while another one is pouring, they are prepared right away
+    def queue_order(self, cocktail, size):
+        order = self.orders.submit(cocktail, size)
+        log_controller.info("queued %s, queue depth %d", order, self.orders.depth())
+        self.publish("queued", order, size = size, position = self.orders.depth())
+        if self.orders.current is None and self.glass_state is None:
+            if self.glass_present:
+                self.start_pouring()
+            else:
+                self.glass_state = "place"
+        self.update_queue_status()
+        return order
+        
+    # an order from the order API, the screen only follows it if nobody is using it
+    def queue_remote_order(self, cocktail, size):
+        order = self.queue_order(cocktail, size)
+        log_controller.info("remote order %s", order)
+        if self.main_window.currentWidget() is self.intro_menu:
+            self.main_window.setCurrentWidget(self.pouring_menu)
+        return order
+
+# requests of the order API (orderserver.Request), in the GUI thread
+# an order goes to the mixer with the shortest queue of those that can pour it
+def handle_remote_request(controllers, request):
+    controllers = [controller for controller in controllers if controller.loaded]
+    if not controllers:
+        request.reply(503, {"error": "starting"})
+        return
+    shared = controllers[0].shared
+    if request.kind == "cocktails":
+        cocktails = [{"name": name, "alcoholic": shared.recipes.get(name).alcoholic,
+            "prices": {size: shared.price_table.getPrice(name, size) for size in SIZES}} for name in sorted(shared.pourable())]
+        request.reply(200, {"cocktails": cocktails})
+        return
+    cocktail = request.data["cocktail"]
+    size = request.data["size"]
+    if size not in SIZES:
+        request.reply(400, {"error": "sizes: " + ", ".join(str(size) for size in SIZES)})
+        return
+    if shared.recipes.get(cocktail) is None:
+        request.reply(404, {"error": "unknown cocktail"})
+        return
+    mixers = [controller for controller in controllers if cocktail in controller.availability.pourable]
+    if not mixers:
+        request.reply(409, {"error": "can't be poured right now"})
+        return
+    controller = min(mixers, key = lambda controller: controller.orders.depth())
+    order = controller.queue_remote_order(cocktail, size)
+    request.reply(202, {"order": order.id, "cocktail": cocktail, "size": size,
+        "price": shared.price_table.getPrice(cocktail, size), "mixer": controller.name, "position": controller.orders.depth()})
 
+# an order API request, emitted in the server thread and handled in the GUI thread
+class OrderIntake(QObject):
+    
+    request_received = pyqtSignal(object)
+    
+# mixers on the command line: [--http PORT] [--capture] PORT[,MACHINE_FILE] ...
 def main(args):
+    eventlog.setup()
     app = QApplication(args)
     app.setStyle(QStyleFactory.create("Fusion"))
     
-    controller = Controller()
+    http_port = None
+    if "--http" in args:
+        i = args.index("--http")
+        http_port = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
+    # every mixer records its serial traffic to data/captures for replay.py
+    capture = "--capture" in args
+    if capture:
+        args = [arg for arg in args if arg != "--capture"]
+    
+    # serial port of the Arduino, e.g. the pty of headless_emulator.py
+    mixers = [arg.split(",", 1) for arg in args[1:]] or [["COM8"]]
+    if len(mixers) == 1:
+        controllers = [Controller(mixers[0][0], None, *mixers[0][1:], capture_file = captureName() if capture else None)]
+    else:
+        # one screen per mixer, one data cache and one serial I/O thread for all of them
+        shared = MixerData()
+        controllers = [Controller(mixer[0], shared, *mixer[1:], name = "mixer" + str(i + 1),
+            capture_file = captureName("mixer" + str(i + 1)) if capture else None) for i, mixer in enumerate(mixers)]
+        for i, controller in enumerate(controllers):
+            controller.main_window.move(i * controller.main_window.width(), 0)
+    
+    # orders from phones or a POS terminal, see orderserver.py
+    server = None
+    if http_port is not None:
+        from orderserver import OrderServer
+        intake = OrderIntake()
+        intake.request_received.connect(lambda request: handle_remote_request(controllers, request), Qt.QueuedConnection)
+        server = OrderServer(intake.request_received.emit, port = http_port)
+        server.start()
+        log_controller.info("order API on port %d", server.port)
+        for controller in controllers:
+            controller.order_server = server
     
     # TODO close serial port, files, etc?
     # TODO: add raspi shutdown function? or rather seperate script watching a GPIO-pin?
-    sys.exit(app.exec_())
+    result = app.exec_()
+    if server is not None:
+        server.stop()
+    for controller in controllers:
+        controller.close()
+    if len(controllers) > 1:
+        import serialio
+        serialio.stopIoThread()
+        shared.close()
+    eventlog.shutdown()
+    sys.exit(result)
   
 if __name__== "__main__":
     main( sys.argv )
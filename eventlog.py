@@ -0,0 +1,155 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import queue
+import logging
+import logging.handlers
+from collections import deque
+
+# logging for the GUI and serial hot paths
+#
+# every subsystem has its own logger ("cocktailmixer.serial", ...) with its own level, a
+# disabled level costs one cached isEnabledFor() check since all messages use lazy %-formatting.
+# records are handed to a background thread over a bounded queue (dropped when full, the GUI
+# thread never waits for the console) and the last records are kept in a ring buffer that
+# can be dumped after an emergency stop
+#
+# the ring buffer keeps what the console shows. with a ring level below that, e.g. "ring=DEBUG",
+# it also keeps the records the console hides, so a dump has the DEBUG details of the last
+# moments: the loggers let those records through and the queue handler applies the console
+# levels. that costs a record per hot path debug call, so it is only for tracking down a
+# problem, the default keeps disabled levels at one isEnabledFor() check
+#
+# levels can be set with COCKTAILMIXER_LOG, e.g. COCKTAILMIXER_LOG="serial=DEBUG,gui=WARNING,ring=DEBUG"
+
+ROOT = "cocktailmixer"
+SUBSYSTEMS = ("serial", "hardware", "gui", "controller", "recipes")
+DEFAULT_LEVEL = logging.INFO
+QUEUE_SIZE = 10000
+RING_SIZE = 1000
+FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+def getLogger(subsystem):
+    return logging.getLogger(ROOT + "." + subsystem)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# the console level per logger name, for records the loggers only pass for the ring buffer
+class LevelFilter(logging.Filter):
+
+    def __init__(self, levels, default):
+        super().__init__()
+        self.levels = levels
+        self.default = default
+
+    def filter(self, record):
+        return record.levelno >= self.levels.get(record.name, self.default)
+
+class RingBufferHandler(logging.Handler):
+
+    def __init__(self, capacity = RING_SIZE):
+        super().__init__()
+        self.records = deque(maxlen = capacity)
+
+    # formatting is postponed until the buffer is dumped
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, stream):
+        formatter = self.formatter or logging.Formatter(FORMAT)
+        for record in list(self.records):
+            stream.write(formatter.format(record) + "\n")
+
+_queue_handler = None
+_ring_handler = None
+_listener = None
+
+def parseLevels(spec):
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            subsystem, level = item.split("=", 1)
+            levels[subsystem.strip()] = level.strip().upper()
+    return levels
+
+# a level name or number, default for unknown names
+def levelNumber(level, default):
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(level)
+    return number if isinstance(number, int) else default
+
+# ring_level: None keeps the console levels, see above
+def setup(levels = None, stream = None, queue_size = QUEUE_SIZE, ring_size = RING_SIZE, ring_level = None):
+    global _queue_handler, _ring_handler, _listener
+    if _listener is not None:
+        return
+    if levels is None:
+        levels = parseLevels(os.environ.get("COCKTAILMIXER_LOG", ""))
+    default = levelNumber(levels.get("all", DEFAULT_LEVEL), DEFAULT_LEVEL)
+    console_levels = {getLogger(subsystem).name: levelNumber(levels.get(subsystem, default), default) for subsystem in SUBSYSTEMS}
+    if ring_level is None and "ring" in levels:
+        ring_level = levelNumber(levels["ring"], None)
+    root = logging.getLogger(ROOT)
+    root.setLevel(default if ring_level is None else min(default, ring_level))
+    root.propagate = False
+    for subsystem in SUBSYSTEMS:
+        logger = getLogger(subsystem)
+        level = console_levels[logger.name]
+        logger.setLevel(level if ring_level is None else min(level, ring_level))
+
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(logging.Formatter(FORMAT))
+    _queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _queue_handler.addFilter(LevelFilter(console_levels, default))
+    _ring_handler = RingBufferHandler(ring_size)
+    root.addHandler(_queue_handler)
+    root.addHandler(_ring_handler)
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, writer)
+    _listener.start()
+
+def shutdown():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def droppedRecords():
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+# write the ring buffer to a file, returns the file name, raises OSError
+def dumpRingBuffer(directory = "logs", prefix = "dump"):
+    if _ring_handler is None:
+        return None
+    os.makedirs(directory, exist_ok = True)
+    filename = os.path.join(directory, prefix + "-" + time.strftime("%Y%m%d-%H%M%S") + ".log")
+    with open(filename, "w") as dump_file:
+        _ring_handler.dump(dump_file)
+    return filename
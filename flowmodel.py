@@ -0,0 +1,237 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import bisect
+
+# learned flow rate and shutoff lag per ingredient, for closing the valves early
+#
+# the Arduino closes a valve as soon as the scale reached the mass of its pour step, but the
+# liquid keeps running for a moment (valve and pump lag), so every ingredient overshoots by
+# about flow * lag. the model learns both from the scale samples of finished pours and the
+# planner sends the target minus the expected overshoot instead of the target itself.
+#
+# steps running alone are measured directly:
+#   delivered  scale increase over the step, until the next step started
+#   flow       slope between 20% and 80% of the delivered mass
+#   lag        (delivered - commanded mass) / flow
+# the scale only sees the sum of parallel steps. their pour is cut into segments at every
+# planned start and end, the increase in a segment is shared among the valves open in it
+# in proportion to their planned rates (mass / duration), and an increase after the last
+# valves closed goes to those valves:
+#   delivered  sum of the shares
+#   flow       shares while the valve was open / time it was open
+# a valve running out while another one is open is counted for the open one, so the lag
+# of parallel steps is less exact than that of steps running alone
+# "python3 flowmodel.py <file>" prints the learned values and the accuracy per ingredient
+
+MODEL_FILE = "data/flow_model.json"
+
+# weight of a new measurement in the running estimates
+LEARNING_RATE = 0.3
+
+# steps delivering less than this (g) are too small to measure a flow
+MIN_MEASURED_MASS = 5
+
+MAX_LAG = 2.0
+
+# never command less than this fraction of the target, in case of a bad estimate
+MIN_COMMAND_FRACTION = 0.25
+
+class FlowEstimate():
+
+    def __init__(self, flow = None, lag = 0, pours = 0, error_sum = 0, abs_error_sum = 0, last_error = 0):
+        # ml/s, None until measured
+        self.flow = flow
+        # s
+        self.lag = lag
+        self.pours = pours
+        self.error_sum = error_sum
+        self.abs_error_sum = abs_error_sum
+        self.last_error = last_error
+
+    def update(self, flow, lag, error):
+        if self.flow is None:
+            self.flow = flow
+            self.lag = lag
+        else:
+            self.flow += LEARNING_RATE * (flow - self.flow)
+            self.lag += LEARNING_RATE * (lag - self.lag)
+        self.pours += 1
+        self.error_sum += error
+        self.abs_error_sum += abs(error)
+        self.last_error = error
+
+    def stats(self):
+        return {"flow_ml_s": self.flow, "lag_s": self.lag, "pours": self.pours,
+            "mean_error_g": self.error_sum / self.pours if self.pours else 0,
+            "mean_abs_error_g": self.abs_error_sum / self.pours if self.pours else 0,
+            "last_error_g": self.last_error}
+
+class FlowModel():
+
+    def __init__(self, ingredients_data):
+        self.ingredients_data = ingredients_data
+        self.estimates = {}
+
+    @classmethod
+    def load(cls, ingredients_data, filename = MODEL_FILE):
+        model = cls(ingredients_data)
+        try:
+            with open(filename) as model_file:
+                data = json.load(model_file)
+        except (OSError, ValueError):
+            return model
+        try:
+            entries = data.get("ingredients", {}).items()
+        except AttributeError:
+            return model
+        for ingredient, values in entries:
+            # written by an older version or by hand, that ingredient is learned again
+            try:
+                model.estimates[ingredient] = FlowEstimate(**values)
+            except TypeError:
+                continue
+        return model
+
+    def save(self, filename = MODEL_FILE):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        data = {ingredient: vars(estimate) for ingredient, estimate in sorted(self.estimates.items())}
+        # write and rename, a crash never leaves a half written model
+        with open(filename + ".tmp", "w") as model_file:
+            json.dump({"time": time.time(), "ingredients": data}, model_file, indent = 1)
+        os.replace(filename + ".tmp", filename)
+
+    def density(self, ingredient):
+        return self.ingredients_data.get(ingredient, {}).get("density", 1)
+
+    # learned flow in ml/s, or default if this ingredient was never measured
+    def flowRate(self, ingredient, default):
+        estimate = self.estimates.get(ingredient)
+        return estimate.flow if estimate is not None and estimate.flow else default
+
+    def lag(self, ingredient):
+        estimate = self.estimates.get(ingredient)
+        return estimate.lag if estimate is not None else 0
+
+    # mass to send to the Arduino so the glass ends up with target after the valve lag
+    def commandedMass(self, ingredient, target):
+        estimate = self.estimates.get(ingredient)
+        if estimate is None or not estimate.flow:
+            return target
+        overshoot = estimate.flow * self.density(ingredient) * estimate.lag
+        return max(target - overshoot, target * MIN_COMMAND_FRACTION)
+
+    # steps: PourSteps of the finished pour, samples: [(seconds since pour start, grams above tare), ...]
+    # returns {ingredient: error in g} of the measured steps
+    def learn(self, steps, samples):
+        errors = {}
+        if not samples:
+            return errors
+        times = [t for t, mass in samples]
+        steps = sorted(steps, key = lambda step: step.start)
+        parallel = []
+        for i, step in enumerate(steps):
+            others = steps[:i] + steps[i + 1:]
+            # another step still running (as planned) or starting together, see learnParallel
+            if any(other.start <= step.start < other.end for other in others):
+                parallel.append(step)
+                continue
+            window_end = min((other.start for other in others if other.start > step.start), default = times[-1])
+            window = [(t, mass) for t, mass in samples if step.start <= t <= window_end]
+            if len(window) < 3:
+                continue
+            base = window[0][1]
+            # the peak, the glass may already be lifted at the end of the last step
+            delivered = max(mass for t, mass in window) - base
+            if delivered < MIN_MEASURED_MASS:
+                continue
+            t20 = next(t for t, mass in window if mass - base >= 0.2 * delivered)
+            t80 = next(t for t, mass in window if mass - base >= 0.8 * delivered)
+            if t80 <= t20:
+                continue
+            flow = 0.6 * delivered / (t80 - t20)
+            lag = min(max((delivered - step.mass) / flow, 0), MAX_LAG)
+            error = delivered - step.target
+            self.estimates.setdefault(step.ingredient, FlowEstimate()).update(flow / self.density(step.ingredient), lag, error)
+            errors[step.ingredient] = error
+        if parallel:
+            errors.update(self.learnParallel(steps, parallel, samples))
+        return errors
+
+    # the steps in measured ran together with others, all steps are needed to share the scale
+    def learnParallel(self, steps, measured, samples):
+        times = [t for t, mass in samples]
+        masses = [mass for t, mass in samples]
+
+        def massAt(t):
+            return masses[max(bisect.bisect_right(times, t) - 1, 0)]
+
+        bounds = sorted(t for t in {step.start for step in steps} | {step.end for step in steps} | {times[-1]} if t <= times[-1])
+        # id(step): [g while open, s open, g in total]
+        shares = {id(step): [0, 0, 0] for step in steps}
+        for start, end in zip(bounds, bounds[1:]):
+            running = [step for step in steps if step.start <= start < step.end]
+            if running:
+                increase = massAt(end) - massAt(start)
+                sharing = running
+            else:
+                # the peak, the glass may already be lifted at the end
+                window = masses[bisect.bisect_left(times, start):bisect.bisect_right(times, end)]
+                increase = max(window, default = massAt(start)) - massAt(start)
+                sharing = [step for step in steps if step.end == start]
+            if not sharing or increase <= 0:
+                continue
+            rates = [step.mass / step.duration if step.duration > 0 else 1 for step in sharing]
+            total = sum(rates)
+            for step, rate in zip(sharing, rates):
+                share = shares[id(step)]
+                mass = increase * rate / total
+                share[2] += mass
+                if running:
+                    share[0] += mass
+                    share[1] += end - start
+        errors = {}
+        for step in measured:
+            open_mass, open_time, delivered = shares[id(step)]
+            if delivered < MIN_MEASURED_MASS or open_time <= 0 or open_mass <= 0:
+                continue
+            flow = open_mass / open_time
+            lag = min(max((delivered - step.mass) / flow, 0), MAX_LAG)
+            error = delivered - step.target
+            self.estimates.setdefault(step.ingredient, FlowEstimate()).update(flow / self.density(step.ingredient), lag, error)
+            errors[step.ingredient] = error
+        return errors
+
+    def stats(self):
+        return {ingredient: estimate.stats() for ingredient, estimate in sorted(self.estimates.items())}
+
+def main(args):
+    filename = args[1] if len(args) > 1 else MODEL_FILE
+    model = FlowModel.load({}, filename)
+    print("%-20s %8s %7s %6s %10s %10s" % ("ingredient", "ml/s", "lag s", "pours", "bias g", "error g"))
+    for ingredient, stats in model.stats().items():
+        print("%-20s %8.2f %7.3f %6d %+10.2f %10.2f" % (ingredient, stats["flow_ml_s"] or 0, stats["lag_s"], stats["pours"],
+            stats["mean_error_g"], stats["mean_abs_error_g"]))
+
+if __name__== "__main__":
+    main( sys.argv )
@@ -0,0 +1,303 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pty
+import sys
+import tty
+import json
+import time
+import random
+import select
+import argparse
+import threading
+
+import protocol
+import reliable
+
+# headless hardware emulator on a pty pair, no Qt and no com0com needed
+#
+# simulates the pumps filling a glass on the scale and sends scale/encoder/e-stop frames at
+# configurable rates, answers the protocol negotiation and pour commands like the Arduino.
+# the controller connects to the printed pty, e.g.:
+#   python3 headless_emulator.py --scale-rate 200 &
+#   python3 cocktailmixer.py /dev/pts/3
+
+class Valve():
+
+    def __init__(self, slot, pump, ingredient, density):
+        self.slot = slot
+        self.pump = pump
+        self.ingredient = ingredient
+        self.density = density
+        self.open = False
+        self.target = 0
+        self.poured = 0
+        self.start = 0
+        self.closed_at = None
+
+class Simulation():
+
+    def __init__(self, machine_data, ingredients_data, noise = 0.3, lag = 0.15, glass_mass = 180, swap_delay = 2):
+        self.flow_rates = {pump["pump"]: pump["flow_rate"] for pump in machine_data["pumps"]}
+        self.valves = {}
+        for slot in machine_data["slots"]:
+            density = ingredients_data.get(slot["ingredient"], {}).get("density", 1)
+            self.valves[slot["slot"]] = Valve(slot["slot"], slot["pump"], slot["ingredient"], density)
+        self.noise = noise
+        self.lag = lag
+        self.glass_mass = glass_mass
+        self.swap_delay = swap_delay
+        self.glass = glass_mass
+        self.liquid = 0
+        self.schedule = []
+        self.pour_start = None
+        self.finished_at = None
+        self.swap_state = None
+
+    def startPour(self, steps, now):
+        self.schedule = steps
+        self.pour_start = now
+        for slot, mass, start in steps:
+            valve = self.valves[slot]
+            valve.target = mass
+            valve.poured = 0
+            valve.start = start
+            valve.closed_at = None
+
+    # advance the physics by dt, returns True when a running pour just finished
+    def step(self, now, dt):
+        if self.pour_start is not None:
+            elapsed = now - self.pour_start
+            pumps = {}
+            for slot, mass, start in self.schedule:
+                valve = self.valves[slot]
+                if valve.closed_at is None and elapsed >= start:
+                    valve.open = True
+                if valve.open:
+                    pumps.setdefault(valve.pump, []).append(valve)
+            # a pump shares its flow between its open valves, flow keeps going for a moment after closing (lag)
+            for pump, valves in pumps.items():
+                flow = self.flow_rates[pump] / len(valves)
+                for valve in valves:
+                    mass = flow * valve.density * dt
+                    valve.poured += mass
+                    self.liquid += mass
+                    if valve.closed_at is None and valve.poured >= valve.target:
+                        valve.closed_at = now
+                    if valve.closed_at is not None and now - valve.closed_at >= self.lag:
+                        valve.open = False
+            if all(self.valves[slot].closed_at is not None and not self.valves[slot].open for slot, mass, start in self.schedule):
+                self.pour_start = None
+                self.finished_at = now
+                self.swap_state = "remove"
+                return True
+        # take the full glass away and put an empty one on the scale
+        if self.swap_state == "remove" and now - self.finished_at >= self.swap_delay:
+            self.glass = 0
+            self.liquid = 0
+            self.swap_state = "place"
+        elif self.swap_state == "place" and now - self.finished_at >= 2 * self.swap_delay:
+            self.glass = self.glass_mass
+            self.swap_state = None
+        return False
+
+    def stop(self):
+        for valve in self.valves.values():
+            valve.open = False
+        self.pour_start = None
+
+    def scale(self):
+        return int(round(self.glass + self.liquid + random.gauss(0, self.noise)))
+
+class HeadlessEmulator():
+
+    def __init__(self, simulation, scale_rate = 50, encoder_rate = 0, estop_interval = 0, baud_rate = 115200, binary = True,
+            acks = True, loss = 0):
+        self.simulation = simulation
+        self.scale_rate = scale_rate
+        self.encoder_rate = encoder_rate
+        self.estop_interval = estop_interval
+        self.baud_rate = baud_rate
+        self.allow_binary = binary
+        self.binary = False
+        self.allow_acks = acks
+        # acknowledges sequenced commands once the controller asked for it with "set link"
+        self.receiver = None
+        # share of the received frames that get lost, to exercise the retransmissions
+        self.loss = loss
+        self.lost_frames = 0
+        self.splitter = protocol.FrameSplitter()
+        self.pending_steps = []
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        # the link only carries baud / 10 bytes per second (8N1)
+        self.link_free = 0
+
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port_name = os.ttyname(slave)
+        self.slave = slave
+
+    # force: never dropped, for answers the controller waits for
+    def send(self, command, cmd_id, value = None, force = False):
+        data = protocol.encode_frame(command, cmd_id, value, self.binary)
+        now = time.monotonic()
+        if self.baud_rate and self.link_free > now + 0.1 and not force:
+            # the link is saturated, drop the frame like a full UART buffer would
+            return False
+        self.link_free = max(self.link_free, now) + len(data) * 10 / self.baud_rate if self.baud_rate else now
+        os.write(self.master, data)
+        self.sent_frames += 1
+        self.sent_bytes += len(data)
+        return True
+
+    def receive(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            return
+        self.splitter.feed(data)
+        for raw in self.splitter.frames():
+            if self.loss and random.random() < self.loss:
+                self.lost_frames += 1
+                continue
+            try:
+                cmd, cmd_id, value, seq = protocol.decode_sequenced(raw)
+            except protocol.FrameError as e:
+                print("> EMU: invalid frame: " + str(e))
+                continue
+            if seq is None or self.receiver is None:
+                self.handle(cmd, cmd_id, value)
+                continue
+            items, answers = self.receiver.receive(seq, (cmd, cmd_id, value))
+            for answer, answer_seq in answers:
+                self.send(answer, "link", answer_seq, force = True)
+            for item in items:
+                self.handle(*item)
+
+    def handle(self, cmd, cmd_id, value):
+        if cmd == "set" and cmd_id == "protocol":
+            mode = value if self.allow_binary else "json"
+            self.send("finished", "protocol", mode)
+            self.binary = mode == "binary"
+            print("> EMU: protocol " + mode)
+        elif cmd == "set" and cmd_id == "link":
+            if self.allow_acks:
+                self.receiver = reliable.ReliableReceiver(min(int(value), reliable.WINDOW))
+                self.send("finished", "link", self.receiver.window, force = True)
+                print("> EMU: acknowledged commands, window " + str(self.receiver.window))
+        elif cmd == "set" and cmd_id == "scale_rate":
+            self.scale_rate = int(value)
+            print("> EMU: scale rate " + str(self.scale_rate) + " Hz")
+        elif cmd == "set" and cmd_id == "emergency_stop":
+            self.simulation.stop()
+            self.pending_steps = []
+            # the controller resends the stop until it sees this
+            self.send("finished", "emergency_stop", 1, force = True)
+            print("> EMU: stopped by the controller")
+        elif cmd == "pour" and cmd_id == "pour_step":
+            slot, decigrams, start_ms = (int(x) for x in str(value).split(":"))
+            self.pending_steps.append((slot, decigrams / 10, start_ms / 1000))
+        elif cmd == "pour" and cmd_id == "pour_start":
+            print("> EMU: pouring " + str(len(self.pending_steps)) + " steps")
+            self.simulation.startPour(self.pending_steps, time.monotonic())
+            self.pending_steps = []
+
+    def run(self, duration = None):
+        print("> EMU: headless emulator on " + self.port_name)
+        sys.stdout.flush()
+        start = last = time.monotonic()
+        next_scale = next_encoder = start
+        next_estop = start + self.estop_interval if self.estop_interval else None
+        next_report = start + 5
+        while duration is None or last - start < duration:
+            now = time.monotonic()
+            deadlines = [now + 0.01, next_report]
+            if self.scale_rate:
+                deadlines.append(next_scale)
+            if self.encoder_rate:
+                deadlines.append(next_encoder)
+            if next_estop is not None:
+                deadlines.append(next_estop)
+            readable, _, _ = select.select([self.master], [], [], max(min(deadlines) - now, 0))
+            if readable:
+                self.receive()
+            now = time.monotonic()
+            if self.simulation.step(now, now - last):
+                self.send("finished", "pour_start", len(self.simulation.schedule))
+                print("> EMU: pour finished")
+            last = now
+            if self.scale_rate and now >= next_scale:
+                self.send("update", "scale", self.simulation.scale())
+                next_scale = max(next_scale + 1 / self.scale_rate, now - 1 / self.scale_rate)
+            if self.encoder_rate and now >= next_encoder:
+                self.send("update", "encoder", random.choice((-1, 1)))
+                next_encoder = max(next_encoder + 1 / self.encoder_rate, now - 1 / self.encoder_rate)
+            if next_estop is not None and now >= next_estop:
+                self.simulation.stop()
+                self.send("update", "emergency_stop", 1)
+                next_estop += self.estop_interval
+            if now >= next_report:
+                elapsed = now - start
+                print("> EMU: " + str(int(self.sent_frames / elapsed)) + " frames/s, "
+                    + str(int(self.sent_bytes / elapsed)) + " bytes/s, " + ("binary" if self.binary else "JSON")
+                + (", " + str(self.lost_frames) + " frames lost" if self.loss else ""))
+                sys.stdout.flush()
+                next_report += 5
+
+def main(args):
+    parser = argparse.ArgumentParser(description = "headless CocktailMixer hardware emulator on a pty")
+    parser.add_argument("--scale-rate", type = float, default = 50, help = "scale frames per second")
+    parser.add_argument("--encoder-rate", type = float, default = 0, help = "encoder ticks per second")
+    parser.add_argument("--estop-interval", type = float, default = 0, help = "seconds between emergency stops, 0 = never")
+    parser.add_argument("--noise", type = float, default = 0.3, help = "scale noise (standard deviation in g)")
+    parser.add_argument("--lag", type = float, default = 0.15, help = "valve shutoff lag in s")
+    parser.add_argument("--flow-scale", type = float, default = 1, help = "factor for the flow rates of machine.json")
+    parser.add_argument("--swap-delay", type = float, default = 2, help = "seconds until a finished glass is swapped")
+    parser.add_argument("--baud", type = int, default = 115200, help = "emulated link speed, 0 = unlimited")
+    parser.add_argument("--json-only", action = "store_true", help = "refuse the binary protocol")
+    parser.add_argument("--no-acks", action = "store_true", help = "refuse acknowledged commands (older firmware)")
+    parser.add_argument("--loss", type = float, default = 0, help = "share of the received frames to lose")
+    parser.add_argument("--duration", type = float, default = None, help = "stop after this many seconds")
+    parser.add_argument("--count", type = int, default = 1, help = "number of mixers, each on its own pty")
+    parser.add_argument("--machine", default = "data/machine.json")
+    parser.add_argument("--ingredients", default = "data/ingredients.json")
+    options = parser.parse_args(args[1:])
+
+    with open(options.machine) as machine_json_file:
+        machine_data = json.load(machine_json_file)
+    with open(options.ingredients) as ingredients_json_file:
+        ingredients_data = json.load(ingredients_json_file)
+    for pump in machine_data["pumps"]:
+        pump["flow_rate"] *= options.flow_scale
+
+    emulators = []
+    for i in range(options.count):
+        simulation = Simulation(machine_data, ingredients_data, options.noise, options.lag, swap_delay = options.swap_delay)
+        emulators.append(HeadlessEmulator(simulation, options.scale_rate, options.encoder_rate, options.estop_interval,
+            options.baud, not options.json_only, not options.no_acks, options.loss))
+    # several mixers for one controller process: "python3 cocktailmixer.py <pty> <pty> ..."
+    for emulator in emulators[1:]:
+        threading.Thread(target = emulator.run, args = (options.duration,), daemon = True).start()
+    try:
+        emulators[0].run(options.duration)
+    except KeyboardInterrupt:
+        pass
+
+if __name__== "__main__":
+    main( sys.argv )
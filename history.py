@@ -0,0 +1,204 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import heapq
+from collections import deque
+
+# append-only log of every pour, one JSON line per pour:
+#   {"time": ..., "cocktail": ..., "size": ml, "masses": [[ingredient, g], ...], "duration": s, "outcome": ...}
+# with several mixers in one process the name of the mixer is added as "mixer"
+#
+# every line is flushed and synced before the pour counts as recorded. a crash can only
+# leave a torn last line, which is cut off when the log is opened again. a complete line
+# that isn't a valid record is skipped and counted in corrupt_lines, the pours after it
+# still count.
+#
+# the queries never read the log: the recent pours, pour counts per cocktail and consumption
+# per ingredient are kept up to date on every append and saved to an index file together
+# with the log size they cover. opening the log loads the index and only reads the lines
+# appended after it was saved.
+# "python3 history.py <file>" prints the statistics, it opens the log read only and
+# changes neither the log nor the index
+
+HISTORY_FILE = "data/history.jsonl"
+
+# pours kept for the recent list
+RECENT_SIZE = 100
+
+# appends between two index saves, at most this many lines are read when opening the log
+INDEX_INTERVAL = 50
+
+OUTCOMES = ("finished", "cancelled")
+
+class PourHistory():
+
+    # read_only: only the statistics, for looking at a log another process may be writing
+    def __init__(self, filename = HISTORY_FILE, read_only = False):
+        self.filename = filename
+        self.read_only = read_only
+        self.index_filename = filename + ".index"
+        self.recent = deque(maxlen = RECENT_SIZE)
+        self.counts = {}
+        self.consumption = {}
+        self.outcomes = {outcome: 0 for outcome in OUTCOMES}
+        # bytes of the log covered by the statistics
+        self.size = 0
+        self.unsaved = 0
+        self.corrupt_lines = 0
+        self.log_file = None
+        self.loadIndex()
+        self.replay()
+        if read_only:
+            return
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.log_file = open(filename, "ab")
+
+    def loadIndex(self):
+        try:
+            with open(self.index_filename) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return
+        try:
+            size, recent, counts = int(index["size"]), list(index["recent"]), dict(index["counts"])
+            consumption, outcomes = dict(index["consumption"]), dict(index["outcomes"])
+        except (KeyError, TypeError, ValueError):
+            # an index of an older version or a broken one, the log is read from the start
+            return
+        # an index newer than the log doesn't belong to it, start from scratch
+        if not os.path.exists(self.filename) or size > os.path.getsize(self.filename):
+            return
+        self.size = size
+        self.recent.extend(recent)
+        self.counts = counts
+        self.consumption = consumption
+        self.outcomes.update(outcomes)
+
+    # read the lines the index doesn't cover yet, skip corrupt ones and cut off a torn last line
+    def replay(self):
+        try:
+            log_file = open(self.filename, "rb")
+        except FileNotFoundError:
+            return
+        with log_file:
+            log_file.seek(self.size)
+            for line in log_file:
+                if not line.endswith(b"\n"):
+                    break
+                self.size += len(line)
+                self.unsaved += 1
+                try:
+                    self.count(json.loads(line.decode("utf-8")))
+                except (ValueError, KeyError, TypeError):
+                    self.corrupt_lines += 1
+        if not self.read_only and os.path.getsize(self.filename) > self.size:
+            with open(self.filename, "r+b") as log_file:
+                log_file.truncate(self.size)
+
+    # raises KeyError, TypeError or ValueError before counting anything if the record is broken
+    def count(self, record):
+        outcome = record["outcome"]
+        cocktail = record["cocktail"]
+        if not isinstance(outcome, str) or not isinstance(cocktail, str):
+            raise TypeError("outcome and cocktail have to be strings")
+        masses = [(str(ingredient), float(mass)) for ingredient, mass in record["masses"]] if outcome == "finished" else []
+        self.recent.append(record)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        if outcome != "finished":
+            return
+        self.counts[cocktail] = self.counts.get(cocktail, 0) + 1
+        for ingredient, mass in masses:
+            self.consumption[ingredient] = self.consumption.get(ingredient, 0) + mass
+
+    def append(self, cocktail, size, masses, duration, outcome, mixer = None):
+        record = {"time": round(time.time(), 3), "cocktail": cocktail, "size": size,
+            "masses": [[ingredient, round(mass, 1)] for ingredient, mass in masses],
+            "duration": round(duration, 2), "outcome": outcome}
+        if mixer is not None:
+            record["mixer"] = mixer
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        self.log_file.write(line)
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        self.size += len(line)
+        self.count(record)
+        self.unsaved += 1
+        if self.unsaved >= INDEX_INTERVAL:
+            self.saveIndex()
+        return record
+
+    def saveIndex(self):
+        index = {"size": self.size, "recent": list(self.recent), "counts": self.counts,
+            "consumption": self.consumption, "outcomes": self.outcomes}
+        # write and rename, a crash leaves the old index which is just replayed further
+        with open(self.index_filename + ".tmp", "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(self.index_filename + ".tmp", self.index_filename)
+        self.unsaved = 0
+
+    def close(self):
+        if self.read_only:
+            return
+        if self.unsaved:
+            self.saveIndex()
+        self.log_file.close()
+
+    # the last n pours, newest first
+    def recentPours(self, n = RECENT_SIZE):
+        return [self.recent[-i] for i in range(1, min(n, len(self.recent)) + 1)]
+
+    # names of the recently finished cocktails, newest first, each only once
+    def recentCocktails(self, n = RECENT_SIZE):
+        names = []
+        for record in reversed(self.recent):
+            if record["outcome"] == "finished" and record["cocktail"] not in names:
+                names.append(record["cocktail"])
+                if len(names) >= n:
+                    break
+        return names
+
+    # [(cocktail, pours), ...] of the k most poured cocktails
+    def topCocktails(self, k = 10):
+        return heapq.nlargest(k, self.counts.items(), key = lambda item: (item[1], item[0]))
+
+    # g of every ingredient in all finished pours
+    def consumed(self, ingredient = None):
+        if ingredient is not None:
+            return self.consumption.get(ingredient, 0)
+        return dict(self.consumption)
+
+def main(args):
+    history = PourHistory(args[1] if len(args) > 1 else HISTORY_FILE, read_only = True)
+    print("pours: " + ", ".join(outcome + " " + str(count) for outcome, count in sorted(history.outcomes.items())))
+    if history.corrupt_lines:
+        print("skipped %d corrupt lines" % history.corrupt_lines)
+    print("\n%-30s %6s" % ("top cocktails", "pours"))
+    for cocktail, count in history.topCocktails(10):
+        print("%-30s %6d" % (cocktail, count))
+    print("\n%-30s %10s" % ("ingredient", "consumed g"))
+    for ingredient, mass in sorted(history.consumed().items(), key = lambda item: -item[1]):
+        print("%-30s %10.1f" % (ingredient, mass))
+    history.close()
+
+if __name__== "__main__":
+    main( sys.argv )
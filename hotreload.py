@@ -0,0 +1,80 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from PyQt5.QtCore import pyqtSignal, QFileSystemWatcher, QObject, QTimer
+
+# watches the data files and reports each changed file once it stopped changing
+#
+# editors often save by writing a new file and renaming it over the old one, which removes
+# the path from the QFileSystemWatcher, so it is added again after every change. the
+# directories are watched as well, a file that is missing at the start (the watcher can't
+# add it) is picked up as soon as it appears. files whose size and modification time
+# didn't change are not reported
+
+# wait this long after the last change before reporting a file
+SETTLE_TIME = 300
+
+class DataWatcher(QObject):
+
+    file_changed = pyqtSignal(str)
+
+    def __init__(self, filenames, parent = None):
+        super().__init__(parent)
+        self.watcher = QFileSystemWatcher(self)
+        self.timers = {}
+        self.stats = {}
+        for filename in filenames:
+            self.stats[filename] = self.stat(filename)
+            timer = QTimer(self)
+            timer.setSingleShot(True)
+            timer.setInterval(SETTLE_TIME)
+            timer.timeout.connect(lambda filename = filename: self.settled(filename))
+            self.timers[filename] = timer
+            if os.path.exists(filename):
+                self.watcher.addPath(filename)
+        self.directories = {os.path.dirname(os.path.abspath(filename)) for filename in filenames}
+        self.watcher.addPaths(sorted(self.directories))
+        self.watcher.fileChanged.connect(self.changed)
+        self.watcher.directoryChanged.connect(self.directoryChanged)
+
+    def stat(self, filename):
+        try:
+            result = os.stat(filename)
+            return (result.st_size, result.st_mtime_ns)
+        except OSError:
+            return None
+
+    def changed(self, filename):
+        if filename in self.timers:
+            self.timers[filename].start()
+
+    # a file in it was created, removed or renamed, settled() sorts out which one changed
+    def directoryChanged(self, directory):
+        for filename, timer in self.timers.items():
+            if os.path.dirname(os.path.abspath(filename)) == directory:
+                timer.start()
+
+    def settled(self, filename):
+        if filename not in self.watcher.files() and os.path.exists(filename):
+            self.watcher.addPath(filename)
+        stat = self.stat(filename)
+        if stat is None or stat == self.stats[filename]:
+            return
+        self.stats[filename] = stat
+        self.file_changed.emit(filename)
@@ -20,6 +20,8 @@ from PyQt5.QtCore import QIODevice, pyqtSignal, Qt
 from PyQt5.QtWidgets import QApplication, QStyleFactory, QWidget, QGridLayout, QSizePolicy, QPushButton, QLabel, QScrollBar
 from PyQt5.QtSerialPort import QSerialPort
 
+import protocol
+
 # bridge COM ports COM8 and COM9 (using com0com), cocktailmixer controller listening on COM8
 
 class Menu(QWidget):
@@ -87,31 +89,68 @@ class Emulator():
         self.serial.setFlowControl(QSerialPort.NoFlowControl)
         assert self.serial.error() == QSerialPort.NoError
         
+        # start in JSON mode until the controller asks for binary frames
+        self.binary = False
+        self.splitter = protocol.FrameSplitter()
+        self.serial.readyRead.connect(self.serialRead)
+        
         menu.encoder_update.connect(self.update_encoder)
         menu.encoder_click.connect(self.click_encoder)
         menu.emergency_stop.connect(self.update_emergency_stop)
         menu.scale_update.connect(self.update_scale)
         
         print("> EMU: emulator ready")
+        
+    def send(self, command, cmd_id, value = None):
+        self.serial.write(protocol.encode_frame(command, cmd_id, value, self.binary))
+        
+    def serialRead(self):
+        self.splitter.feed(bytes(self.serial.readAll()))
+        for raw in self.splitter.frames():
+            try:
+                cmd, cmd_id, value = protocol.decode_frame(raw)
+            except protocol.FrameError as e:
+                print("> EMU: invalid frame: " + str(e))
+                continue
+            print("> EMU: received " + cmd + " " + cmd_id + " " + str(value))
+            if cmd == "set" and cmd_id == "protocol":
+                self.set_protocol(value)
+            elif cmd == "set" and cmd_id == "emergency_stop":
+                # the controller resends the stop until it sees this
+                self.send("finished", "emergency_stop", 1)
+                
+    def set_protocol(self, mode):
+        # the confirmation still goes out in the old mode, everything after it in the new one
+        self.send("finished", "protocol", mode)
+        self.binary = mode == "binary"
+        scale_frame = protocol.encode_frame("update", "scale", 100, self.binary)
+        print("> EMU: protocol " + mode + ", scale frame " + str(len(scale_frame)) + " bytes, max. "
+            + str(int(protocol.link_capacity(len(scale_frame)))) + " scale samples/s")
     
     def update_encoder(self, counts):
         print("> EMU: sending update_encoder")
-        self.serial.write(b'{"command": "update", "id": "encoder", "value": "%d", "checksum": "ABCD"}\n' % counts)
+        self.send("update", "encoder", counts)
         
     def click_encoder(self):
         print("> EMU: sending update_encoder_button")
-        self.serial.write(b'{"command": "update", "id": "encoder_button", "value": "1", "checksum": "ABCD"}\n')
+        self.send("update", "encoder_button", 1)
         
     def update_emergency_stop(self):
         print("> EMU: sending update_emergency_stop")
-        self.serial.write(b'{"command": "update", "id": "emergency_stop", "value": "1", "checksum": "ABCD"}\n')
+        self.send("update", "emergency_stop", 1)
         
     def update_scale(self, value):
         print("> EMU: sending update_scale")
-        self.serial.write(b'{"command": "update", "id": "scale", "value": "%d", "checksum": "ABCD"}\n' % value)
+        self.send("update", "scale", value)
         
 def main(args):
 
+    # no window, simulated pumps and scale on a pty, see headless_emulator.py
+    if "--headless" in args:
+        import headless_emulator
+        headless_emulator.main([arg for arg in args if arg != "--headless"])
+        return
+
     app = QApplication(args)
     
     emulator = Emulator()
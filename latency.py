@@ -0,0 +1,151 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+
+# latency from serial bytes to pixels
+#
+# every stage is measured from the moment the bytes were read in serialRead:
+#   <event>.parse  frame decoded in serialProcess
+#   <event>.emit   Qt signal emitted in command_update (after coalescing for the scale)
+#   <event>.paint  repaint finished in the widget showing the event
+# a paint measurement still waiting after MAX_PENDING is dropped as expired, the widget
+# was hidden and the repaint that finally comes belongs to something else.
+# the histograms are written to a JSON snapshot file every SNAPSHOT_INTERVAL and on exit,
+# "python3 latency.py <file>" prints them
+
+SNAPSHOT_FILE = "logs/latency.json"
+
+# s
+SNAPSHOT_INTERVAL = 60
+MAX_PENDING = 1.0
+
+# bucket i counts latencies below 2^i microseconds, the last one everything above
+BUCKETS = 27
+
+class Histogram():
+
+    def __init__(self):
+        self.counts = [0] * (BUCKETS + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        us = int(seconds * 1e6)
+        self.counts[min(us.bit_length(), BUCKETS)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # upper bucket bound of the given percentile in seconds
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p90_ms": self.percentile(90) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+            "buckets_us": {str(1 << i): n for i, n in enumerate(self.counts) if n},
+        }
+
+class LatencyTracker():
+
+    def __init__(self):
+        self.enabled = True
+        self.histograms = {}
+        self.pending = {}
+        self.expired = 0
+
+    def record(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].record(seconds)
+
+    def stage(self, event, stage, start):
+        if self.enabled and start is not None:
+            self.record(event + "." + stage, time.perf_counter() - start)
+
+    # the next repaint of the widget showing this event type finishes the measurement
+    def arm(self, event, start):
+        if not self.enabled or start is None:
+            return
+        pending = self.pending.get(event)
+        if pending is not None and start - pending > MAX_PENDING:
+            self.expired += 1
+            pending = None
+        if pending is None:
+            self.pending[event] = start
+
+    def painted(self, event):
+        start = self.pending.pop(event, None)
+        if start is None:
+            return
+        seconds = time.perf_counter() - start
+        if seconds > MAX_PENDING:
+            self.expired += 1
+        else:
+            self.record(event + ".paint", seconds)
+
+    def reset(self):
+        self.histograms = {}
+        self.pending = {}
+        self.expired = 0
+
+    def snapshot(self):
+        return {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())}
+
+    def writeSnapshot(self, filename = SNAPSHOT_FILE):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        # write and rename, readers never see a half written file
+        with open(filename + ".tmp", "w") as snapshot_file:
+            json.dump({"time": time.time(), "expired_paints": self.expired, "latency": self.snapshot()}, snapshot_file, indent = 1)
+        os.replace(filename + ".tmp", filename)
+
+# shared by the hardware interface and the widgets
+tracker = LatencyTracker()
+
+def main(args):
+    filename = args[1] if len(args) > 1 else SNAPSHOT_FILE
+    with open(filename) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    print("snapshot from " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["time"])) +
+        ", %d expired paint measurements" % snapshot.get("expired_paints", 0))
+    print("%-24s %8s %9s %9s %9s %9s" % ("event", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for name, h in snapshot["latency"].items():
+        print("%-24s %8d %9.3f %9.3f %9.3f %9.3f" % (name, h["count"], h["p50_ms"], h["p90_ms"], h["p99_ms"], h["max_ms"]))
+
+if __name__== "__main__":
+    main( sys.argv )
@@ -0,0 +1,144 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+import eventlog
+import recipes
+from recipes import RecipeStore
+from pricing import PriceTable
+from search import SearchIndex
+from history import PourHistory, HISTORY_FILE
+from hotreload import DataWatcher
+
+log_controller = eventlog.getLogger("controller")
+
+# the data shared by all mixers driven from one process (one Controller per mixer)
+#
+# recipes, ingredients, prices, the search index and the pour history are loaded once.
+# everything depending on the machine (slots, empty bottles, pour planning, flow model,
+# orders) stays with the Controller of the mixer, which registers its Availability here
+# so the shared inventory knows which mixer can pour what.
+# changed data files are applied here once and then announced to every Controller.
+
+class MixerData(QObject):
+
+    # (changed or new Recipes, removed names)
+    recipes_changed = pyqtSignal(list, list)
+    # (ingredients data, names of the recipes with new prices)
+    ingredients_changed = pyqtSignal(dict, set)
+
+    def __init__(self, cocktails_file = "data/cocktails.json", ingredients_file = "data/ingredients.json", history_file = HISTORY_FILE, parent = None):
+        super().__init__(parent)
+        self.cocktails_file = cocktails_file
+        self.ingredients_file = ingredients_file
+        self.history_file = history_file
+        self.loaded = False
+        # mixer name: Availability
+        self.mixers = {}
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        # data files that failed to load or reload, see loadFile
+        self.rejected = set()
+        self.ingredients_data = self.loadFile(self.ingredients_file, recipes.validateIngredients)
+        self.recipes = RecipeStore(self.loadFile(self.cocktails_file, lambda data: recipes.validate(data, self.ingredients_data)))
+        self.price_table = PriceTable(self.recipes, self.ingredients_data)
+        self.history = PourHistory(self.history_file)
+        if self.history.corrupt_lines:
+            log_controller.warning("skipped %d corrupt lines in %s", self.history.corrupt_lines, self.history.filename)
+        self.search_index = SearchIndex(self.recipes)
+        # recipes and prices can be edited while the machines are running
+        self.data_watcher = DataWatcher([self.cocktails_file, self.ingredients_file])
+        self.data_watcher.file_changed.connect(self.reload)
+
+    # a missing or broken data file is logged and the machine starts without its contents,
+    # the file watcher applies the file as soon as it was fixed. cocktails rejected for
+    # unknown ingredients are applied again once ingredients.json was fixed
+    def loadFile(self, filename, check):
+        try:
+            with open(filename) as json_file:
+                data = json.load(json_file)
+            check(data)
+            return data
+        except (OSError, ValueError) as e:
+            log_controller.error("can't load %s, starting without it: %s", filename, e)
+            self.rejected.add(filename)
+            return {}
+
+    def close(self):
+        if self.loaded:
+            self.history.close()
+
+    def register(self, name, availability):
+        self.mixers[name] = availability
+
+    def unregister(self, name):
+        self.mixers.pop(name, None)
+
+    # names of the mixers that can pour this cocktail right now
+    def mixersFor(self, cocktail):
+        return [name for name, availability in self.mixers.items() if cocktail in availability.pourable]
+
+    # all cocktails at least one mixer can pour
+    def pourable(self):
+        names = set()
+        for availability in self.mixers.values():
+            names |= availability.pourable
+        return names
+
+    # a changed data file is applied recipe by recipe, a running pour keeps its prepared
+    # masses and schedule, files that don't parse or validate are ignored
+    def reload(self, filename):
+        try:
+            with open(filename) as json_file:
+                data = json.load(json_file)
+            if filename == self.ingredients_file:
+                recipes.validateIngredients(data)
+                missing = set(self.recipes.ingredients()) - set(data)
+                if missing:
+                    raise ValueError("ingredients still used by recipes: " + ", ".join(sorted(missing)))
+            else:
+                recipes.validate(data, self.ingredients_data)
+        except (OSError, ValueError) as e:
+            log_controller.error("rejected changes in %s: %s", filename, e)
+            self.rejected.add(filename)
+            return
+        self.rejected.discard(filename)
+        if filename == self.ingredients_file:
+            affected = self.price_table.updateIngredients(data, self.recipes.by_ingredient)
+            self.ingredients_data = data
+            log_controller.info("reloaded %s, %d recipes updated", filename, len(affected))
+            self.ingredients_changed.emit(data, set(affected))
+            if self.cocktails_file in self.rejected:
+                self.reload(self.cocktails_file)
+            return
+        changed, removed = self.recipes.diff(data)
+        for name in removed:
+            self.recipes.remove(name)
+            self.price_table.removeRecipe(name)
+        for recipe in changed:
+            self.recipes.add(recipe)
+            self.price_table.addRecipe(recipe)
+        if changed or removed:
+            self.search_index = SearchIndex(self.recipes)
+        log_controller.info("reloaded %s, %d recipes updated", filename, len(changed) + len(removed))
+        self.recipes_changed.emit(changed, removed)
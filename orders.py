@@ -0,0 +1,96 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import itertools
+from collections import deque
+
+# drinks finished within this window count for the throughput
+THROUGHPUT_WINDOW = 3600
+
+# unique over all mixers of the process, the order API reports them
+_order_ids = itertools.count(1)
+
+class Order():
+
+    def __init__(self, cocktail, size, masses, schedule):
+        self.id = next(_order_ids)
+        self.cocktail = cocktail
+        self.size = size
+        self.masses = masses
+        self.schedule = schedule
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return "Order(" + str(self.id) + ", " + self.cocktail + ", " + str(self.size) + "ml)"
+
+# orders waiting to be poured, everything needed to pour them (masses and pour schedule)
+# is prepared when the order is entered so the next drink can start right away
+class OrderQueue():
+
+    def __init__(self, price_table, pour_planner):
+        self.price_table = price_table
+        self.pour_planner = pour_planner
+        self.pending = deque()
+        self.current = None
+        self.finished_times = deque()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def depth(self):
+        return len(self.pending) + (self.current is not None)
+
+    def submit(self, cocktail, size):
+        masses = self.price_table.getMasses(cocktail, size)
+        order = Order(cocktail, size, masses, self.pour_planner.plan(masses))
+        self.pending.append(order)
+        return order
+
+    def start(self):
+        if self.current is not None or not self.pending:
+            return None
+        self.current = self.pending.popleft()
+        self.current.started = time.monotonic()
+        return self.current
+
+    def finish(self):
+        order = self.current
+        if order is None:
+            return None
+        order.finished = time.monotonic()
+        self.current = None
+        self.finished_times.append(order.finished)
+        return order
+
+    def cancel(self):
+        order = self.current
+        self.current = None
+        return order
+
+    # drinks per hour over the last THROUGHPUT_WINDOW seconds
+    def throughput(self):
+        now = time.monotonic()
+        while self.finished_times and self.finished_times[0] < now - THROUGHPUT_WINDOW:
+            self.finished_times.popleft()
+        if not self.finished_times:
+            return 0
+        # don't extrapolate from the first few seconds of a session
+        elapsed = max(now - self.finished_times[0], 60)
+        return len(self.finished_times) * 3600 / min(elapsed, THROUGHPUT_WINDOW)
@@ -0,0 +1,425 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import json
+import time
+import base64
+import struct
+import asyncio
+import hashlib
+import threading
+from collections import deque
+
+# order intake over the local network (phones, POS terminal), next to the touchscreen
+#
+#   GET  /cocktails   pourable cocktails with their prices
+#   POST /orders      {"cocktail": name, "size": ml} -> 202 {"order": id, ...}
+#   GET  /status      queue depth and counters
+#   GET  /events      WebSocket, JSON events of all orders: queued, started, progress, finished, cancelled
+#
+# the server runs its own asyncio loop in a thread, the Qt event loop is never blocked by a
+# client. requests needing the recipes or the machines are handed to the GUI thread with
+# handler(request), which answers with request.reply(status, body) from there.
+#
+# admission control: with MAX_QUEUE orders waiting over all mixers an order is refused with
+# 503 and Retry-After right here, before it reaches the GUI thread. connections above
+# MAX_CONNECTIONS are refused the same way.
+# backpressure on the event streams: a client only gets the newest progress, older progress
+# events are dropped while its socket is busy. a client falling MAX_CLIENT_EVENTS other
+# events behind is disconnected, it would only slow down the others.
+# "python3 orderserver.py [port]" serves a simulated mixer, e.g. for benchmarks/order_load.py
+
+HOST = "0.0.0.0"
+PORT = 8080
+
+# orders waiting or pouring over all mixers, remote orders above it are refused
+MAX_QUEUE = 10
+
+MAX_CONNECTIONS = 256
+MAX_BODY = 4096
+MAX_HEADERS = 64
+
+# s
+REPLY_TIMEOUT = 2.0
+IDLE_TIMEOUT = 30
+# suggested to a refused client while no drink was finished yet
+DEFAULT_RETRY = 60
+
+MAX_CLIENT_EVENTS = 64
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    409: "Conflict", 500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+# a request for the GUI thread
+#   "order": {"cocktail": name, "size": ml}
+#   "cocktails": {}
+class Request():
+
+    def __init__(self, kind, data, loop, future):
+        self.kind = kind
+        self.data = data
+        self.loop = loop
+        self.future = future
+
+    # from any thread
+    def reply(self, status, body):
+        self.loop.call_soon_threadsafe(self.resolve, status, body)
+
+    def resolve(self, status, body):
+        # the client may have timed out already
+        if not self.future.done():
+            self.future.set_result((status, body))
+
+class EventClient():
+
+    def __init__(self):
+        self.events = deque()
+        # only the newest progress is sent
+        self.progress = None
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    def push(self, event):
+        if event["type"] == "progress":
+            self.progress = event
+        elif len(self.events) >= MAX_CLIENT_EVENTS:
+            self.closed = True
+        else:
+            # keep the order, the progress came before this event
+            if self.progress is not None:
+                self.events.append(self.progress)
+                self.progress = None
+            self.events.append(event)
+        self.ready.set()
+
+    def take(self):
+        events = list(self.events)
+        self.events.clear()
+        if self.progress is not None:
+            events.append(self.progress)
+            self.progress = None
+        self.ready.clear()
+        return events
+
+def websocketFrame(payload, opcode = 1):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+class OrderServer():
+
+    def __init__(self, handler, host = HOST, port = PORT, max_queue = MAX_QUEUE, max_connections = MAX_CONNECTIONS):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_queue = max_queue
+        self.max_connections = max_connections
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+        self.error = None
+        # mixer name: (orders waiting or pouring, drinks per hour), set from the GUI thread
+        self.queues = {}
+        # orders handed to the GUI thread and not answered yet
+        self.waiting = 0
+        self.connections = 0
+        self.clients = set()
+        self.requests = 0
+        self.accepted = 0
+        self.refused = 0
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run, name = "order server", daemon = True)
+        self.thread.start()
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            server = loop.run_until_complete(asyncio.start_server(self.connection, self.host, self.port, backlog = self.max_connections))
+        except OSError as e:
+            self.error = e
+            self.started.set()
+            loop.close()
+            return
+        self.port = server.sockets[0].getsockname()[1]
+        self.loop = loop
+        self.started.set()
+        loop.run_forever()
+        server.close()
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions = True))
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop = None
+
+    # from the GUI thread: the queue of a mixer changed
+    def setQueue(self, mixer, depth, throughput):
+        self.queues[mixer] = (depth, throughput)
+
+    # from the GUI thread: an event for all /events clients
+    def publish(self, event):
+        if self.loop is not None and self.clients:
+            self.loop.call_soon_threadsafe(self.broadcast, event)
+
+    def broadcast(self, event):
+        for client in self.clients:
+            client.push(event)
+
+    def queueDepth(self):
+        return sum(depth for depth, throughput in list(self.queues.values()))
+
+    # s until a slot is probably free again
+    def retryAfter(self):
+        throughput = sum(throughput for depth, throughput in list(self.queues.values()))
+        return max(int(3600 / throughput), 1) if throughput else DEFAULT_RETRY
+
+    def status(self):
+        return {"queue": self.queueDepth(), "max_queue": self.max_queue, "waiting": self.waiting,
+            "mixers": {mixer: depth for mixer, (depth, throughput) in list(self.queues.items())},
+            "connections": self.connections, "event_clients": len(self.clients),
+            "requests": self.requests, "accepted": self.accepted, "refused": self.refused}
+
+    async def connection(self, reader, writer):
+        if self.connections >= self.max_connections:
+            self.refused += 1
+            await self.respond(writer, 503, {"error": "too many connections"}, {"Retry-After": "1"}, False)
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.readRequest(reader), IDLE_TIMEOUT)
+                except ValueError as e:
+                    await self.respond(writer, 400, {"error": str(e)}, {}, False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if path == "/events" and headers.get("upgrade", "").lower() == "websocket":
+                    await self.events(reader, writer, headers)
+                    break
+                status, body, extra_headers = await self.dispatch(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.respond(writer, status, body, extra_headers, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    # (method, path, headers, body), None at the end of the connection
+    async def readRequest(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise ValueError("malformed request line")
+        headers = {}
+        for i in range(MAX_HEADERS + 1):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, separator, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError("too many headers")
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY:
+            raise ValueError("request too large")
+        body = await reader.readexactly(length) if length else b""
+        return parts[0], parts[1], headers, body
+
+    async def respond(self, writer, status, body, extra_headers, keep_alive):
+        data = json.dumps(body).encode("utf-8")
+        head = "HTTP/1.1 " + str(status) + " " + REASONS.get(status, "") + "\r\n"
+        head += "Content-Type: application/json\r\nContent-Length: " + str(len(data)) + "\r\n"
+        for name, value in extra_headers.items():
+            head += name + ": " + value + "\r\n"
+        if not keep_alive:
+            head += "Connection: close\r\n"
+        writer.write(head.encode("latin-1") + b"\r\n" + data)
+        await writer.drain()
+
+    # (status, body, extra headers)
+    async def dispatch(self, method, path, body):
+        self.requests += 1
+        if path == "/status":
+            return 200, self.status(), {}
+        if path == "/cocktails":
+            if method != "GET":
+                return 405, {"error": "use GET"}, {}
+            status, body = await self.ask("cocktails", {})
+            return status, body, {}
+        if path != "/orders":
+            return 404, {"error": "unknown path"}, {}
+        if method != "POST":
+            return 405, {"error": "use POST"}, {}
+        try:
+            data = json.loads(body.decode("utf-8"))
+            cocktail = data["cocktail"]
+            size = data.get("size", 100)
+            if not isinstance(cocktail, str) or not isinstance(size, int):
+                raise ValueError
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 400, {"error": "expected {\"cocktail\": name, \"size\": ml}"}, {}
+        # refused before it reaches the GUI thread, the mixers couldn't pour it anytime soon anyway
+        depth = self.queueDepth()
+        if depth + self.waiting >= self.max_queue:
+            self.refused += 1
+            return 503, {"error": "queue full", "queue": depth}, {"Retry-After": str(self.retryAfter())}
+        self.waiting += 1
+        try:
+            status, body = await self.ask("order", {"cocktail": cocktail, "size": size})
+        finally:
+            self.waiting -= 1
+        if status == 202:
+            self.accepted += 1
+        return status, body, {}
+
+    async def ask(self, kind, data):
+        future = self.loop.create_future()
+        try:
+            self.handler(Request(kind, data, self.loop, future))
+            return await asyncio.wait_for(future, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            return 504, {"error": "no answer from the mixer"}
+        except Exception as e:
+            return 500, {"error": str(e)}
+
+    async def events(self, reader, writer, headers):
+        key = headers.get("sec-websocket-key")
+        if key is None:
+            await self.respond(writer, 400, {"error": "missing Sec-WebSocket-Key"}, {}, False)
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode("latin-1")).digest()).decode("latin-1")
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            "Sec-WebSocket-Accept: " + accept + "\r\n\r\n").encode("latin-1"))
+        client = EventClient()
+        client.push(dict(self.status(), type = "status"))
+        self.clients.add(client)
+        reading = asyncio.ensure_future(self.readFrames(reader, writer, client))
+        try:
+            while not client.closed:
+                await client.ready.wait()
+                for event in client.take():
+                    writer.write(websocketFrame(json.dumps(event).encode("utf-8")))
+                # events arriving meanwhile are coalesced
+                await writer.drain()
+            writer.write(websocketFrame(b"", 8))
+        finally:
+            self.clients.discard(client)
+            reading.cancel()
+
+    # the client only sends pings and the close frame
+    async def readFrames(self, reader, writer, client):
+        try:
+            while True:
+                first, second = await reader.readexactly(2)
+                opcode = first & 0x0F
+                length = second & 0x7F
+                if length == 126:
+                    length, = struct.unpack("!H", await reader.readexactly(2))
+                elif length == 127:
+                    length, = struct.unpack("!Q", await reader.readexactly(8))
+                if length > MAX_BODY:
+                    break
+                mask = await reader.readexactly(4) if second & 0x80 else b"\0\0\0\0"
+                payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(await reader.readexactly(length)))
+                if opcode == 8:
+                    break
+                if opcode == 9:
+                    writer.write(websocketFrame(payload, 10))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            client.closed = True
+            client.ready.set()
+
+# a mixer pouring one drink every drink_time seconds, answers in the server thread
+class SimulatedMixer():
+
+    def __init__(self, server, cocktails, drink_time):
+        self.server = server
+        self.cocktails = cocktails
+        self.drink_time = drink_time
+        self.pending = deque()
+        self.next_id = 1
+
+    def handle(self, request):
+        if request.kind == "cocktails":
+            request.reply(200, {"cocktails": [{"name": name, "prices": {"100": 5.0}} for name in self.cocktails]})
+            return
+        if request.data["cocktail"] not in self.cocktails:
+            request.reply(404, {"error": "unknown cocktail"})
+            return
+        order = self.next_id
+        self.next_id += 1
+        self.pending.append(order)
+        if len(self.pending) == 1:
+            self.server.loop.call_later(self.drink_time, self.finish)
+        self.update()
+        self.server.publish({"type": "queued", "order": order, "cocktail": request.data["cocktail"], "mixer": "simulated"})
+        request.reply(202, {"order": order, "cocktail": request.data["cocktail"], "size": request.data["size"],
+            "mixer": "simulated", "position": len(self.pending)})
+
+    def finish(self):
+        order = self.pending.popleft()
+        self.server.publish({"type": "finished", "order": order, "mixer": "simulated"})
+        if self.pending:
+            self.server.loop.call_later(self.drink_time, self.finish)
+        self.update()
+
+    def update(self):
+        self.server.setQueue("simulated", len(self.pending), 3600 / self.drink_time)
+
+def main(args):
+    server = OrderServer(lambda request: mixer.handle(request), port = int(args[1]) if len(args) > 1 else PORT)
+    mixer = SimulatedMixer(server, ["Cocktail " + str(i) for i in range(100)], 0.1)
+    server.start()
+    print("order server with a simulated mixer on port " + str(server.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+
+if __name__== "__main__":
+    main( sys.argv )
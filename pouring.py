@@ -0,0 +1,135 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+# with several ingredients running at once the scale only sees their sum, so amounts smaller
+# than this many scale steps are poured alone where the scale can measure them exactly
+SOLO_SCALE_STEPS = 20
+
+class PourStep():
+
+    # mass: sent to the Arduino, target minus the expected overshoot (see flowmodel.py)
+    def __init__(self, ingredient, slot, pump, mass, start, duration, target = None):
+        self.ingredient = ingredient
+        self.slot = slot
+        self.pump = pump
+        self.mass = mass
+        self.target = mass if target is None else target
+        self.start = start
+        self.duration = duration
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+    # serial representation: "slot:decigrams:start in ms"
+    def frameValue(self):
+        return str(self.slot) + ":" + str(int(round(self.mass * 10))) + ":" + str(int(round(self.start * 1000)))
+
+    def __repr__(self):
+        return "PourStep(" + self.ingredient + ", slot " + str(self.slot) + ", pump " + str(self.pump) + ", " \
+            + str(round(self.mass, 1)) + "/" + str(round(self.target, 1)) + "g, " + str(round(self.start, 2)) + "s - " + str(round(self.end, 2)) + "s)"
+
+class PourSchedule():
+
+    def __init__(self, steps, sequential_duration):
+        self.steps = steps
+        self.sequential_duration = sequential_duration
+
+    @property
+    def duration(self):
+        return max((step.end for step in self.steps), default = 0)
+
+    @property
+    def speedup(self):
+        return self.sequential_duration / self.duration if self.duration else 1
+
+# builds pour schedules for the machine described in machine.json:
+# every pump runs one valve at a time, up to max_parallel pumps run at the same time
+class PourPlanner():
+
+    # flow_model: learned flow rates and valve lags, the pump flow rates of machine.json without it
+    def __init__(self, machine_data, availability, ingredients_data, flow_model = None):
+        self.availability = availability
+        self.ingredients_data = ingredients_data
+        self.flow_model = flow_model
+        self.flow_rates = {pump["pump"]: pump["flow_rate"] for pump in machine_data["pumps"]}
+        self.max_parallel = machine_data.get("max_parallel", len(self.flow_rates))
+        # no pump at all would never get a step started
+        if isinstance(self.max_parallel, bool) or not isinstance(self.max_parallel, int) or self.max_parallel < 1:
+            raise ValueError("max_parallel has to be at least 1, not " + repr(self.max_parallel))
+        self.valve_delay = machine_data.get("valve_delay", 0)
+        self.solo_mass = machine_data.get("scale_resolution", 1) * SOLO_SCALE_STEPS
+
+    @classmethod
+    def load(cls, filename, availability, ingredients_data, flow_model = None):
+        with open(filename) as machine_json_file:
+            return cls(json.load(machine_json_file), availability, ingredients_data, flow_model)
+
+    def duration(self, ingredient, pump, mass):
+        volume = mass / self.ingredients_data[ingredient]["density"]
+        if self.flow_model is None:
+            return volume / self.flow_rates[pump] + self.valve_delay
+        # the next valve on the scale only opens once the lag of this one ran out
+        flow_rate = self.flow_model.flowRate(ingredient, self.flow_rates[pump])
+        return volume / flow_rate + self.valve_delay + self.flow_model.lag(ingredient)
+
+    # masses as returned by Controller.get_masses: [[ingredient, mass], ...]
+    def plan(self, masses):
+        steps = []
+        for ingredient, mass in masses:
+            slots = self.availability.slotsFor(ingredient)
+            if not slots:
+                raise ValueError("ingredient not available: " + ingredient)
+            slot = min(slots)
+            pump = self.availability.slots[slot][1]
+            commanded = self.flow_model.commandedMass(ingredient, mass) if self.flow_model is not None else mass
+            steps.append(PourStep(ingredient, slot, pump, commanded, 0, self.duration(ingredient, pump, mass), mass))
+        sequential_duration = sum(step.duration for step in steps)
+
+        # small amounts first, one after the other
+        time = 0
+        solo = sorted((step for step in steps if step.target < self.solo_mass), key = lambda step: step.target)
+        for step in solo:
+            step.start = time
+            time += step.duration
+
+        # the rest in parallel, one queue per pump, longest queue first when pumps are limited
+        queues = {}
+        for step in steps:
+            if step.target >= self.solo_mass:
+                queues.setdefault(step.pump, []).append(step)
+        for queue in queues.values():
+            queue.sort(key = lambda step: step.duration, reverse = True)
+        pump_free = {pump: time for pump in queues}
+        running = []
+        while any(queues.values()):
+            ready = sorted((pump for pump in queues if queues[pump] and pump_free[pump] <= time),
+                key = lambda pump: sum(step.duration for step in queues[pump]), reverse = True)
+            running = [end for end in running if end > time]
+            for pump in ready[:max(self.max_parallel - len(running), 0)]:
+                step = queues[pump].pop(0)
+                step.start = time
+                pump_free[pump] = step.end
+                running.append(step.end)
+            # advance to the next moment a pump gets free
+            pending = [pump_free[pump] for pump in queues if queues[pump] and pump_free[pump] > time] + [end for end in running if end > time]
+            if pending:
+                time = min(pending)
+
+        return PourSchedule(sorted(steps, key = lambda step: step.start), sequential_duration)
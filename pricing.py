@@ -0,0 +1,100 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+
+# sizes offered in the SizePriceMenu in ml
+SIZES = (20, 100, 200)
+
+# prices in ingredients.json are per dl
+PRICE_VOLUME = 100
+
+# normalized volumes, target masses and prices of every cocktail at every size
+#
+# every recipe is a dense row of volumes over the ingredient table, the density and price
+# columns are plain arrays, so the whole table is filled in one pass over the rows without
+# any per-size work besides a multiplication. it is only rebuilt when the ingredient data
+# changes, single recipes can be added or removed without touching the others
+class PriceTable():
+
+    def __init__(self, recipes, ingredients_data, sizes = SIZES):
+        self.recipes = recipes
+        self.sizes = tuple(sizes)
+        self.ingredients_data = None
+        self.setIngredients(ingredients_data)
+
+    def setIngredients(self, ingredients_data):
+        if ingredients_data == self.ingredients_data:
+            return False
+        self.ingredients_data = ingredients_data
+        self.columns = {name: i for i, name in enumerate(ingredients_data)}
+        self.densities = array("d", (data["density"] for data in ingredients_data.values()))
+        self.prices = array("d", (data["price"] / PRICE_VOLUME for data in ingredients_data.values()))
+        self.rows = {}
+        self.volumes = {}
+        self.masses = {}
+        self.price = {}
+        for recipe in self.recipes:
+            self.addRecipe(recipe)
+        return True
+
+    # apply changed ingredient data, only the recipes using a changed ingredient are
+    # recalculated unless ingredients were added or removed. returns the recalculated names
+    def updateIngredients(self, ingredients_data, by_ingredient):
+        if list(ingredients_data) != list(self.ingredients_data):
+            self.setIngredients(ingredients_data)
+            return set(self.rows)
+        changed = [name for name in ingredients_data if ingredients_data[name] != self.ingredients_data[name]]
+        self.ingredients_data = ingredients_data
+        affected = set()
+        for name in changed:
+            column = self.columns[name]
+            self.densities[column] = ingredients_data[name]["density"]
+            self.prices[column] = ingredients_data[name]["price"] / PRICE_VOLUME
+            affected |= by_ingredient.get(name, set())
+        for name in affected:
+            self.addRecipe(self.recipes.get(name))
+        return affected
+
+    def addRecipe(self, recipe):
+        row = array("d", bytes(8 * len(self.columns)))
+        for ingredient, volume in recipe.volumes:
+            row[self.columns[ingredient]] += volume
+        total = sum(row)
+        columns = [i for i, volume in enumerate(row) if volume]
+        names = list(self.ingredients_data)
+        # everything scales linearly with the size, so one unit row per recipe is enough
+        unit_volumes = [(names[i], row[i] / total) for i in columns]
+        unit_masses = [(names[i], row[i] / total * self.densities[i]) for i in columns]
+        unit_price = sum(row[i] * self.prices[i] for i in columns) / total
+        self.rows[recipe.name] = row
+        self.volumes[recipe.name] = {size: [[name, volume * size] for name, volume in unit_volumes] for size in self.sizes}
+        self.masses[recipe.name] = {size: [[name, mass * size] for name, mass in unit_masses] for size in self.sizes}
+        self.price[recipe.name] = {size: unit_price * size for size in self.sizes}
+
+    def removeRecipe(self, name):
+        for table in (self.rows, self.volumes, self.masses, self.price):
+            table.pop(name, None)
+
+    def getPrice(self, name, size):
+        return self.price[name][size]
+
+    def getVolumes(self, name, size):
+        return self.volumes[name][size]
+
+    def getMasses(self, name, size):
+        return self.masses[name][size]
@@ -0,0 +1,290 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import math
+import struct
+
+# serial framing shared by the controller (cocktailmixer.py) and the emulator (hw_emulator.py)
+#
+# two frame formats can be mixed on the same link, the first byte tells them apart:
+#   JSON line:    {"command": "update", "id": "scale", "value": "57", "checksum": "ABCD"}\n
+#   binary frame: SYNC | command | id | type | length | payload | CRC16 (big endian)
+# the CRC16-CCITT covers everything between SYNC and the CRC itself
+# the binary mode is negotiated at connect with a JSON "set protocol binary" command,
+# a device answering with "finished protocol binary" switches to binary frames
+#
+# commands that must be acknowledged carry a sequence number (see reliable.py):
+#   JSON line:    {"command": "pour", "id": "pour_start", "value": "3", "seq": 17, "checksum": "ABCD"}\n
+#   binary frame: SYNC_SEQ | seq | command | id | type | length | payload | CRC16
+# the device answers "ack link <seq>" or "nak link <seq>", "set link <window>" enables them
+#
+# the value of an id in VALUE_TYPES is converted while decoding, a frame whose value can't
+# be converted is as invalid as one with a wrong checksum
+
+SYNC = 0xA5
+SYNC_SEQ = 0xA6
+HEADER_SIZE = 5
+SEQ_HEADER_SIZE = 6
+SEQ_MODULO = 256
+CRC_SIZE = 2
+MAX_PAYLOAD = 255
+# longest JSON line, a "{" without a newline within it is noise and gets skipped
+MAX_LINE = 512
+
+COMMANDS = {
+    "update": 1,
+    "finished": 2,
+    "get": 3,
+    "set": 4,
+    "pour": 5,
+    "ack": 6,
+    "nak": 7,
+}
+
+IDS = {
+    "encoder": 1,
+    "encoder_button": 2,
+    "scale": 3,
+    "emergency_stop": 4,
+    "coin_counter": 5,
+    "key_switch": 6,
+    "protocol": 7,
+    "scale_rate": 8,
+    "bottle_empty": 9,
+    "pour_step": 10,
+    "pour_start": 11,
+    "link": 12,
+    "bottle_refilled": 13,
+}
+
+COMMAND_NAMES = {v: k for k, v in COMMANDS.items()}
+ID_NAMES = {v: k for k, v in IDS.items()}
+
+# payload types
+TYPE_NONE = 0
+TYPE_INT16 = 1
+TYPE_INT32 = 2
+TYPE_FLOAT = 3
+TYPE_STRING = 4
+
+class FrameError(ValueError):
+    pass
+
+def _make_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _make_crc_table()
+
+# CRC16-CCITT (poly 0x1021, init 0xFFFF), same as the one in the Arduino util/crc16.h
+def crc16(data, crc = 0xFFFF):
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+def _pack_value(value):
+    if value is None:
+        return TYPE_NONE, b""
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        if -0x8000 <= value <= 0x7FFF:
+            return TYPE_INT16, struct.pack(">h", value)
+        return TYPE_INT32, struct.pack(">i", value)
+    if isinstance(value, float):
+        return TYPE_FLOAT, struct.pack(">f", value)
+    payload = str(value).encode("utf-8")
+    if len(payload) > MAX_PAYLOAD:
+        raise FrameError("payload too long: " + str(len(payload)))
+    return TYPE_STRING, payload
+
+def _unpack_value(value_type, payload):
+    if value_type == TYPE_NONE:
+        return None
+    if value_type == TYPE_INT16 and len(payload) == 2:
+        return struct.unpack(">h", payload)[0]
+    if value_type == TYPE_INT32 and len(payload) == 4:
+        return struct.unpack(">i", payload)[0]
+    if value_type == TYPE_FLOAT and len(payload) == 4:
+        return struct.unpack(">f", payload)[0]
+    if value_type == TYPE_STRING:
+        return payload.decode("utf-8")
+    raise FrameError("invalid payload type " + str(value_type) + " with length " + str(len(payload)))
+
+def encode_binary(command, cmd_id, value = None, seq = None):
+    value_type, payload = _pack_value(value)
+    body = bytes([COMMANDS[command], IDS[cmd_id], value_type, len(payload)]) + payload
+    if seq is None:
+        return bytes([SYNC]) + body + struct.pack(">H", crc16(body))
+    body = bytes([seq % SEQ_MODULO]) + body
+    return bytes([SYNC_SEQ]) + body + struct.pack(">H", crc16(body))
+
+def encode_json(command, cmd_id, value = None, seq = None):
+    # TODO: the firmware still sends the placeholder checksum in JSON mode, use the CRC once it doesn't
+    frame = {"command": command, "id": cmd_id, "value": "" if value is None else str(value)}
+    if seq is not None:
+        frame["seq"] = seq % SEQ_MODULO
+    frame["checksum"] = "ABCD"
+    return json.dumps(frame).encode("utf-8") + b"\n"
+
+def encode_frame(command, cmd_id, value = None, binary = False, seq = None):
+    if binary:
+        return encode_binary(command, cmd_id, value, seq)
+    return encode_json(command, cmd_id, value, seq)
+
+# decode one complete raw frame (as returned by FrameSplitter) into (command, id, value)
+def _int_value(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise TypeError("not a number")
+    number = float(value) if isinstance(value, str) else value
+    if not math.isfinite(number):
+        raise ValueError("not a finite number")
+    return int(number)
+
+def _str_value(value):
+    if not isinstance(value, str):
+        raise TypeError("not a string")
+    return value
+
+# id: conversion of its value, the values of the other ids are passed on as they are
+VALUE_TYPES = {
+    "encoder": _int_value,
+    "scale": _int_value,
+    "protocol": _str_value,
+    "scale_rate": _int_value,
+    "bottle_empty": _int_value,
+    "bottle_refilled": _int_value,
+    "pour_start": _int_value,
+    "link": _int_value,
+}
+
+def convert_value(cmd_id, value):
+    convert = VALUE_TYPES.get(cmd_id)
+    if convert is None:
+        return value
+    try:
+        return convert(value)
+    except (TypeError, ValueError, OverflowError) as e:
+        raise FrameError("invalid value " + repr(value) + " for " + cmd_id + ": " + str(e))
+
+def decode_frame(raw):
+    return decode_sequenced(raw)[:3]
+
+# like decode_frame, but (command, id, value, seq), seq is None for frames without one
+def decode_sequenced(raw):
+    raw = bytes(raw)
+    if not raw:
+        raise FrameError("empty frame")
+    if raw[0] in (SYNC, SYNC_SEQ):
+        command, cmd_id, value, seq = decode_binary(raw)
+    else:
+        command, cmd_id, value, seq = decode_json(raw)
+    return command, cmd_id, convert_value(cmd_id, value), seq
+
+def decode_binary(raw):
+    header_size = SEQ_HEADER_SIZE if raw[0] == SYNC_SEQ else HEADER_SIZE
+    if len(raw) < header_size + CRC_SIZE or raw[0] not in (SYNC, SYNC_SEQ):
+        raise FrameError("truncated binary frame")
+    length = raw[header_size - 1]
+    if len(raw) != header_size + length + CRC_SIZE:
+        raise FrameError("binary frame length mismatch")
+    body = raw[1:header_size + length]
+    if struct.unpack(">H", raw[-CRC_SIZE:])[0] != crc16(body):
+        raise FrameError("CRC mismatch")
+    seq = None
+    if raw[0] == SYNC_SEQ:
+        seq = body[0]
+        body = body[1:]
+    try:
+        command = COMMAND_NAMES[body[0]]
+        cmd_id = ID_NAMES[body[1]]
+    except KeyError:
+        raise FrameError("unknown command or id code " + str(body[0]) + "/" + str(body[1]))
+    try:
+        value = _unpack_value(body[2], body[4:])
+    except UnicodeDecodeError as e:
+        raise FrameError("invalid string payload: " + str(e))
+    return command, cmd_id, value, seq
+
+def decode_json(raw):
+    try:
+        frame = json.loads(raw.decode("utf-8"))
+        seq = frame.get("seq")
+        command, cmd_id = frame["command"], frame["id"]
+        if not isinstance(command, str) or not isinstance(cmd_id, str):
+            raise TypeError("command and id have to be strings")
+        return command, cmd_id, frame["value"], None if seq is None else int(seq)
+    except (UnicodeDecodeError, ValueError, KeyError, TypeError, AttributeError) as e:
+        raise FrameError("invalid JSON frame: " + str(e))
+
+# theoretical frames per second for a given frame size (8N1: 10 bits on the wire per byte)
+def link_capacity(frame_size, baud_rate = 115200):
+    return baud_rate / 10 / frame_size
+
+# cuts a raw byte stream into complete frames, JSON lines and binary frames may be interleaved
+class FrameSplitter():
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.dropped_bytes = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def frames(self):
+        buf = self.buffer
+        while buf:
+            if buf[0] in (SYNC, SYNC_SEQ):
+                header_size = SEQ_HEADER_SIZE if buf[0] == SYNC_SEQ else HEADER_SIZE
+                if len(buf) < header_size:
+                    return
+                size = header_size + buf[header_size - 1] + CRC_SIZE
+                if len(buf) < size:
+                    return
+                raw = bytes(buf[:size])
+                # resynchronize on the next byte if this was a false SYNC
+                if struct.unpack(">H", raw[-CRC_SIZE:])[0] != crc16(raw[1:-CRC_SIZE]):
+                    del buf[0]
+                    self.dropped_bytes += 1
+                    continue
+                del buf[:size]
+                yield raw
+            elif buf[0] == ord("{"):
+                end = buf.find(b"\n", 0, MAX_LINE)
+                if end < 0:
+                    if len(buf) < MAX_LINE:
+                        return
+                    # resynchronize on the next byte, like after a false SYNC
+                    del buf[0]
+                    self.dropped_bytes += 1
+                    continue
+                raw = bytes(buf[:end + 1])
+                del buf[:end + 1]
+                yield raw
+            else:
+                # line noise or the tail of a broken frame
+                del buf[0]
+                self.dropped_bytes += 1
@@ -0,0 +1,165 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import math
+
+CATEGORIES = ("non-alcoholic", "alcoholic")
+
+class Recipe():
+
+    def __init__(self, name, alcoholic, volumes):
+        self.name = name
+        self.alcoholic = alcoholic
+        # list of [ingredient, volume in ml] as in cocktails.json
+        self.volumes = volumes
+        self.ingredients = frozenset(ingredient for ingredient, volume in volumes)
+
+    @property
+    def category(self):
+        return "alcoholic" if self.alcoholic else "non-alcoholic"
+
+    def __eq__(self, other):
+        return isinstance(other, Recipe) and (self.name, self.alcoholic, self.volumes) == (other.name, other.alcoholic, other.volumes)
+
+    def __repr__(self):
+        return "Recipe(" + repr(self.name) + ", " + repr(self.alcoholic) + ", " + repr(self.volumes) + ")"
+
+# recipe "database" built once from cocktails.json
+# lookups by name are dict accesses, ingredient queries intersect the sets of the inverted index
+class RecipeStore():
+
+    def __init__(self, cocktail_data = None):
+        self.recipes = {}
+        self.categories = {category: set() for category in CATEGORIES}
+        self.by_ingredient = {}
+        if cocktail_data is not None:
+            for category in CATEGORIES:
+                for name, volumes in cocktail_data.get(category, {}).items():
+                    self.add(Recipe(name, category == "alcoholic", volumes))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as cocktail_json_file:
+            return cls(json.load(cocktail_json_file))
+
+    # compare with freshly loaded cocktails.json data, returns (new or changed recipes, removed names)
+    def diff(self, cocktail_data):
+        changed = []
+        names = set()
+        for category in CATEGORIES:
+            for name, volumes in cocktail_data.get(category, {}).items():
+                recipe = Recipe(name, category == "alcoholic", volumes)
+                names.add(name)
+                if self.recipes.get(name) != recipe:
+                    changed.append(recipe)
+        return changed, [name for name in self.recipes if name not in names]
+
+    def __len__(self):
+        return len(self.recipes)
+
+    def __contains__(self, name):
+        return name in self.recipes
+
+    def __iter__(self):
+        return iter(self.recipes.values())
+
+    def add(self, recipe):
+        if recipe.name in self.recipes:
+            self.remove(recipe.name)
+        self.recipes[recipe.name] = recipe
+        self.categories[recipe.category].add(recipe.name)
+        for ingredient in recipe.ingredients:
+            self.by_ingredient.setdefault(ingredient, set()).add(recipe.name)
+
+    def remove(self, name):
+        recipe = self.recipes.pop(name)
+        self.categories[recipe.category].discard(name)
+        for ingredient in recipe.ingredients:
+            names = self.by_ingredient[ingredient]
+            names.discard(name)
+            if not names:
+                del self.by_ingredient[ingredient]
+        return recipe
+
+    def get(self, name):
+        return self.recipes.get(name)
+
+    def ingredients(self):
+        return self.by_ingredient.keys()
+
+    # alcoholic=False only returns non-alcoholic cocktails, True means all cocktails (like the AlcoholMenu)
+    def names(self, alcoholic = True):
+        if alcoholic:
+            return set(self.recipes)
+        return set(self.categories["non-alcoholic"])
+
+    # names of the cocktails containing all of include and none of exclude
+    def query(self, include = (), exclude = (), alcoholic = True):
+        include_sets = sorted((self.by_ingredient.get(i, set()) for i in include), key = len)
+        if include_sets:
+            # start with the smallest set so the intersection stays small
+            result = set(include_sets[0])
+            for names in include_sets[1:]:
+                if not result:
+                    break
+                result &= names
+            if not alcoholic:
+                result &= self.categories["non-alcoholic"]
+        else:
+            result = self.names(alcoholic)
+        for ingredient in exclude:
+            if not result:
+                break
+            result -= self.by_ingredient.get(ingredient, set())
+        return result
+
+# a real number, JSON also allows true/false and NaN where a number is expected
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+# raises ValueError if the cocktails.json data can't be used with these ingredients
+def validate(cocktail_data, ingredients_data):
+    if not isinstance(cocktail_data, dict) or not set(cocktail_data) <= set(CATEGORIES):
+        raise ValueError("expected the categories " + ", ".join(CATEGORIES))
+    names = set()
+    for category, cocktails in cocktail_data.items():
+        if not isinstance(cocktails, dict):
+            raise ValueError(category + ": expected cocktails by name")
+        for name, volumes in cocktails.items():
+            if name in names:
+                raise ValueError(name + ": listed twice")
+            names.add(name)
+            if not isinstance(volumes, list) or not volumes:
+                raise ValueError(name + ": expected a list of ingredients")
+            for item in volumes:
+                if not isinstance(item, list) or len(item) != 2 or not isinstance(item[0], str) or not isNumber(item[1]) or item[1] <= 0:
+                    raise ValueError(name + ": invalid ingredient " + repr(item))
+                if item[0] not in ingredients_data:
+                    raise ValueError(name + ": unknown ingredient " + repr(item[0]))
+
+def validateIngredients(ingredients_data):
+    if not isinstance(ingredients_data, dict):
+        raise ValueError("expected ingredients by name")
+    for name, data in ingredients_data.items():
+        if not isinstance(data, dict):
+            raise ValueError(name + ": expected price and density")
+        for key in ("price", "density"):
+            if not isNumber(data.get(key)) or data[key] < 0:
+                raise ValueError(name + ": invalid " + key)
+        if data["density"] == 0:
+            raise ValueError(name + ": density can't be 0")
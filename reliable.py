@@ -0,0 +1,232 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+
+import protocol
+
+# acknowledged commands to the Arduino with a sliding window and selective retransmit
+#
+# commands (set, get, pour) get a sequence number and up to WINDOW of them are in flight at
+# once, so a pour schedule doesn't wait one round trip per frame. the device acknowledges
+# every sequence number it received ("ack link <seq>") and delivers the commands in order.
+# a gap makes it send "nak link <missing seq>", which retransmits only that frame right away,
+# everything else unacknowledged after the retransmission timeout is sent again on its own.
+# telemetry from the device is never sequenced and keeps flowing in between.
+#
+# the timeout follows the measured round trip time (Jacobson/Karels, retransmitted frames
+# are not sampled). a command still unacknowledged after MAX_RETRIES fails together with
+# everything behind it, the device can't deliver those in order anymore, and the sender is
+# marked broken until the link is negotiated again, the same goes for a frame the device
+# keeps NAKing.
+# emergency stops don't go through here, they are sent without a sequence number so the
+# device acts on them whatever is missing in the window, and again every STOP_INTERVAL
+# until the device confirms them with "finished emergency_stop" (see HardwareInterface)
+# this class only does the bookkeeping, the caller writes the frames it returns and
+# calls poll() again at nextDeadline()
+
+# must stay below half the sequence space, a retransmitted frame is never mistaken for a new one
+WINDOW = 8
+
+# s
+INITIAL_TIMEOUT = 0.2
+MIN_TIMEOUT = 0.02
+MAX_TIMEOUT = 2.0
+
+MAX_RETRIES = 8
+
+# s
+STOP_INTERVAL = 0.1
+MAX_STOP_RESENDS = 100
+
+class Transmission():
+
+    def __init__(self, seq, command, cmd_id, value, callback):
+        self.seq = seq
+        self.command = command
+        self.cmd_id = cmd_id
+        self.value = value
+        # callback(ok, detail, rtt)
+        self.callback = callback
+        self.first_sent = None
+        self.sent = None
+        self.deadline = None
+        self.retries = 0
+
+    def __repr__(self):
+        return "Transmission(" + str(self.seq) + ", " + self.command + " " + self.cmd_id + " " + str(self.value) + ")"
+
+class ReliableSender():
+
+    def __init__(self, window = WINDOW, max_retries = MAX_RETRIES):
+        self.window = window
+        self.max_retries = max_retries
+        self.next_seq = 0
+        self.queue = deque()
+        # seq: Transmission, in sequence order (the first one is the oldest)
+        self.in_flight = {}
+        self.broken = False
+        self.srtt = None
+        self.rttvar = 0
+        self.timeout = INITIAL_TIMEOUT
+        self.sent = 0
+        self.acked = 0
+        self.failed = 0
+        self.retransmits = 0
+        self.naks = 0
+        self.rtt_min = None
+        self.rtt_max = None
+        self.occupancy_sum = 0
+        self.occupancy_samples = 0
+        self.occupancy_max = 0
+
+    def submit(self, command, cmd_id, value = None, callback = None):
+        transmission = Transmission(self.next_seq, command, cmd_id, value, callback)
+        self.next_seq = (self.next_seq + 1) % protocol.SEQ_MODULO
+        self.queue.append(transmission)
+        return transmission
+
+    # the frames to write now: queued ones while the window has room, timed out ones again
+    def poll(self, now, binary = False):
+        frames = []
+        timed_out = [transmission for transmission in self.in_flight.values() if transmission.deadline <= now]
+        if timed_out:
+            # back off, the link may just be busy
+            self.timeout = min(self.timeout * 2, MAX_TIMEOUT)
+        for transmission in timed_out:
+            if transmission.retries >= self.max_retries:
+                self.broken = True
+                self.reset("no ACK for " + repr(transmission) + " after " + str(transmission.retries) + " retries")
+                return []
+            transmission.retries += 1
+            self.retransmits += 1
+            frames.append(self.transmit(transmission, now, binary))
+        # the window starts at the oldest unacknowledged frame, not just a count of frames
+        # in flight, or the device would take a new frame for an old one
+        while self.queue and (not self.in_flight or
+                (self.queue[0].seq - next(iter(self.in_flight))) % protocol.SEQ_MODULO < self.window):
+            transmission = self.queue.popleft()
+            self.in_flight[transmission.seq] = transmission
+            frames.append(self.transmit(transmission, now, binary))
+        self.occupancy_sum += len(self.in_flight)
+        self.occupancy_samples += 1
+        self.occupancy_max = max(self.occupancy_max, len(self.in_flight))
+        return frames
+
+    def transmit(self, transmission, now, binary):
+        if transmission.first_sent is None:
+            transmission.first_sent = now
+            self.sent += 1
+        transmission.sent = now
+        transmission.deadline = now + self.timeout
+        return protocol.encode_frame(transmission.command, transmission.cmd_id, transmission.value, binary, transmission.seq)
+
+    def nextDeadline(self):
+        return min((transmission.deadline for transmission in self.in_flight.values()), default = None)
+
+    def ack(self, seq, now):
+        transmission = self.in_flight.get(seq)
+        if transmission is None:
+            # duplicate ACK of a retransmitted frame
+            return None
+        rtt = now - transmission.sent
+        if transmission.retries == 0:
+            self.sampleRtt(rtt)
+        self.finish(transmission, True, "ack", now - transmission.first_sent)
+        return transmission
+
+    # the frame to retransmit right away, None if seq isn't in flight
+    def nak(self, seq, now, binary = False):
+        self.naks += 1
+        transmission = self.in_flight.get(seq)
+        if transmission is None:
+            return None
+        if transmission.retries >= self.max_retries:
+            self.broken = True
+            self.reset("still NAKed " + repr(transmission) + " after " + str(transmission.retries) + " retries")
+            return None
+        transmission.retries += 1
+        self.retransmits += 1
+        return self.transmit(transmission, now, binary)
+
+    def sampleRtt(self, rtt):
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+        self.rtt_max = rtt if self.rtt_max is None else max(self.rtt_max, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += 0.25 * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += 0.125 * (rtt - self.srtt)
+        self.timeout = min(self.srtt + max(4 * self.rttvar, MIN_TIMEOUT), MAX_TIMEOUT)
+
+    def finish(self, transmission, ok, detail, rtt = None):
+        del self.in_flight[transmission.seq]
+        if ok:
+            self.acked += 1
+        else:
+            self.failed += 1
+        if transmission.callback is not None:
+            transmission.callback(ok, detail, rtt)
+
+    # fail everything, e.g. when the port is closed
+    def reset(self, reason):
+        for transmission in list(self.in_flight.values()):
+            self.finish(transmission, False, reason)
+        while self.queue:
+            transmission = self.queue.popleft()
+            self.failed += 1
+            if transmission.callback is not None:
+                transmission.callback(False, reason, None)
+
+    def stats(self):
+        return {"sent": self.sent, "acked": self.acked, "failed": self.failed,
+            "retransmits": self.retransmits, "naks": self.naks,
+            "rtt_ms": None if self.srtt is None else self.srtt * 1000,
+            "rtt_min_ms": None if self.rtt_min is None else self.rtt_min * 1000,
+            "rtt_max_ms": None if self.rtt_max is None else self.rtt_max * 1000,
+            "timeout_ms": self.timeout * 1000,
+            "in_flight": len(self.in_flight), "queued": len(self.queue),
+            "window": self.window, "window_max": self.occupancy_max,
+            "window_average": self.occupancy_sum / self.occupancy_samples if self.occupancy_samples else 0}
+
+# the device side, used by the emulators: acknowledges every frame and delivers them in order
+class ReliableReceiver():
+
+    def __init__(self, window = WINDOW):
+        self.window = window
+        self.expected = 0
+        # seq: item received ahead of a missing one
+        self.buffer = {}
+        self.duplicates = 0
+
+    # returns (items to handle now in order, [(command, seq), ...] to answer)
+    def receive(self, seq, item):
+        offset = (seq - self.expected) % protocol.SEQ_MODULO
+        if offset >= self.window:
+            # already delivered, the ACK got lost
+            self.duplicates += 1
+            return [], [("ack", seq)]
+        answers = [("ack", seq)]
+        self.buffer[seq] = item
+        if offset > 0:
+            answers.append(("nak", self.expected))
+        items = []
+        while self.expected in self.buffer:
+            items.append(self.buffer.pop(self.expected))
+            self.expected = (self.expected + 1) % protocol.SEQ_MODULO
+        return items, answers
@@ -0,0 +1,161 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+# replay a capture (see capture.py) into HardwareInterface.serialProcess
+#
+#   python3 replay.py data/captures/mixer-....cap                    real speed
+#   python3 replay.py --speed 10 <capture>                           10 times faster
+#   python3 replay.py --speed 0 <capture>                            as fast as possible
+#   python3 replay.py --gui <capture>                                through a whole Controller
+#   python3 replay.py --speed 0 --save expected.json <capture>       regression test:
+#   python3 replay.py --speed 0 --expect expected.json <capture>     exit code 1 on differences
+#
+# the received frames are fed with their captured times as rx_time, the scale filter and
+# glass detection see the same timeline at any speed and give the same results. the
+# coalescing of the display follows the wall clock and is only realistic at real speed, the
+# latency tracker is switched off at any other speed. sent frames are in the capture for
+# capture.py, they aren't replayed. with --gui the pour history, flow model and latency
+# snapshot of the Controller go to a temporary directory, a replay never changes the real ones
+
+# let the GUI run after this many frames when replaying as fast as possible
+BATCH = 100
+
+# signals of the HardwareInterface counted in the summary
+SIGNALS = ("encoder_changed", "encoder_clicked", "emergency_stop", "scale_changed", "glass_changed", "bottle_empty", "pour_finished")
+
+# depend on the wall clock, not compared with --expect
+TIMING_KEYS = ("replay_s", "frames_per_s", "scale_changed")
+
+def main(args):
+    parser = argparse.ArgumentParser(description = "replay a CocktailMixer serial capture")
+    parser.add_argument("capture")
+    parser.add_argument("--speed", type = float, default = 1, help = "1 = real speed, 0 = as fast as possible")
+    parser.add_argument("--gui", action = "store_true", help = "replay into a whole Controller with its menus")
+    parser.add_argument("--show", action = "store_true", help = "show the window instead of the offscreen platform")
+    parser.add_argument("--save", help = "write the summary as JSON")
+    parser.add_argument("--expect", help = "compare with a saved summary")
+    options = parser.parse_args(args[1:])
+    if not options.show:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication
+    import eventlog
+    import latency
+    import serialio
+    from capture import CaptureReader, RX
+    from cocktailmixer import Controller, HardwareInterface
+
+    eventlog.setup()
+    # away from real speed the captured rx times drift from the wall clock, the latencies would be nonsense
+    latency.tracker.enabled = options.speed == 1
+    app = QApplication(args[:1])
+    # the port doesn't exist, the frames only come from the capture
+    port_name = "/dev/null-cocktailmixer-replay"
+    controller = None
+    state_dir = None
+    if options.gui:
+        state_dir = tempfile.mkdtemp(prefix = "cocktailmixer-replay-")
+        controller = Controller(port_name, state_dir = state_dir)
+        while not controller.startup_complete:
+            app.processEvents()
+        hardware_interface = controller.hardware_interface
+    else:
+        hardware_interface = HardwareInterface(port_name)
+    counts = {name: 0 for name in SIGNALS}
+    for name in SIGNALS:
+        getattr(hardware_interface, name).connect(lambda *values, name = name: counts.__setitem__(name, counts[name] + 1))
+
+    reader = CaptureReader(options.capture)
+    frames = ((t, frame) for t, direction, frame in reader if direction == RX)
+    state = {"next": next(frames, None), "fed": 0, "last": 0}
+    if state["next"] is None:
+        print("no received frames in " + options.capture)
+        if state_dir is not None:
+            shutil.rmtree(state_dir, ignore_errors = True)
+        return
+    first = state["next"][0]
+    start = time.perf_counter()
+    timer = QTimer()
+    timer.setSingleShot(True)
+
+    def feed():
+        now = time.perf_counter()
+        fed = 0
+        while state["next"] is not None:
+            t, frame = state["next"]
+            due = start + (t - first) / options.speed if options.speed else now
+            if due > now or (not options.speed and fed >= BATCH):
+                break
+            hardware_interface.serialProcess(frame, start + t - first)
+            state["last"] = t
+            state["next"] = next(frames, None)
+            fed += 1
+        state["fed"] += fed
+        if state["next"] is None:
+            app.quit()
+        elif options.speed:
+            timer.start(max(int((start + (state["next"][0] - first) / options.speed - time.perf_counter()) * 1000), 0))
+        else:
+            timer.start(0)
+
+    timer.timeout.connect(feed)
+    feed()
+    if state["next"] is not None:
+        app.exec_()
+    elapsed = time.perf_counter() - start
+    # the last scale value may still wait for its display frame
+    hardware_interface.flushScale()
+
+    summary = {"frames": state["fed"], "invalid_frames": hardware_interface.invalid_frames,
+        "captured_s": round(state["last"] - first, 3), "replay_s": round(elapsed, 3), "frames_per_s": round(state["fed"] / elapsed),
+        "scale_samples": hardware_interface.scale_samples_total, "final_weight": round(hardware_interface.scale_filter.weight, 1)}
+    summary.update(counts)
+    for key, value in summary.items():
+        print("%-16s %s" % (key, value))
+
+    if controller is not None:
+        controller.close()
+    else:
+        hardware_interface.close()
+        serialio.stopIoThread()
+    reader.close()
+    eventlog.shutdown()
+    if state_dir is not None:
+        shutil.rmtree(state_dir, ignore_errors = True)
+
+    if options.save:
+        with open(options.save, "w") as summary_file:
+            json.dump(summary, summary_file, indent = 1)
+    if options.expect:
+        with open(options.expect) as summary_file:
+            expected = json.load(summary_file)
+        differences = [key for key in expected if key not in TIMING_KEYS and expected[key] != summary.get(key)]
+        for key in differences:
+            print("DIFFERENT %s: expected %s, got %s" % (key, expected[key], summary.get(key)))
+        sys.exit(1 if differences else 0)
+
+if __name__== "__main__":
+    main( sys.argv )
@@ -0,0 +1,243 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import random
+import itertools
+
+from pricing import PRICE_VOLUME
+
+# random suggestions for RANDOM COCKTAIL and RANDOM INGREDIENTS, drawn in constant time
+#
+# only valid suggestions are in the tables, nothing is drawn and thrown away again:
+#   cocktails    pourable and at most MAX_PRICE per dl, weighted by 1 + times poured
+#   ingredients  pairs of ingredients (or the single one of a one-ingredient recipe),
+#                weighted by the number of such cocktails containing them, so every pair
+#                leads to at least one cocktail in the select by ingredients list
+# one table each for all cocktails and for the non-alcoholic ones.
+#
+# a table is an alias table (Walker/Vose, one random number per draw) per block of
+# BLOCK_SIZE items and one more alias table over the block totals. a bottle running dry or
+# a price change only marks the blocks of the recipes concerned, they are rebuilt on the
+# next draw, so a change costs the size of a few blocks instead of the whole table.
+# "python3 sampling.py <count>" times building and drawing on a synthetic table
+
+BLOCK_SIZE = 256
+
+# per dl in the currency of ingredients.json, pricier cocktails are never suggested
+MAX_PRICE = 5.0
+
+class AliasTable():
+
+    def __init__(self, weights):
+        count = len(weights)
+        self.total = sum(weights)
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+        if self.total <= 0:
+            return
+        scaled = [weight * count / self.total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        # the rest is 1 up to rounding errors
+        for i in small + large:
+            self.probability[i] = 1.0
+
+    # index, drawn with the probability of its weight
+    def sample(self, rng = random):
+        u = rng.random() * len(self.probability)
+        i = int(u)
+        return i if u - i < self.probability[i] else self.alias[i]
+
+class WeightedSampler():
+
+    def __init__(self, block_size = BLOCK_SIZE):
+        self.block_size = block_size
+        # slot: key (None if free) and its weight
+        self.keys = []
+        self.weights = []
+        # key: slot
+        self.slots = {}
+        self.free = []
+        self.blocks = []
+        self.top = AliasTable([])
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    # a weight of 0 or less removes the key
+    def set(self, key, weight):
+        if weight <= 0:
+            self.remove(key)
+            return
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = len(self.keys)
+                self.keys.append(None)
+                self.weights.append(0)
+            self.slots[key] = slot
+            self.keys[slot] = key
+        elif self.weights[slot] == weight:
+            return
+        self.weights[slot] = weight
+        self.dirty.add(slot // self.block_size)
+
+    def remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        self.keys[slot] = None
+        self.weights[slot] = 0
+        self.free.append(slot)
+        self.dirty.add(slot // self.block_size)
+
+    def rebuild(self):
+        if not self.dirty:
+            return
+        size = self.block_size
+        while len(self.blocks) * size < len(self.keys):
+            self.blocks.append(None)
+        for block in self.dirty:
+            self.blocks[block] = AliasTable(self.weights[block * size:(block + 1) * size])
+        self.top = AliasTable([table.total for table in self.blocks])
+        self.dirty.clear()
+
+    # a key drawn with the probability of its weight, None if there is none
+    def sample(self, rng = random):
+        self.rebuild()
+        if self.top.total <= 0:
+            return None
+        block = self.top.sample(rng)
+        return self.keys[block * self.block_size + self.blocks[block].sample(rng)]
+
+# the ingredient combinations a recipe counts for
+def mixes(recipe):
+    ingredients = sorted(recipe.ingredients)
+    if len(ingredients) == 1:
+        return [tuple(ingredients)]
+    return list(itertools.combinations(ingredients, 2))
+
+class Suggestions():
+
+    def __init__(self, recipes, availability, price_table, history = None, max_price = MAX_PRICE):
+        self.recipes = recipes
+        self.availability = availability
+        self.price_table = price_table
+        self.history = history
+        self.max_price = max_price
+        # by the alcohol choice of the menu: True all cocktails, False only non-alcoholic ones
+        self.cocktails = {True: WeightedSampler(), False: WeightedSampler()}
+        self.mixes = {True: WeightedSampler(), False: WeightedSampler()}
+        self.mix_counts = {True: {}, False: {}}
+        # name: (alcoholic, mixes) of the cocktails in the tables
+        self.included = {}
+        self.update(recipe.name for recipe in recipes)
+        availability.watch(self.update)
+        for sampler in list(self.cocktails.values()) + list(self.mixes.values()):
+            sampler.rebuild()
+
+    def suggestible(self, recipe):
+        return recipe.name in self.availability.pourable and \
+            self.price_table.getPrice(recipe.name, PRICE_VOLUME) <= self.max_price
+
+    def weight(self, name):
+        return 1 + (self.history.counts.get(name, 0) if self.history is not None else 0)
+
+    # check these cocktails again: availability, price or popularity changed
+    def update(self, names):
+        # the mixes are counted first and set once, a bottle change touches many cocktails
+        touched = {True: set(), False: set()}
+        for name in names:
+            old = self.included.pop(name, None)
+            if old is not None:
+                self.include(name, old[0], old[1], -1, touched)
+            recipe = self.recipes.get(name)
+            if recipe is not None and self.suggestible(recipe):
+                recipe_mixes = mixes(recipe)
+                self.included[name] = (recipe.alcoholic, recipe_mixes)
+                self.include(name, recipe.alcoholic, recipe_mixes, 1, touched)
+        for selection, touched_mixes in touched.items():
+            counts = self.mix_counts[selection]
+            sampler = self.mixes[selection]
+            for mix in touched_mixes:
+                sampler.set(mix, counts.get(mix, 0))
+
+    def include(self, name, alcoholic, recipe_mixes, delta, touched):
+        for selection in (True,) if alcoholic else (True, False):
+            if delta > 0:
+                self.cocktails[selection].set(name, self.weight(name))
+            else:
+                self.cocktails[selection].remove(name)
+            counts = self.mix_counts[selection]
+            for mix in recipe_mixes:
+                count = counts.get(mix, 0) + delta
+                if count > 0:
+                    counts[mix] = count
+                else:
+                    del counts[mix]
+            touched[selection].update(recipe_mixes)
+
+    # a cocktail name, None if nothing can be suggested
+    def cocktail(self, alcoholic = True, rng = random):
+        return self.cocktails[alcoholic].sample(rng)
+
+    # a list of one or two ingredients, None if nothing can be suggested
+    def ingredients(self, alcoholic = True, rng = random):
+        mix = self.mixes[alcoholic].sample(rng)
+        return list(mix) if mix is not None else None
+
+def main(args):
+    import time
+    count = int(args[1]) if len(args) > 1 else 100000
+    rng = random.Random(42)
+    weights = [rng.randint(1, 20) for i in range(count)]
+    start = time.perf_counter()
+    sampler = WeightedSampler()
+    for i, weight in enumerate(weights):
+        sampler.set(i, weight)
+    sampler.rebuild()
+    print("build %d: %.1fms" % (count, (time.perf_counter() - start) * 1000))
+    draws = 100000
+    start = time.perf_counter()
+    for i in range(draws):
+        sampler.sample(rng)
+    print("draw: %.2fus" % ((time.perf_counter() - start) / draws * 1e6))
+    start = time.perf_counter()
+    for i in range(100):
+        sampler.set(rng.randrange(count), rng.randint(0, 20))
+        sampler.rebuild()
+    print("single change and rebuild: %.2fms" % ((time.perf_counter() - start) / 100 * 1000))
+
+if __name__== "__main__":
+    main( sys.argv )
@@ -0,0 +1,118 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import bisect
+from collections import deque
+
+# streaming filter for the raw scale samples, constant work per sample
+#
+#   1. moving median over the last few samples removes single spikes
+#   2. alpha-beta filter (a steady state Kalman filter for weight and rate) smooths the noise
+#      without lagging behind a running pour, since it tracks the rate as well. the gains
+#      follow from the time constant FILTER_TIME, so any scale rate gives the same response
+#   3. stable: the weight stayed within STABLE_BAND for STABLE_TIME
+#   4. glass: a stable weight of at least GLASS_MIN_MASS, gone below half of it again
+# the empty scale slowly drifts, its zero (tare) follows while nothing is on it
+
+MEDIAN_WINDOW = 5
+# s
+FILTER_TIME = 0.1
+
+# g
+STABLE_BAND = 2
+# s
+STABLE_TIME = 0.4
+
+# g above zero, lighter glasses aren't detected
+GLASS_MIN_MASS = 30
+
+# the zero follows readings this close to it (g) while the scale is stable and empty
+ZERO_BAND = 5
+ZERO_TRACKING = 0.02
+
+# after a pause longer than this (s) the filter restarts from the next sample
+MAX_GAP = 1.0
+
+class ScaleFilter():
+
+    def __init__(self):
+        self.window = deque()
+        self.sorted = []
+        self.raw = None
+        self.zero = 0
+        self.last_time = None
+        self.stable_since = None
+        self.stable_weight = None
+        # filtered weight above zero (g) and its rate of change (g/s)
+        self.weight = 0
+        self.rate = 0
+        self.stable = False
+        self.glass = False
+
+    # the next sample in raw scale units, now in seconds. returns the events it caused:
+    # "stable", "unstable", "glass_placed", "glass_removed"
+    def update(self, value, now):
+        window = self.window
+        window.append(value)
+        bisect.insort(self.sorted, value)
+        if len(window) > MEDIAN_WINDOW:
+            del self.sorted[bisect.bisect_left(self.sorted, window.popleft())]
+        median = self.sorted[len(self.sorted) // 2]
+
+        dt = now - self.last_time if self.last_time is not None else None
+        self.last_time = now
+        if dt is None or dt > MAX_GAP:
+            self.raw = median
+            self.rate = 0
+        elif dt > 0:
+            alpha = 1 - math.exp(-dt / FILTER_TIME)
+            # critically damped (Benedict-Bordner)
+            beta = alpha * alpha / (2 - alpha)
+            predicted = self.raw + self.rate * dt
+            residual = median - predicted
+            self.raw = predicted + alpha * residual
+            self.rate += beta * residual / dt
+        self.weight = self.raw - self.zero
+
+        events = []
+        if self.stable_weight is None or abs(self.weight - self.stable_weight) > STABLE_BAND:
+            self.stable_weight = self.weight
+            self.stable_since = now
+            if self.stable:
+                self.stable = False
+                events.append("unstable")
+        elif not self.stable and now - self.stable_since >= STABLE_TIME:
+            self.stable = True
+            events.append("stable")
+
+        if self.glass and self.weight < GLASS_MIN_MASS / 2:
+            self.glass = False
+            events.append("glass_removed")
+        elif not self.glass and self.stable and self.weight >= GLASS_MIN_MASS:
+            self.glass = True
+            events.append("glass_placed")
+        elif not self.glass and self.stable and abs(self.weight) < ZERO_BAND:
+            self.zero += ZERO_TRACKING * self.weight
+        return events
+
+    # take the current weight as zero
+    def tare(self):
+        if self.raw is not None:
+            self.zero = self.raw
+            self.weight = 0
+            self.stable_weight = None
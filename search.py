@@ -0,0 +1,126 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import bisect
+
+# type-ahead search over cocktail and ingredient names, built once when the recipes are loaded
+#
+# the prefix index is a trie flattened into sorted arrays: all keys starting with a prefix
+# are one contiguous range found with two binary searches, so a keystroke costs O(log n + k)
+# no matter how many names there are. results are ranked by:
+#   1. cocktail name starts with the query
+#   2. a word of the cocktail name starts with the query
+#   3. the cocktail contains an ingredient starting with the query
+#   4. fuzzy match: cocktail names sharing trigrams with the query (typos, missing letters)
+
+MAX_RESULTS = 20
+
+# trigrams found in more names than this don't help ranking and are skipped
+MAX_POSTINGS = 2000
+
+def normalize(text):
+    return re.sub(r"[^a-z0-9 ]+", "", text.lower()).strip()
+
+def trigrams(text):
+    text = " " + text + " "
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+class PrefixIndex():
+
+    def __init__(self, pairs):
+        pairs = sorted(pairs)
+        self.keys = [key for key, value in pairs]
+        self.values = [value for key, value in pairs]
+
+    # all values whose key starts with prefix, in key order
+    def range(self, prefix):
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + "\uffff", start)
+        return range(start, end)
+
+class SearchIndex():
+
+    def __init__(self, recipes):
+        self.recipes = recipes
+        self.names = sorted(recipe.name for recipe in recipes)
+        ids = {name: i for i, name in enumerate(self.names)}
+        normalized = [normalize(name) for name in self.names]
+        self.full = PrefixIndex((key, i) for i, key in enumerate(normalized))
+        words = []
+        for i, key in enumerate(normalized):
+            # the first word is already covered by the full name
+            words.extend((word, i) for word in key.split()[1:])
+        self.words = PrefixIndex(words)
+        self.ingredients = PrefixIndex((normalize(ingredient), ingredient) for ingredient in recipes.ingredients())
+        self.ingredient_ids = {ingredient: sorted(ids[name] for name in names) for ingredient, names in recipes.by_ingredient.items()}
+        self.trigrams = {}
+        self.trigram_counts = []
+        for i, key in enumerate(normalized):
+            key_trigrams = trigrams(key)
+            self.trigram_counts.append(len(key_trigrams))
+            for trigram in key_trigrams:
+                self.trigrams.setdefault(trigram, []).append(i)
+
+    def search(self, query, allowed = None, limit = MAX_RESULTS):
+        query = normalize(query)
+        results = []
+        seen = set()
+
+        def add(i):
+            name = self.names[i]
+            if i not in seen and (allowed is None or name in allowed):
+                seen.add(i)
+                results.append(name)
+            return len(results) >= limit
+
+        if not query:
+            for i in range(len(self.names)):
+                if add(i):
+                    return results
+            return results
+        for index in (self.full, self.words):
+            for position in index.range(query):
+                if add(index.values[position]):
+                    return results
+        for position in self.ingredients.range(query):
+            for i in self.ingredient_ids.get(self.ingredients.values[position], ()):
+                if add(i):
+                    return results
+        if len(query) >= 2:
+            for i in self.fuzzy(query):
+                if add(i):
+                    return results
+        return results
+
+    # ids of names sharing at least half of the usable query trigrams, best match first
+    def fuzzy(self, query):
+        query_trigrams = trigrams(query)
+        counts = {}
+        used = 0
+        for trigram in query_trigrams:
+            postings = self.trigrams.get(trigram, ())
+            if not postings or len(postings) > MAX_POSTINGS:
+                continue
+            used += 1
+            for i in postings:
+                counts[i] = counts.get(i, 0) + 1
+        # typos create trigrams no name has, only the known ones count
+        needed = used / 2
+        scored = [(count / (len(query_trigrams) + self.trigram_counts[i] - count), i) for i, count in counts.items() if count >= needed]
+        scored.sort(key = lambda item: (-item[0], item[1]))
+        return [i for score, i in scored]
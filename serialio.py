@@ -0,0 +1,168 @@
+# Copyright 2017 Marco Zollinger <marco@freelabs.space>
+#
+# This file is part of CocktailMixer.
+#
+# CocktailMixer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CocktailMixer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CocktailMixer.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from collections import deque
+
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QIODevice, QObject, QThread, QTimer
+from PyQt5.QtSerialPort import QSerialPort
+
+import protocol
+import capture
+
+# serial port reading and frame decoding off the GUI thread
+#
+# the SerialWorker owns the QSerialPort and lives in the I/O thread. decoded frames are
+# appended to a deque (append/popleft are atomic, no lock needed) and the GUI thread is
+# notified with a queued signal, at most once until it drained the deque again, so a
+# stalled GUI only lets the deque grow instead of delaying the decoding.
+# with a capture.CaptureWriter every frame read or written is recorded in this thread too
+
+# events waiting for the GUI, above this the telemetry in DROPPABLE is dropped
+MAX_QUEUE = 1024
+
+# (command, id) of the telemetry a newer frame makes up for. everything else (replies,
+# ACK/NAK, button and bottle updates) changes state and always goes through
+DROPPABLE = (("update", "scale"), ("update", "encoder"))
+
+_io_thread = None
+
+# one thread for all serial ports
+def ioThread():
+    global _io_thread
+    if _io_thread is None:
+        _io_thread = QThread()
+        _io_thread.setObjectName("serial I/O")
+        _io_thread.start()
+    return _io_thread
+
+def stopIoThread():
+    global _io_thread
+    if _io_thread is not None:
+        _io_thread.quit()
+        _io_thread.wait()
+        _io_thread = None
+
+class SerialWorker(QObject):
+
+    events_ready = pyqtSignal()
+    opened = pyqtSignal(bool, str)
+
+    def __init__(self, port_name, baud_rate = 115200, max_queue = MAX_QUEUE, capture_writer = None):
+        super().__init__()
+        self.port_name = port_name
+        self.capture_writer = capture_writer
+        self.baud_rate = baud_rate
+        self.max_queue = max_queue
+        self.serial = None
+        self.flush_timer = None
+        self.splitter = protocol.FrameSplitter()
+        # (command, id, value, rx_time, parse_time)
+        self.events = deque()
+        self.notified = False
+        self.max_depth = 0
+        self.dropped = 0
+        self.invalid_frames = 0
+        self.last_rx_time = 0
+
+    @pyqtSlot()
+    def open(self):
+        # TODO: check for port opening / writing exceptions
+        self.serial = QSerialPort(self)
+        self.serial.readyRead.connect(self.serialRead)
+        self.serial.setPortName(self.port_name)
+        ok = self.serial.open(QIODevice.ReadWrite)
+        self.serial.setBaudRate(self.baud_rate)
+        self.serial.setDataBits(8)
+        self.serial.setParity(QSerialPort.NoParity)
+        self.serial.setStopBits(1)
+        self.serial.setFlowControl(QSerialPort.NoFlowControl)
+        if ok:
+            self.serial.clear(QSerialPort.Input)
+        if self.capture_writer is not None:
+            # created here to live in the I/O thread with the writer
+            self.flush_timer = QTimer(self)
+            self.flush_timer.timeout.connect(self.capture_writer.flush)
+            self.flush_timer.start(int(capture.FLUSH_INTERVAL * 1000))
+        self.opened.emit(ok, self.serial.errorString())
+
+    @pyqtSlot()
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+        if self.flush_timer is not None:
+            self.flush_timer.stop()
+            self.flush_timer = None
+        if self.capture_writer is not None:
+            self.capture_writer.close()
+            self.capture_writer = None
+
+    @pyqtSlot(bytes)
+    def write(self, data):
+        if self.serial is not None:
+            self.serial.write(data)
+            if self.capture_writer is not None:
+                self.capture_writer.write(capture.TX, data)
+
+    def serialRead(self):
+        now = time.perf_counter()
+        self.splitter.feed(bytes(self.serial.readAll()))
+        frames = list(self.splitter.frames())
+        # one read often holds several frames. the last one was complete just now, every one
+        # before it one frame time on the wire earlier, so each frame (a scale sample for the
+        # filter) gets a time of its own, always after the frames of the previous read
+        times = []
+        rx_time = now
+        for raw in reversed(frames):
+            times.append(rx_time)
+            rx_time -= len(raw) * 10 / self.baud_rate
+        for raw, rx_time in zip(frames, reversed(times)):
+            rx_time = max(rx_time, self.last_rx_time + 1e-6)
+            self.last_rx_time = rx_time
+            if self.capture_writer is not None:
+                self.capture_writer.write(capture.RX, raw, rx_time)
+            self.process(raw, rx_time)
+
+    def process(self, raw, rx_time):
+        try:
+            cmd, cmd_id, value = protocol.decode_frame(raw)
+        except protocol.FrameError:
+            self.invalid_frames += 1
+            return
+        if len(self.events) >= self.max_queue and (cmd, cmd_id) in DROPPABLE:
+            self.dropped += 1
+            return
+        self.events.append((cmd, cmd_id, value, rx_time, time.perf_counter()))
+        self.max_depth = max(self.max_depth, len(self.events))
+        if not self.notified:
+            self.notified = True
+            self.events_ready.emit()
+
+    # called from the GUI thread, reset the notification before draining so nothing gets stuck
+    def takeEvents(self):
+        self.notified = False
+        events = self.events
+        while True:
+            try:
+                yield events.popleft()
+            except IndexError:
+                return
+
+    def stats(self):
+        return {"queue_depth": len(self.events), "max_depth": self.max_depth,
+            "dropped": self.dropped, "invalid_frames": self.invalid_frames,
+            "dropped_bytes": self.splitter.dropped_bytes}